@@ -0,0 +1,53 @@
+"""Compare shutil.copytree with the threaded copy in nsist.fileops, on a tree
+of many small files like a large package.
+
+Usage: python benchmarks/bench_copytree.py [n_files] [threads]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nsist.fileops import copytree  # noqa: E402
+
+FILES_PER_DIR = 50
+REPEAT = 3
+
+
+def make_tree(root, n_files):
+    for i in range(n_files):
+        d = root / 'sub{}'.format(i // FILES_PER_DIR % 10) / \
+            'd{}'.format(i // FILES_PER_DIR)
+        d.mkdir(parents=True, exist_ok=True)
+        # Mostly small modules, with some larger data files
+        size = 200000 if i % 100 == 0 else 2000
+        (d / 'mod{}.py'.format(i)).write_bytes(b'x' * size)
+
+
+def main():
+    n_files = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    methods = [('shutil.copytree', shutil.copytree),
+               ('fileops.copytree', lambda s, d: copytree(s, d, threads=threads))]
+    with tempfile.TemporaryDirectory() as td:
+        src = Path(td, 'src')
+        make_tree(src, n_files)
+        print('{} files, best of {} runs'.format(n_files, REPEAT))
+        best = {name: float('inf') for name, _ in methods}
+        # Take turns, and use a new destination each time, as in bench_ingest
+        for i in range(REPEAT):
+            for name, func in methods:
+                dest = Path(td, 'dest{}-{}'.format(i, name))
+                start = time.perf_counter()
+                func(str(src), str(dest))
+                best[name] = min(best[name], time.perf_counter() - start)
+        for name, _ in methods:
+            print('{:>20}: {:7.2f}s'.format(name, best[name]))
+
+
+if __name__ == '__main__':
+    main()
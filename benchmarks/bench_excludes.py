@@ -0,0 +1,96 @@
+"""Compare ways of checking paths against exclude patterns: fnmatch.filter for
+each pattern (as copytree ignore callbacks did), a list of compiled regexes
+tried in turn (as wheel extraction did), and nsist.excludes.ExcludeMatcher.
+The patterns include each kind the matcher indexes differently, including
+[...] classes, and the three methods are checked to exclude the same paths.
+
+Usage: python benchmarks/bench_excludes.py
+"""
+import fnmatch
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nsist.excludes import ExcludeMatcher  # noqa: E402
+
+N_PATTERNS = 200
+N_PATHS = 100000
+N_PACKAGES = 100
+
+
+def make_patterns(rng):
+    patterns = []
+    for i in range(N_PATTERNS):
+        pkg = 'pkg{}'.format(rng.randrange(N_PACKAGES))
+        kind = i % 5
+        if kind == 0:
+            patterns.append('pkgs/{}/tests'.format(pkg))
+        elif kind == 1:
+            patterns.append('pkgs/{}/sub{}/*.txt'.format(pkg, rng.randrange(10)))
+        elif kind == 2:
+            patterns.append('pkgs/*/examples{}'.format(i))
+        elif kind == 3:
+            patterns.append('pkgs/{}/data/file{}?.dat'.format(pkg, i))
+        else:
+            patterns.append('pkgs/{}/[ct]ore/*[0-9].py[cd]'.format(pkg))
+    return patterns
+
+
+def make_paths(rng):
+    names = ['tests', 'data', 'examples3', 'core'] + \
+            ['sub{}'.format(i) for i in range(10)]
+    exts = ['.py', '.txt', '.dat', '.pyd']
+    return ['pkgs/pkg{}/{}/{}/file{}{}'.format(
+                rng.randrange(N_PACKAGES), rng.choice(names), rng.choice(names),
+                i, rng.choice(exts))
+            for i in range(N_PATHS)]
+
+
+def with_fnmatch_filter(patterns, paths):
+    dir_patterns = [p + '/*' for p in patterns if not p.endswith('*')]
+    excluded = set()
+    for pattern in patterns + dir_patterns:
+        excluded.update(fnmatch.filter(paths, pattern))
+    return [p in excluded for p in paths]
+
+
+def with_regex_list(patterns, paths):
+    re_pats = set()
+    for pattern in patterns:
+        re_pats.add(fnmatch.translate(pattern))
+        if not pattern.endswith('*'):
+            re_pats.add(fnmatch.translate(pattern + '/*'))
+    regexen = [re.compile(p) for p in sorted(re_pats)]
+    return [any(r.match(p) for r in regexen) for p in paths]
+
+
+def with_matcher(patterns, paths):
+    matcher = ExcludeMatcher(patterns)
+    return [matcher(p) for p in paths]
+
+
+def main():
+    rng = random.Random(0)
+    patterns = make_patterns(rng)
+    paths = make_paths(rng)
+    print('{} patterns, {} paths'.format(len(patterns), len(paths)))
+    expected = None
+    for name, func in [('fnmatch.filter', with_fnmatch_filter),
+                       ('regex list', with_regex_list),
+                       ('ExcludeMatcher', with_matcher)]:
+        start = time.perf_counter()
+        result = func(patterns, paths)
+        elapsed = time.perf_counter() - start
+        if expected is None:
+            expected = result
+        assert result == expected, name
+        print('{:>16}: {:7.3f}s  ({} excluded)'.format(
+            name, elapsed, sum(result)))
+
+
+if __name__ == '__main__':
+    main()
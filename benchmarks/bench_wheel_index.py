@@ -0,0 +1,59 @@
+"""Compare looking up wheels in a large extra_wheel_sources directory with
+and without the SQLite wheel index.
+
+Usage: python benchmarks/bench_wheel_index.py
+"""
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nsist.wheels import WheelLocator, CompatibilityScorer  # noqa: E402
+from nsist.wheelindex import WheelIndex  # noqa: E402
+
+N_REQUIREMENTS = 100
+
+
+def make_wheelhouse(directory, n_wheels):
+    for i in range(n_wheels):
+        dist, version = 'pkg{}'.format(i // 5), '1.{}'.format(i % 5)
+        Path(directory, '{}-{}-py3-none-any.whl'.format(dist, version)).touch()
+
+
+def time_lookups(source, n_wheels, index):
+    scorer = CompatibilityScorer('3.8.0', 'win_amd64')
+    reqs = ['pkg{}==1.2'.format(i) for i in range(0, n_wheels // 5,
+                                                  max(1, n_wheels // 5 // N_REQUIREMENTS))]
+    start = time.perf_counter()
+    for req in reqs:
+        wl = WheelLocator(req, scorer, extra_sources=[source], index=index)
+        assert wl.check_extra_sources() is not None
+    return (time.perf_counter() - start) / len(reqs)
+
+
+def main():
+    print('{:>8}  {:>12}  {:>12}  {:>12}'.format(
+        'wheels', 'listdir', 'index (cold)', 'index (warm)'))
+    for n_wheels in (1000, 5000, 15000, 50000):
+        with tempfile.TemporaryDirectory() as td:
+            source = Path(td, 'wheelhouse')
+            source.mkdir()
+            make_wheelhouse(source, n_wheels)
+            # Let the directory mtime settle so the index can trust it.
+            os.utime(str(source), (time.time() - 60,) * 2)
+
+            t_listdir = time_lookups(source, n_wheels, None)
+            index = WheelIndex(Path(td, 'index.sqlite3'))
+            t_cold = time_lookups(source, n_wheels, index)
+            t_warm = time_lookups(source, n_wheels, index)
+            index.close()
+
+        print('{:>8}  {:>10.3f}ms  {:>10.3f}ms  {:>10.3f}ms'.format(
+            n_wheels, t_listdir * 1e3, t_cold * 1e3, t_warm * 1e3))
+
+
+if __name__ == '__main__':
+    main()
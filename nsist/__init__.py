@@ -1,5 +1,6 @@
 """Build NSIS installers for Python applications.
 """
+from functools import partial
 import io
 import logging
 import ntpath
@@ -10,7 +11,6 @@ import re
 import shutil
 from subprocess import call
 import sys
-import fnmatch
 import zipfile
 
 if os.name == 'nt':
@@ -18,12 +18,17 @@ if os.name == 'nt':
 else:
     winreg = None
 
+from .cache import record_access
 from .configreader import get_installer_builder_args
 from .commands import prepare_bin_directory
 from .copymodules import copy_modules
+from .excludes import ExcludeMatcher
+from .fileops import CopyEngine, STAGE_MODES, copytree, stage_function
+from .hashing import check_cached_file, hash_file
 from .nsiswriter import NSISFileWriter
-from .wheels import WheelGetter
-from .util import download, get_cache_dir, normalize_path
+from .pypi import OFFLINE_ENV_VAR
+from .wheels import ExtractedWheelCache, WheelGetter
+from .util import download, find_in_cache, get_cache_dir, normalize_path
 
 __version__ = '2.8'
 
@@ -69,6 +74,39 @@ def split_entry_point(ep: str):
     )
 
 
+def python_download_url_filename(py_version, bitness):
+    """Get the URL and filename of the embeddable build of a Python version"""
+    filename = 'python-{}-embed-{}.zip'.format(py_version,
+                               'amd64' if bitness==64 else 'win32')
+
+    version_minus_prerelease = re.sub(r'(a|b|rc)\d+$', '', py_version)
+    return 'https://www.python.org/ftp/python/{0}/{1}'.format(
+            version_minus_prerelease, filename), filename
+
+
+def get_python_embeddable(py_version, bitness, offline=False):
+    """Find the embeddable Python zip file in the cache, downloading if needed
+
+    Returns the path of the zip file. In offline mode, raises InputError if
+    it's not already in the cache.
+    """
+    url, filename = python_download_url_filename(py_version, bitness)
+    cache_file = find_in_cache(filename)
+    if cache_file is not None:
+        record_access(cache_file, hit=True)
+        return cache_file
+
+    cache_file = get_cache_dir(ensure_existence=True) / filename
+    if offline:
+        raise InputError('py_version', py_version,
+                         "a version already in the cache (offline mode)")
+    logger.info('Downloading embeddable Python build...')
+    logger.info('Getting %s', url)
+    download(url, cache_file)
+    record_access(cache_file, hit=False)
+    return cache_file
+
+
 class InstallerBuilder(object):
     """Controls building an installer. This includes three main steps:
 
@@ -89,6 +127,14 @@ class InstallerBuilder(object):
     :param list pypi_wheel_reqs: Package specifications to fetch from PyPI as wheels
     :param extra_wheel_sources: Directory paths to find wheels in.
     :type extra_wheel_sources: list of Path objects
+    :param list index_urls: Simple repository index URLs to find wheels on,
+            in priority order, instead of the PyPI JSON API
+    :param list find_links: URLs of HTML pages linking to wheel files,
+            searched before the indexes
+    :param bool resolve_dependencies: Also fetch the dependencies of
+            ``pypi_wheel_reqs``, which may then use version ranges
+    :param bool build_sdists: Build wheels from sdists for pure-Python
+            packages in ``pypi_wheel_reqs`` which don't publish wheels
     :param local_wheels: Glob paths matching wheel files to include
     :type local_wheels: list of str
     :param list extra_files: List of 2-tuples (file, destination) of files to include
@@ -102,6 +148,20 @@ class InstallerBuilder(object):
     :param str build_dir: Directory to run the build in
     :param str installer_name: Filename of the installer to produce
     :param str nsi_template: Path to a template NSI file to use
+    :param int jobs: Number of wheels to look up and download concurrently
+    :param bool offline: Only use cached downloads and PyPI metadata. The
+            default (None) checks the ``PYNSIST_OFFLINE`` environment variable.
+    :param str lockfile: Path of a lockfile written by ``pynsist lock``, to
+            fetch exactly the wheels recorded there
+    :param bool prune_modules: Remove modules in ``pkgs`` which can't be
+            reached by following imports from the entry points
+    :param list keep_modules: Module names or glob patterns to keep when
+            pruning, for modules imported dynamically
+    :param str prune_profile: Path of a profile written by ``pynsist trace``;
+            modules and data files in ``pkgs`` which it doesn't list are removed
+    :param str stage_mode: How to put files in the build directory: 'copy',
+            or 'hardlink', 'reflink' or 'symlink' to link them to the source
+            files where possible, or 'auto' to try reflinks and then hard links
     """
     def __init__(self, appname, version, shortcuts, *, publisher=None,
                 icon=DEFAULT_ICON, packages=None, extra_files=None,
@@ -109,7 +169,11 @@ class InstallerBuilder(object):
                 py_format='bundled', inc_msvcrt=True, build_dir=DEFAULT_BUILD_DIR,
                 installer_name=None, nsi_template=None,
                 exclude=None, pypi_wheel_reqs=None, extra_wheel_sources=None,
-                local_wheels=None, commands=None, license_file=None):
+                index_urls=None, find_links=None, resolve_dependencies=False,
+                build_sdists=False,
+                local_wheels=None, commands=None, license_file=None, jobs=1,
+                offline=None, lockfile=None, prune_modules=False,
+                keep_modules=None, prune_profile=None, stage_mode='copy'):
         self.appname = appname
         self.version = version
         self.publisher = publisher
@@ -120,9 +184,25 @@ class InstallerBuilder(object):
         self.extra_files = extra_files or []
         self.pypi_wheel_reqs = pypi_wheel_reqs or []
         self.extra_wheel_sources = extra_wheel_sources or []
+        self.index_urls = index_urls or []
+        self.find_links = find_links or []
+        self.resolve_dependencies = resolve_dependencies
+        self.build_sdists = build_sdists
         self.local_wheels = local_wheels or []
         self.commands = commands or {}
         self.license_file = license_file
+        self.jobs = jobs
+        if offline is None:
+            offline = bool(os.environ.get(OFFLINE_ENV_VAR))
+        self.offline = offline
+        self.lockfile = lockfile
+        self.prune_modules = prune_modules
+        self.keep_modules = keep_modules or []
+        self.prune_profile = prune_profile
+        if stage_mode not in STAGE_MODES:
+            raise InputError('stage_mode', stage_mode, ', '.join(STAGE_MODES))
+        self.stage_mode = stage_mode
+        self.stage_file = stage_function(stage_mode)
 
         # Python options
         self.py_version = py_version
@@ -163,6 +243,8 @@ class InstallerBuilder(object):
         self.install_files = []
         self.install_dirs = []
         self.msvcrt_files = []
+        # Files copied by copy_modules, with sizes and hashes
+        self.package_manifest = None
 
     _py_version_pattern = re.compile(r'\d\.\d+\.\d+$')
 
@@ -180,14 +262,7 @@ class InstallerBuilder(object):
         return s.replace(' ', '_')
 
     def _python_download_url_filename(self):
-        version = self.py_version
-        bitness = self.py_bitness
-        filename = 'python-{}-embed-{}.zip'.format(version,
-                                   'amd64' if bitness==64 else 'win32')
-
-        version_minus_prerelease = re.sub(r'(a|b|rc)\d+$', '', self.py_version)
-        return 'https://www.python.org/ftp/python/{0}/{1}'.format(
-                version_minus_prerelease, filename), filename
+        return python_download_url_filename(self.py_version, self.py_bitness)
 
     def fetch_python_embeddable(self):
         """Fetch the embeddable Windows build for the specified Python version
@@ -197,18 +272,19 @@ class InstallerBuilder(object):
         In addition, any ``*._pth`` files found therein will have the pkgs path
         appended to them.
         """
-        url, filename = self._python_download_url_filename()
-        cache_file = get_cache_dir(ensure_existence=True) / filename
-        if not cache_file.is_file():
-            logger.info('Downloading embeddable Python build...')
-            logger.info('Getting %s', url)
-            download(url, cache_file)
+        cache_file = get_python_embeddable(self.py_version, self.py_bitness,
+                                           offline=self.offline)
 
         logger.info('Unpacking Python...')
         python_dir = pjoin(self.build_dir, 'Python')
 
-        with zipfile.ZipFile(str(cache_file)) as z:
-            z.extractall(python_dir)
+        if self.stage_mode == 'copy':
+            with zipfile.ZipFile(str(cache_file)) as z:
+                z.extractall(python_dir)
+        else:
+            # Link to files extracted in the cache
+            copytree(str(self._extracted_python(cache_file)), python_dir,
+                     copy_function=self.stage_file)
 
         # Manipulate any *._pth files so the default paths AND pkgs directory
         # ends up in sys.path. Please see:
@@ -223,13 +299,39 @@ class InstallerBuilder(object):
 
         self.install_dirs.append(('Python', '$INSTDIR'))
 
+    @staticmethod
+    def _extracted_python(cache_file):
+        """Get a directory in the cache with the embeddable Python unpacked
+
+        Like extracted wheels, it's keyed by the sha256 hash of the zip file,
+        so a zip downloaded again with different contents isn't mixed up with
+        the old one.
+        """
+        cache = ExtractedWheelCache()
+        # Only write a hash record for the zip in our own cache, not in a
+        # read-only shared layer
+        local_dir = Path(os.path.abspath(str(get_cache_dir())))
+        local = local_dir in Path(os.path.abspath(str(cache_file))).parents
+        sha256 = check_cached_file(cache_file, writable=local)[1]
+        if sha256 is None:
+            sha256 = hash_file(cache_file)
+        tree = cache.cache_dir / 'python-{}'.format(sha256)
+        if tree.is_dir():
+            record_access(tree, hit=True)
+        else:
+            def extract(zip_file, target):
+                with zipfile.ZipFile(str(zip_file)) as z:
+                    z.extractall(str(target))
+            cache.add_tree(tree, extract, cache_file)
+        return tree
+
     def prepare_msvcrt(self):
         arch = 'x64' if self.py_bitness == 64 else 'x86'
         src = pjoin(_PKGDIR, 'msvcrt', arch)
         dst = pjoin(self.build_dir, 'msvcrt')
         self.msvcrt_files = sorted(os.listdir(src))
 
-        shutil.copytree(src, dst)
+        copytree(src, dst, copy_function=self.stage_file)
 
     SCRIPT_TEMPLATE = """#!python{qualifier}
 import sys, os
@@ -348,20 +450,78 @@ if __name__ == '__main__':
 
         # 1. Manually prepared packages
         if os.path.isdir('pynsist_pkgs'):
-            shutil.copytree('pynsist_pkgs', build_pkg_dir)
+            copytree('pynsist_pkgs', build_pkg_dir,
+                     copy_function=self.stage_file)
         else:
             os.mkdir(build_pkg_dir)
 
         # 2. Wheels specified in pypi_wheel_reqs or in paths of local_wheels
+        lock = None
+        if self.lockfile:
+            from .lockfile import read_lockfile
+            logger.info('Using wheels from lockfile %s', self.lockfile)
+            lock = read_lockfile(self.lockfile)
         wg = WheelGetter(self.pypi_wheel_reqs, self.local_wheels, build_pkg_dir,
                          py_version=self.py_version, bitness=self.py_bitness,
                          extra_sources=self.extra_wheel_sources,
-                         exclude=self.exclude)
+                         exclude=self.exclude, jobs=self.jobs,
+                         offline=self.offline, lock=lock,
+                         index_urls=self.index_urls, find_links=self.find_links,
+                         resolve=self.resolve_dependencies,
+                         build_sdists=self.build_sdists)
         wg.get_all()
 
         # 3. Copy importable modules
-        copy_modules(self.packages, build_pkg_dir,
-                     py_version=self.py_version, exclude=self.exclude)
+        self.package_manifest = copy_modules(
+            self.packages, build_pkg_dir, py_version=self.py_version,
+            exclude=self.exclude)
+
+    def prune_packages(self):
+        """Remove modules which the entry points never import
+
+        Scripts for shortcuts and preambles for commands are parsed to find
+        their imports. See :mod:`nsist.treeshake`.
+        """
+        from .treeshake import (entry_point_modules, prune_unused_modules,
+                                script_imports)
+        logger.info("Removing unused modules from packages...")
+        scripts = [pjoin(self.build_dir, sc['script'])
+                   for sc in self.shortcuts.values() if sc.get('script')]
+        scripts += [cmd['extra_preamble'] for cmd in self.commands.values()
+                    if cmd.get('extra_preamble')]
+        roots = entry_point_modules(cmd['entry_point']
+                                    for cmd in self.commands.values())
+        roots += script_imports(scripts)
+
+        build_pkg_dir = pjoin(self.build_dir, 'pkgs')
+        report = prune_unused_modules(build_pkg_dir, roots,
+                                      keep=self.keep_modules, jobs=self.jobs)
+        report.log()
+        self._forget_pruned(report)
+        return report
+
+    def prune_packages_to_profile(self):
+        """Remove modules and data files not used when tracing the app
+
+        See :mod:`nsist.tracing`.
+        """
+        from .tracing import prune_to_profile, read_profile
+        logger.info("Removing files not in trace profile %s...",
+                    self.prune_profile)
+        profile = read_profile(self.prune_profile)
+        report = prune_to_profile(pjoin(self.build_dir, 'pkgs'), profile)
+        report.log()
+        self._forget_pruned(report)
+        return report
+
+    def _forget_pruned(self, report):
+        """Remove pruned files from the package manifest"""
+        if self.package_manifest:
+            for relpath in report.removed:
+                prefix = 'pkgs/' + relpath
+                for key in [k for k in self.package_manifest
+                            if k == prefix or k.startswith(prefix + '/')]:
+                    del self.package_manifest[key]
 
     def prepare_commands(self):
         for cmd in self.commands.values():
@@ -372,23 +532,17 @@ if __name__ == '__main__':
         self.install_dirs.append((command_dir.name, '$INSTDIR'))
         self.extra_files.append((pjoin(_PKGDIR, '_system_path.py'), '$INSTDIR'))
 
-    def copytree_ignore_callback(self, directory, files):
-        """This is being called back by our shutil.copytree call to implement the
+    def copytree_ignore_callback(self, excluded, src, in_build_dir,
+                                 directory, files):
+        """This is being called back by our copytree call to implement the
         'exclude' feature.
-        """
-        ignored = set()
 
-        # Filter by file names relative to the build directory
-        directory = os.path.normpath(directory)
-        files = [os.path.join(directory, fname) for fname in files]
-
-        # Execute all patterns
-        for pattern in self.exclude:
-            ignored.update([
-                os.path.basename(fname)
-                for fname in fnmatch.filter(files, pattern)
-            ])
-        return ignored
+        Exclude patterns are relative to the build directory, so paths are
+        matched as they will be there. Excluded directories are not entered.
+        """
+        reldir = os.path.relpath(directory, src)
+        target = normalize_path(os.path.join(in_build_dir, reldir))
+        return {fname for fname in files if excluded(target + '/' + fname)}
 
     def copy_extra_files(self):
         """Copy a list of files into the build directory, and add them to
@@ -399,6 +553,12 @@ if __name__ == '__main__':
         # in the build directory should already be in place.
         Path(self.nsi_file).touch()
 
+        with CopyEngine() as engine:
+            self._copy_extra_files(engine)
+
+    def _copy_extra_files(self, engine):
+        # Files are copied in the background, so remember the names we've used
+        taken = set()
         for file, destination in self.extra_files:
             file = file.rstrip('/\\')
             in_build_dir = Path(self.build_dir, os.path.basename(file))
@@ -407,10 +567,11 @@ if __name__ == '__main__':
             # similar to the source filename, e.g. foo.1.txt, foo.2.txt, ...
             stem, suffix = in_build_dir.stem, in_build_dir.suffix
             n = 1
-            while in_build_dir.exists():
+            while in_build_dir.exists() or in_build_dir.name in taken:
                 name = '{}.{}{}'.format(stem, n, suffix)
                 in_build_dir = in_build_dir.with_name(name)
                 n += 1
+            taken.add(in_build_dir.name)
 
             if destination:
                 # Normalize destination paths to Windows-style
@@ -420,15 +581,19 @@ if __name__ == '__main__':
 
             if os.path.isdir(file):
                 if self.exclude:
-                    shutil.copytree(file, str(in_build_dir),
-                                    ignore=self.copytree_ignore_callback)
+                    ignore = partial(self.copytree_ignore_callback,
+                                     ExcludeMatcher(self.exclude), file,
+                                     in_build_dir.name)
+                    engine.copytree(file, str(in_build_dir), ignore=ignore,
+                                    copy_function=self.stage_file)
                 else:
                     # Don't use our exclude callback if we don't need to,
                     # as it slows things down.
-                    shutil.copytree(file, str(in_build_dir))
+                    engine.copytree(file, str(in_build_dir),
+                                    copy_function=self.stage_file)
                 self.install_dirs.append((in_build_dir.name, destination))
             else:
-                shutil.copy2(file, str(in_build_dir))
+                engine.copy(file, str(in_build_dir), self.stage_file)
                 self.install_files.append((in_build_dir.name, destination))
 
     def write_nsi(self):
@@ -486,6 +651,10 @@ if __name__ == '__main__':
 
         # Packages
         self.prepare_packages()
+        if self.prune_profile:
+            self.prune_packages_to_profile()
+        if self.prune_modules:
+            self.prune_packages()
 
         # Extra files
         self.copy_extra_files()
@@ -500,6 +669,38 @@ if __name__ == '__main__':
             return exitcode
         return 0
 
+def read_config_args(config_path):
+    """Read and validate a config file for one of the command line tools
+
+    This changes the working directory to the directory containing the config
+    file, so relative paths in it work. Returns the config filename (relative
+    to that directory) and a dict of arguments for :class:`InstallerBuilder`.
+    Exits with an error message if the config file is invalid.
+    """
+    dirname, config_file = os.path.split(config_path)
+    if dirname:
+        os.chdir(dirname)
+
+    from . import configreader
+    try:
+        cfg = configreader.read_and_validate(config_file)
+        args = get_installer_builder_args(cfg)
+    except configreader.InvalidConfig as e:
+        logger.error('Error parsing configuration file:')
+        logger.error(str(e))
+        sys.exit(1)
+
+    return config_file, args
+
+# Subcommands, e.g. 'pynsist lock installer.cfg', mapped to the module
+# containing their main() function.
+SUBCOMMANDS = {
+    'lock': 'nsist.lockfile',
+    'cache': 'nsist.cache',
+    'fetch': 'nsist.fetch',
+    'trace': 'nsist.tracing',
+}
+
 def main(argv=None):
     """Make an installer from the command line.
 
@@ -509,32 +710,54 @@ def main(argv=None):
     logger.setLevel(logging.INFO)
     logger.handlers = [logging.StreamHandler()]
 
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in SUBCOMMANDS:
+        import importlib
+        mod = importlib.import_module(SUBCOMMANDS[argv[0]])
+        return mod.main(argv[1:])
+
     import argparse
     argp = argparse.ArgumentParser(prog='pynsist')
     argp.add_argument('config_file')
     argp.add_argument('--no-makensis', action='store_true',
         help='Prepare files and folders, stop before calling makensis. For debugging.'
     )
+    argp.add_argument('-j', '--jobs', type=int, default=1,
+        help='Number of wheels to download concurrently (default 1).'
+    )
+    argp.add_argument('--offline', action='store_true', default=None,
+        help="Only use files and metadata already in the cache."
+    )
+    argp.add_argument('--no-lock', action='store_true',
+        help="Ignore the lockfile written by 'pynsist lock', if there is one."
+    )
+    argp.add_argument('--stage-mode', choices=STAGE_MODES, default='copy',
+        help="Link files into the build directory instead of copying them, "
+             "where possible. 'auto' tries reflinks, then hard links "
+             "(default: copy)."
+    )
     options = argp.parse_args(argv)
 
-    dirname, config_file = os.path.split(options.config_file)
-    if dirname:
-        os.chdir(dirname)
+    config_file, args = read_config_args(options.config_file)
 
-    from . import configreader
-    try:
-        cfg = configreader.read_and_validate(config_file)
-        args = get_installer_builder_args(cfg)
-    except configreader.InvalidConfig as e:
-        logger.error('Error parsing configuration file:')
-        logger.error(str(e))
-        sys.exit(1)
+    from .lockfile import lockfile_path, LockfileError
+    from .resolver import ResolutionError
+    lockfile = lockfile_path(config_file)
+    if options.no_lock or not os.path.isfile(lockfile):
+        lockfile = None
 
     try:
-        ec = InstallerBuilder(**args).run(makensis=(not options.no_makensis))
+        ec = InstallerBuilder(**args, jobs=options.jobs,
+                              offline=options.offline, lockfile=lockfile,
+                              stage_mode=options.stage_mode)\
+                .run(makensis=(not options.no_makensis))
     except InputError as e:
         logger.error("Error in config values:")
         logger.error(str(e))
         sys.exit(1)
+    except (LockfileError, ResolutionError) as e:
+        logger.error(str(e))
+        sys.exit(1)
 
     return ec
@@ -0,0 +1,382 @@
+"""Track use of the download cache, and remove files from it
+
+Builds record each time they use (a hit) or download (a miss) a cached file in
+an SQLite database in the cache directory. ``pynsist cache info`` reports on
+this, and ``pynsist cache prune`` removes the least recently used files.
+``pynsist cache verify`` re-hashes cached files to find any corrupted ones.
+
+Files in the cache which have never been recorded, e.g. those downloaded by
+older versions of Pynsist, are treated as last used at their modification time.
+"""
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .hashing import check_cached_file, remove_sidecar
+from .util import get_cache_dir
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS access (
+    path TEXT PRIMARY KEY,
+    last_access REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    misses INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+class CacheUsage(object):
+    """Access records for files in one cache directory
+
+    Paths are stored relative to the cache directory, with '/' separators.
+    """
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = get_cache_dir()
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            str(self.cache_dir / 'cache-usage.sqlite3'), timeout=30,
+            check_same_thread=False
+        )
+        # WAL mode lets builds record accesses without blocking each other
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def _relpath(self, path):
+        try:
+            rel = Path(os.path.abspath(str(path))).relative_to(
+                os.path.abspath(str(self.cache_dir)))
+        except ValueError:
+            return None  # Not in this cache, e.g. a shared cache layer
+        return rel.as_posix()
+
+    def record(self, path, hit):
+        """Record that a cached file was used (hit) or downloaded (not hit)"""
+        rel = self._relpath(path)
+        if rel is None:
+            return
+        hits, misses = (1, 0) if hit else (0, 1)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO access (path, last_access) VALUES (?, 0)",
+                (rel,)
+            )
+            self._conn.execute(
+                "UPDATE access SET last_access = ?, hits = hits + ?, "
+                "misses = misses + ? WHERE path = ?",
+                (time.time(), hits, misses, rel)
+            )
+
+    def get(self, relpath):
+        """Get (last_access, hits, misses) for one file, or None"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT last_access, hits, misses FROM access WHERE path = ?",
+                (relpath,)
+            ).fetchone()
+
+    def all(self):
+        """Get a dict of relative path -> (last_access, hits, misses)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, last_access, hits, misses FROM access"
+            ).fetchall()
+        return {r[0]: tuple(r[1:]) for r in rows}
+
+    def forget(self, relpaths):
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM access WHERE path = ?",
+                                   [(p,) for p in relpaths])
+
+
+_usage = {}  # cache dir -> CacheUsage
+_usage_lock = threading.Lock()
+
+def record_access(path, hit):
+    """Record a cache hit or miss for path in the local cache
+
+    Problems with the database are logged and otherwise ignored, so they
+    never stop a build.
+    """
+    cache_dir = get_cache_dir()
+    try:
+        with _usage_lock:
+            if cache_dir not in _usage:
+                _usage[cache_dir] = CacheUsage(cache_dir)
+            usage = _usage[cache_dir]
+        usage.record(path, hit)
+    except (sqlite3.Error, OSError) as e:
+        logger.debug('Could not record cache access for %s: %s', path, e)
+
+
+class Artifact(object):
+    """A file (or extracted wheel directory) in the cache"""
+    def __init__(self, relpath, kind, size, mtime):
+        self.relpath = relpath
+        self.kind = kind
+        self.size = size
+        self.mtime = mtime
+        self.last_access = mtime
+        self.hits = self.misses = 0
+
+    def __repr__(self):
+        return '<Artifact {}>'.format(self.relpath)
+
+
+def _tree_size(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for fn in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, fn)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def find_artifacts(cache_dir):
+    """List the artifacts in a cache directory
+
+    These are wheels and sdists (``pypi/<name>/<version>/*``), embeddable
+    Python zips, wheels built from sdists (``built-wheels/<key>/*.whl``) and
+    wheels extracted for reuse (``extracted/<key>``).
+    """
+    cache_dir = Path(cache_dir)
+    res = []
+    for p in cache_dir.glob('python-*-embed-*.zip'):
+        st = p.stat()
+        res.append(Artifact(p.name, 'python', st.st_size, st.st_mtime))
+    for pattern, kind in [('pypi/*/*/*.whl', 'wheel'),
+                          ('pypi/*/*/*.tar.gz', 'sdist'),
+                          ('pypi/*/*/*.zip', 'sdist'),
+                          ('built-wheels/*/*.whl', 'built')]:
+        for p in cache_dir.glob(pattern):
+            if p.parent.name.startswith('tmp-'):
+                continue  # A build in progress
+            st = p.stat()
+            res.append(Artifact(p.relative_to(cache_dir).as_posix(), kind,
+                                st.st_size, st.st_mtime))
+    extracted = cache_dir / 'extracted'
+    if extracted.is_dir():
+        for entry in os.scandir(str(extracted)):
+            if entry.is_dir() and not entry.name.startswith('tmp-'):
+                res.append(Artifact('extracted/' + entry.name, 'extracted',
+                                    _tree_size(entry.path),
+                                    entry.stat().st_mtime))
+    return res
+
+
+def load_artifacts(cache_dir, usage):
+    """List the artifacts in a cache, with their recorded usage"""
+    artifacts = find_artifacts(cache_dir)
+    records = usage.all()
+    for a in artifacts:
+        if a.relpath in records:
+            a.last_access, a.hits, a.misses = records[a.relpath]
+    return artifacts
+
+
+def select_for_pruning(artifacts, max_size=None, older_than=None, now=None):
+    """Choose artifacts to delete, least recently used first
+
+    Artifacts not used for older_than seconds are removed, and then more
+    until the total size is no more than max_size bytes.
+    """
+    if now is None:
+        now = time.time()
+    by_age = sorted(artifacts, key=lambda a: a.last_access)
+    selected = []
+    if older_than is not None:
+        selected = [a for a in by_age if now - a.last_access > older_than]
+
+    if max_size is not None:
+        remaining = [a for a in by_age if a not in selected]
+        total = sum(a.size for a in remaining)
+        for a in remaining:
+            if total <= max_size:
+                break
+            selected.append(a)
+            total -= a.size
+    return selected
+
+
+def remove_artifact(cache_dir, artifact):
+    path = Path(cache_dir, artifact.relpath)
+    if artifact.kind == 'extracted':
+        shutil.rmtree(str(path))
+        return
+
+    path.unlink()
+    remove_sidecar(path)
+    lock = path.with_name(path.name + '.lock')
+    if lock.exists():
+        lock.unlink()
+    if artifact.kind == 'built':
+        dirs = (path.parent,)
+    elif artifact.kind in ('wheel', 'sdist'):
+        # Remove pypi/<name>/<version> and pypi/<name> if they're now empty
+        dirs = (path.parent, path.parent.parent)
+    else:
+        dirs = ()
+    for d in dirs:
+        try:
+            d.rmdir()
+        except OSError:
+            break
+
+
+_size_re = re.compile(r'^(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?$', re.IGNORECASE)
+_SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+def parse_size(s):
+    """Parse a size like '500M' or '2G' into a number of bytes"""
+    m = _size_re.match(s.strip())
+    if not m:
+        raise ValueError("Invalid size: {!r}".format(s))
+    return int(float(m.group(1)) * _SIZE_UNITS[m.group(2).upper()])
+
+
+_age_re = re.compile(r'^(\d+(?:\.\d+)?)\s*([smhdw]?)$')
+_AGE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400, '': 86400}
+
+def parse_age(s):
+    """Parse an age like '30d' or '12h' into seconds; plain numbers are days"""
+    m = _age_re.match(s.strip().lower())
+    if not m:
+        raise ValueError("Invalid age: {!r}".format(s))
+    return float(m.group(1)) * _AGE_UNITS[m.group(2)]
+
+
+def format_size(n):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if n < 1024 or unit == 'GiB':
+            return ('{:.0f} {}' if unit == 'B' else '{:.1f} {}').format(n, unit)
+        n /= 1024
+
+
+def _format_time(t):
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(t))
+
+
+def print_info(cache_dir, artifacts, list_all=False):
+    print('Cache directory:', cache_dir)
+    total = sum(a.size for a in artifacts)
+    print('Total size: {} in {} items'.format(format_size(total), len(artifacts)))
+    for kind in ('python', 'wheel', 'sdist', 'built', 'extracted'):
+        of_kind = [a for a in artifacts if a.kind == kind]
+        print('  {:<10} {:>5} items {:>12}   hits: {}  misses: {}'.format(
+            kind, len(of_kind), format_size(sum(a.size for a in of_kind)),
+            sum(a.hits for a in of_kind), sum(a.misses for a in of_kind)))
+
+    if list_all:
+        print()
+        print('{:<16}  {:>10}  {:>5}  {}'.format('Last used', 'Size', 'Hits', 'Path'))
+        for a in sorted(artifacts, key=lambda a: a.last_access, reverse=True):
+            print('{:<16}  {:>10}  {:>5}  {}'.format(
+                _format_time(a.last_access), format_size(a.size), a.hits,
+                a.relpath))
+
+
+def verify_artifacts(cache_dir, artifacts, jobs=4):
+    """Re-hash cached files and compare them with their hash records
+
+    Returns a list of the artifacts which don't match. Files with no record
+    are hashed and a record written.
+    """
+    files = [a for a in artifacts if a.kind != 'extracted']
+
+    def check(a):
+        return check_cached_file(Path(cache_dir, a.relpath), full=True)[0]
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(check, files))
+    return [a for a, ok in zip(files, results) if not ok]
+
+
+def main(argv=None):
+    """Show information about the cache, or remove files from it"""
+    import argparse
+    argp = argparse.ArgumentParser(prog='pynsist cache')
+    subparsers = argp.add_subparsers(dest='action')
+    subparsers.required = True
+    info_p = subparsers.add_parser('info', help='Show the size and use of the cache')
+    info_p.add_argument('--list', action='store_true',
+        help='List every cached item with when it was last used.'
+    )
+    prune_p = subparsers.add_parser('prune',
+        help='Remove the least recently used items from the cache'
+    )
+    prune_p.add_argument('--max-size', type=parse_size,
+        help="Remove items until the cache is at most this size, e.g. '2G'."
+    )
+    prune_p.add_argument('--older-than', type=parse_age,
+        help="Remove items not used in this time, e.g. '30d' or '12h'."
+    )
+    prune_p.add_argument('--dry-run', action='store_true',
+        help="Show what would be removed without removing it."
+    )
+    verify_p = subparsers.add_parser('verify',
+        help='Check all cached downloads against their recorded hashes'
+    )
+    verify_p.add_argument('-j', '--jobs', type=int, default=4,
+        help='Number of files to hash in parallel (default 4).'
+    )
+    verify_p.add_argument('--delete', action='store_true',
+        help='Remove files which fail the check, so they are downloaded again.'
+    )
+    options = argp.parse_args(argv)
+
+    cache_dir = get_cache_dir()
+    if not cache_dir.is_dir():
+        print('No cache at', cache_dir)
+        return 0
+    usage = CacheUsage(cache_dir)
+    artifacts = load_artifacts(cache_dir, usage)
+
+    if options.action == 'info':
+        print_info(cache_dir, artifacts, list_all=options.list)
+        return 0
+
+    if options.action == 'verify':
+        corrupted = verify_artifacts(cache_dir, artifacts, jobs=options.jobs)
+        for a in corrupted:
+            logger.error('%s does not match its recorded hash%s', a.relpath,
+                         '; removing it' if options.delete else '')
+            if options.delete:
+                remove_artifact(cache_dir, a)
+        if options.delete:
+            usage.forget([a.relpath for a in corrupted])
+        logger.info('Checked %d files, %d corrupted',
+                    sum(a.kind != 'extracted' for a in artifacts), len(corrupted))
+        return 1 if corrupted else 0
+
+    if options.max_size is None and options.older_than is None:
+        argp.error('prune needs --max-size and/or --older-than')
+    selected = select_for_pruning(artifacts, options.max_size,
+                                  options.older_than)
+    for a in selected:
+        logger.info('%s %s (%s, last used %s)',
+                    'Would remove' if options.dry_run else 'Removing',
+                    a.relpath, format_size(a.size), _format_time(a.last_access))
+        if not options.dry_run:
+            remove_artifact(cache_dir, a)
+    if not options.dry_run:
+        usage.forget([a.relpath for a in selected])
+    logger.info('%s %d items, %s', 'Would free' if options.dry_run else 'Freed',
+                len(selected), format_size(sum(a.size for a in selected)))
+    return 0
@@ -74,9 +74,16 @@ CONFIG_VALIDATORS = {
         ('packages', False),
         ('pypi_wheels', False),
         ('extra_wheel_sources', False),
+        ('index_urls', False),
+        ('find_links', False),
+        ('resolve_dependencies', False),
+        ('build_sdists', False),
         ('files', False),
         ('exclude', False),
-        ('local_wheels', False)
+        ('local_wheels', False),
+        ('prune_modules', False),
+        ('keep_modules', False),
+        ('prune_profile', False),
     ]),
     'Python': SectionValidator([
         ('version', False),
@@ -230,6 +237,10 @@ def get_installer_builder_args(config):
     args['extra_wheel_sources'] = [Path(p) for p in
         config.get('Include', 'extra_wheel_sources', fallback='').strip().splitlines()
     ]
+    args['index_urls'] = config.get('Include', 'index_urls', fallback='').strip().splitlines()
+    args['find_links'] = config.get('Include', 'find_links', fallback='').strip().splitlines()
+    args['resolve_dependencies'] = config.getboolean('Include', 'resolve_dependencies', fallback=False)
+    args['build_sdists'] = config.getboolean('Include', 'build_sdists', fallback=False)
     args['extra_files'] = read_extra_files(config)
     args['py_version'] = config.get('Python', 'version', fallback=DEFAULT_PY_VERSION)
     args['py_bitness'] = config.getint('Python', 'bitness', fallback=DEFAULT_BITNESS)
@@ -239,4 +250,7 @@ def get_installer_builder_args(config):
     args['nsi_template'] = config.get('Build', 'nsi_template', fallback=None)
     args['exclude'] = config.get('Include', 'exclude', fallback='').strip().splitlines()
     args['local_wheels'] = config.get('Include', 'local_wheels', fallback='').strip().splitlines()
+    args['prune_modules'] = config.getboolean('Include', 'prune_modules', fallback=False)
+    args['keep_modules'] = config.get('Include', 'keep_modules', fallback='').strip().splitlines()
+    args['prune_profile'] = config.get('Include', 'prune_profile', fallback=None)
     return args
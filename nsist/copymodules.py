@@ -1,15 +1,19 @@
+import bisect
+import hashlib
 import importlib
 import importlib.abc
 import importlib.machinery
+import importlib.util
 import os
+import posixpath
 import shutil
 import sys
-import tempfile
 import zipfile, zipimport
-import fnmatch
+from collections import namedtuple
 from functools import partial
 
-from .util import normalize_path
+from .excludes import ExcludeMatcher
+from .fileops import CopyEngine
 
 pjoin = os.path.join
 
@@ -38,56 +42,325 @@ def check_ext_mod(path, target_python):
         # to a stable ABI. Can we detect this?
         raise ExtensionModuleMismatch(extensionmod_errmsg % ('Python '+target_python, path))
 
-def check_package_for_ext_mods(path, target_python):
-    """Walk the directory path, calling :func:`check_ext_mod` on each file.
+COPY_CHUNK = 1 << 20
+
+#: A file copied into the build directory, in a :class:`Manifest`
+ManifestEntry = namedtuple('ManifestEntry', ['size', 'sha256', 'source'])
+
+class Manifest(dict):
+    """Files copied into the build directory, with their sizes and hashes
+
+    Keys are paths relative to the build directory with '/' separators, like
+    'pkgs/foo/__init__.py'. Values are :class:`ManifestEntry` tuples. Later
+    stages can use this to avoid reading or hashing the files again.
+    """
+    def total_size(self):
+        return sum(e.size for e in self.values())
+
+def _copy_stream(fsrc, dest):
+    """Copy an open file to dest, returning (size, sha256)"""
+    h = hashlib.sha256()
+    size = 0
+    with open(dest, 'wb') as fdst:
+        for chunk in iter(lambda: fsrc.read(COPY_CHUNK), b''):
+            h.update(chunk)
+            fdst.write(chunk)
+            size += len(chunk)
+    return size, h.hexdigest()
+
+def copy_file(src, dest, relpath, manifest=None):
+    """Copy one file like shutil.copy2, and record it in manifest
+
+    The file is hashed as it is copied, so it's only read once.
+    """
+    with open(src, 'rb') as fsrc:
+        size, sha256 = _copy_stream(fsrc, dest)
+    shutil.copystat(src, dest)
+    if manifest is not None:
+        manifest[relpath] = ManifestEntry(size, sha256, src)
+
+def ingest_package(pkgdir, dest, modname, target_python, exclude=None,
+                   manifest=None, engine=None):
+    """Copy a package directory to dest in one pass over the tree
+
+    Each directory is listed once with os.scandir. Entries matching the
+    exclude patterns (which are matched against paths like
+    'pkgs/modname/sub/file.py') and .pyc files are skipped, without looking
+    inside excluded directories. Extension modules are checked with
+    :func:`check_ext_mod`, and other files are copied and recorded in
+    manifest.
+
+    If engine (a :class:`nsist.fileops.CopyEngine`) is given, files are queued
+    to copy on it, and may not be copied until its wait() method returns.
+    """
+    if engine is None:
+        with CopyEngine() as engine:
+            return ingest_package(pkgdir, dest, modname, target_python,
+                                  exclude, manifest, engine)
+
+    is_excluded = ExcludeMatcher(list(exclude or []) + ['*.pyc'])
+    os.mkdir(dest)
+    stack = [(pkgdir, dest, 'pkgs/' + modname)]
+    while stack:
+        src_dir, dst_dir, reldir = stack.pop()
+        with os.scandir(src_dir) as it:
+            entries = list(it)
+        for entry in entries:
+            relpath = reldir + '/' + entry.name
+            if is_excluded(relpath):
+                continue
+            dst_path = pjoin(dst_dir, entry.name)
+            if entry.is_dir():
+                os.mkdir(dst_path)
+                stack.append((entry.path, dst_path, relpath))
+            else:
+                check_ext_mod(entry.path, target_python)
+                engine.copy(entry.path, dst_path, partial(
+                    copy_file, relpath=relpath, manifest=manifest))
+        engine.copystat_later(src_dir, dst_dir)
+
+class ZipArchive:
+    """An open zip file, with its member names sorted to find them by prefix
     """
-    for dirpath, dirnames, filenames in os.walk(path):
-        for filename in filenames:
-            check_ext_mod(os.path.join(path, dirpath, filename), target_python)
+    def __init__(self, path):
+        self.zf = zipfile.ZipFile(path)
+        infos = sorted(self.zf.infolist(), key=lambda zi: zi.filename)
+        self.infos = infos
+        self.names = [zi.filename for zi in infos]
+
+    def close(self):
+        self.zf.close()
+
+    def members_under(self, prefix):
+        """List ZipInfo objects for members whose names start with prefix"""
+        start = bisect.bisect_left(self.names, prefix)
+        end = bisect.bisect_left(self.names, prefix + '\U0010ffff', lo=start)
+        return self.infos[start:end]
+
+    def extract_member(self, zinfo, dest, relpath, manifest=None):
+        """Write one member to dest, which may be a file or directory name
+
+        Files are recorded in manifest under relpath.
+        """
+        if zinfo.is_dir():
+            os.makedirs(dest, exist_ok=True)
+            return
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with self.zf.open(zinfo) as fsrc:
+            size, sha256 = _copy_stream(fsrc, dest)
+        if manifest is not None:
+            source = self.zf.filename + '/' + zinfo.filename
+            manifest[relpath] = ManifestEntry(size, sha256, source)
 
-def copy_zipmodule(loader, modname, target):
-    """Copy a module or package out of a zip file to the target directory."""
+class ZipArchives:
+    """Zip files opened while copying modules, each opened only once"""
+    def __init__(self):
+        self._open = {}
+
+    def get(self, path):
+        try:
+            return self._open[path]
+        except KeyError:
+            archive = self._open[path] = ZipArchive(path)
+            return archive
+
+    def close(self):
+        for archive in self._open.values():
+            archive.close()
+        self._open.clear()
+
+def copy_zipmodule(loader, modname, target, archive=None, manifest=None):
+    """Copy a module or package out of a zip file to the target directory.
+
+    archive may be a :class:`ZipArchive` for the zip file, to reuse it.
+    Copied files are recorded in manifest, if given.
+    """
     file = loader.get_filename(modname)
     assert file.startswith(loader.archive)
-    path_in_zip = file[len(loader.archive+'/'):]
-    zf = zipfile.ZipFile(loader.archive)
+    path_in_zip = file[len(loader.archive+'/'):].replace(os.sep, '/')
+    if archive is None:
+        archive = ZipArchive(loader.archive)
+        try:
+            return copy_zipmodule(loader, modname, target, archive, manifest)
+        finally:
+            archive.close()
 
-    # If the packages are in a subdirectory, extracting them recreates the
-    # directory structure from the zip file. So extract to a temp dir first,
-    # and then copy the modules to target.
-    tempdir = tempfile.mkdtemp()
     if loader.is_package(modname):
-        # Extract everything in a folder
-        pkgdir, basename = os.path.split(path_in_zip)
+        # Copy everything in the package folder
+        pkgdir, basename = posixpath.split(path_in_zip)
         assert basename.startswith('__init__')
-        pkgfiles = [f for f in zf.namelist() if f.startswith(pkgdir)]
-        zf.extractall(tempdir, pkgfiles)
-        shutil.copytree(pjoin(tempdir, pkgdir), pjoin(target, modname))
+        dest = pjoin(target, modname)
+        os.makedirs(dest)
+        for zinfo in archive.members_under(pkgdir + '/'):
+            # Drop path components which could point outside the target
+            parts = [p for p in zinfo.filename[len(pkgdir) + 1:].split('/')
+                     if p not in {'', '.', '..'}]
+            if parts:
+                archive.extract_member(zinfo, pjoin(dest, *parts),
+                                       '/'.join(['pkgs', modname] + parts),
+                                       manifest)
     else:
-        # Extract a single file
-        zf.extract(path_in_zip, tempdir)
-        shutil.copy2(pjoin(tempdir, path_in_zip), target)
+        # Copy a single file
+        basename = posixpath.basename(path_in_zip)
+        archive.extract_member(archive.zf.getinfo(path_in_zip),
+                               pjoin(target, basename), 'pkgs/' + basename,
+                               manifest)
 
-    shutil.rmtree(tempdir)
+def _get_finder(entry):
+    """Get the path entry finder for one sys.path entry, or None"""
+    try:
+        return sys.path_importer_cache[entry]
+    except KeyError:
+        pass
+    for hook in sys.path_hooks:
+        try:
+            return hook(entry or os.getcwd())
+        except ImportError:
+            continue
+    return None
 
-def copytree_ignore_callback(excludes, pkgdir, modname, directory, files):
-    """This is being called back by our shutil.copytree call to implement the
-    'exclude' feature.
+def _finder_find_spec(finder, modname):
+    """Ask a path entry finder for a module's spec
+
+    Finders without find_spec, like zipimporter before Python 3.10, are used
+    through find_loader, as importlib's PathFinder does.
     """
-    ignored = set()
+    if hasattr(finder, 'find_spec'):
+        return finder.find_spec(modname)
+    loader, portions = finder.find_loader(modname)
+    if loader is not None:
+        return importlib.util.spec_from_loader(modname, loader)
+    if portions:
+        spec = importlib.machinery.ModuleSpec(modname, None)
+        spec.submodule_search_locations = portions
+        return spec
+    return None
+
+def _module_name(filename, suffixes):
+    """Get the module name for a file, or None if it's not a module"""
+    for suffix in suffixes:
+        if filename.endswith(suffix):
+            name = filename[:-len(suffix)]
+            return name if (name and '.' not in name) else None
+    return None
+
+class ModuleResolver:
+    """Find top-level modules on a path, listing each path entry only once
+
+    importlib's PathFinder asks every entry's finder about every module, which
+    is slow with a long path. This lists the top-level names in each directory
+    and zip file once, and asks only the finders for entries which have a
+    matching name. Finders are created once and reused, so they also keep
+    their own caches of directory and zip file contents.
+    """
+    def __init__(self, path, zips=None):
+        self.path = list(path)
+        self.zips = zips if (zips is not None) else ZipArchives()
+        self._finders = [_get_finder(entry) for entry in self.path]
+        self._index = None  # Top-level name -> list of finders
+        self._unindexed = []  # Finders we can't list the contents of
+
+    def _list_entry(self, entry, finder):
+        """List the top-level names a path entry may provide, or None"""
+        suffixes = importlib.machinery.all_suffixes()
+        if isinstance(finder, importlib.machinery.FileFinder):
+            names = set()
+            try:
+                it = os.scandir(finder.path or os.getcwd())
+            except OSError:
+                return names
+            with it:
+                for dir_entry in it:
+                    if dir_entry.is_dir():
+                        names.add(dir_entry.name)
+                    else:
+                        name = _module_name(dir_entry.name, suffixes)
+                        if name is not None:
+                            names.add(name)
+            return names
+
+        if isinstance(finder, zipimport.zipimporter):
+            names = set()
+            prefix = finder.prefix.replace(os.sep, '/')
+            archive = self.zips.get(finder.archive)
+            for zinfo in archive.members_under(prefix):
+                relpath = zinfo.filename[len(prefix):]
+                first, slash, _ = relpath.partition('/')
+                if slash:
+                    names.add(first)
+                else:
+                    name = _module_name(first, suffixes)
+                    if name is not None:
+                        names.add(name)
+            return names
+
+        return None
+
+    def _build_index(self):
+        self._index = {}
+        for entry, finder in zip(self.path, self._finders):
+            if finder is None:
+                continue
+            names = self._list_entry(entry, finder)
+            if names is None:
+                self._unindexed.append(finder)
+                continue
+            for name in names:
+                self._index.setdefault(name, []).append(finder)
+
+    def find_spec(self, modname):
+        """Find a top-level module, like PathFinder.find_spec
+
+        Returns a ModuleSpec, or None if the module is not found. A namespace
+        package has a spec with loader None.
+        """
+        if self._index is None:
+            self._build_index()
+        candidates = self._index.get(modname, [])
+        if self._unindexed:
+            # Keep the path order when some entries couldn't be listed
+            wanted = set(map(id, candidates + self._unindexed))
+            candidates = [f for f in self._finders if id(f) in wanted]
 
-    # Filter by file names relative to the build directory
-    reldir = os.path.relpath(directory, pkgdir)
-    target = os.path.join('pkgs', modname, reldir)
-    files = [normalize_path(os.path.join(target, fname)) for fname in files]
-    # Execute all patterns
-    for pattern in excludes + ['*.pyc']:
-        ignored.update([
-            os.path.basename(fname)
-            for fname in fnmatch.filter(files, pattern)
-        ])
+        namespace_path = []
+        for finder in candidates:
+            spec = _finder_find_spec(finder, modname)
+            if spec is None:
+                continue
+            if spec.loader is not None:
+                return spec
+            namespace_path.extend(spec.submodule_search_locations or [])
 
-    return ignored
+        if namespace_path:
+            spec = importlib.machinery.ModuleSpec(modname, None)
+            spec.submodule_search_locations = namespace_path
+            return spec
+        return None
+
+    def find_specs(self, modnames):
+        """Find several top-level modules, returning a dict of specs
+
+        Raises ImportError listing every module which can't be bundled.
+        """
+        specs, missing, namespace = {}, [], []
+        for modname in modnames:
+            spec = self.find_spec(modname)
+            if spec is None:
+                missing.append(modname)
+            elif spec.loader is None:
+                namespace.append(modname)
+            else:
+                specs[modname] = spec
+
+        problems = []
+        if missing:
+            problems.append('Could not find %s' % ', '.join(map(repr, missing)))
+        if namespace:
+            problems.append('Cannot bundle namespace package %s'
+                            % ', '.join(map(repr, namespace)))
+        if problems:
+            raise ImportError('\n'.join(problems))
+        return specs
 
 
 class ModuleCopier:
@@ -99,8 +372,23 @@ class ModuleCopier:
     def __init__(self, py_version, path=None):
         self.py_version = py_version
         self.path = path if (path is not None) else ([''] + sys.path)
+        # Records every file copied
+        self.manifest = Manifest()
+        # Zip files are kept open to copy several modules from them
+        self.zips = ZipArchives()
+        self.resolver = ModuleResolver(self.path, self.zips)
+        # Files (except from zip files) are copied on a pool of threads
+        self.engine = CopyEngine()
+
+    def wait(self):
+        """Wait for the queued files to be copied"""
+        self.engine.wait()
 
-    def copy(self, modname, target, exclude):
+    def close(self):
+        self.zips.close()
+        self.engine.close()
+
+    def copy(self, modname, target, exclude, spec=None):
         """Copy the importable module 'modname' to the directory 'target'.
 
         modname should be a top-level import, i.e. without any dots.
@@ -108,45 +396,39 @@ class ModuleCopier:
 
         This can currently copy regular filesystem files and directories,
         and extract modules and packages from appropriately structured zip
-        files.
+        files. spec may be passed if the module has already been found.
+        Files may still be copying in the background until :meth:`wait` is
+        called.
         """
-        spec = importlib.machinery.PathFinder.find_spec(modname, self.path)
         if spec is None:
-            raise ImportError('Could not find %r' % modname)
+            spec = self.resolver.find_specs([modname])[modname]
         loader = spec.loader
-        if loader is None:
-            raise ImportError('Cannot bundle namespace package %r' % modname)
 
         pkg = loader.is_package(modname)
 
         if isinstance(loader, importlib.machinery.ExtensionFileLoader):
             check_ext_mod(loader.path, self.py_version)
-            shutil.copy2(loader.path, target)
+            self._copy_file(loader.path, target)
 
         elif isinstance(loader, importlib.abc.FileLoader):
             file = loader.get_filename(modname)
             if pkg:
                 pkgdir, basename = os.path.split(file)
                 assert basename.startswith('__init__')
-                check_package_for_ext_mods(pkgdir, self.py_version)
-                dest = os.path.join(target, modname)
-                if exclude:
-                    shutil.copytree(
-                        pkgdir, dest,
-                        ignore=partial(copytree_ignore_callback, exclude, pkgdir, modname)
-                    )
-                else:
-                    # Don't use our exclude callback if we don't need to,
-                    # as it slows things down.
-                    shutil.copytree(
-                        pkgdir, dest,
-                        ignore=shutil.ignore_patterns('*.pyc')
-                    )
+                ingest_package(pkgdir, os.path.join(target, modname), modname,
+                               self.py_version, exclude, self.manifest,
+                               self.engine)
             else:
-                shutil.copy2(file, target)
+                self._copy_file(file, target)
 
         elif isinstance(loader, zipimport.zipimporter):
-            copy_zipmodule(loader, modname, target)
+            copy_zipmodule(loader, modname, target,
+                           self.zips.get(loader.archive), self.manifest)
+
+    def _copy_file(self, path, target):
+        basename = os.path.basename(path)
+        self.engine.copy(path, pjoin(target, basename), partial(
+            copy_file, relpath='pkgs/' + basename, manifest=self.manifest))
 
 
 def copy_modules(modnames, target, py_version, path=None, exclude=None):
@@ -154,17 +436,26 @@ def copy_modules(modnames, target, py_version, path=None, exclude=None):
 
     By default, it finds modules in :data:`sys.path` - this can be overridden
     by passing the path parameter.
+
+    Returns a :class:`Manifest` of the files copied.
     """
     mc = ModuleCopier(py_version, path)
     files_in_target_noext = [os.path.splitext(f)[0] for f in os.listdir(target)]
 
-    for modname in modnames:
-        if modname in files_in_target_noext:
-            # Already there, no need to copy it.
-            continue
-        mc.copy(modname, target, exclude)
+    # Already there, no need to copy them.
+    to_copy = [m for m in modnames if m not in files_in_target_noext]
+    try:
+        # Find them all first, to report all the missing modules at once
+        specs = mc.resolver.find_specs(to_copy)
+        for modname in to_copy:
+            mc.copy(modname, target, exclude, spec=specs[modname])
+        mc.wait()
+    finally:
+        mc.close()
 
     if not modnames:
         # NSIS abhors an empty folder, so give it a file to find.
         with open(os.path.join(target, 'placeholder'), 'w') as f:
             f.write('This file only exists so NSIS finds something in this directory.')
+
+    return mc.manifest
@@ -0,0 +1,120 @@
+"""Match paths against the exclude patterns from the config file
+
+Patterns are relative to the build directory, like ``pkgs/foo/tests``, and
+use shell-style wildcards. A pattern also matches everything below a
+directory it matches, so directories can be skipped without looking inside
+them. On Windows, matching is case-insensitive, as with :mod:`fnmatch`.
+"""
+import fnmatch
+import os
+import re
+
+
+def _normcase(path):
+    return os.path.normcase(path).replace('\\', '/')
+
+
+def _literal_tail_start(pattern):
+    """Find where the literal text after the last wildcard begins
+
+    Returns -1 if the pattern has no wildcards. A ``[`` with no closing ``]``
+    is a literal character, as in :func:`fnmatch.translate`.
+    """
+    start = -1
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c in '*?':
+            start = i
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] == '!':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            j = pattern.find(']', j)
+            if j >= 0:
+                i = start = j + 1
+    return start
+
+
+def _compile(patterns):
+    return re.compile('|'.join(sorted(fnmatch.translate(p) for p in patterns)))
+
+
+class ExcludeMatcher:
+    """Check paths against a list of exclude patterns
+
+    A path is excluded if a pattern matches it or one of its parent
+    directories. Rather than trying every pattern on each of these, patterns
+    are indexed by what they require of the last path component:
+
+    - Patterns without wildcards are kept in a set.
+    - Patterns like ``pkgs/*/tests`` need the last component to be ``tests``.
+    - Patterns like ``pkgs/foo/*.txt`` need it to end with ``.txt``.
+
+    Patterns sharing a key are compiled into one regex, which is only tried
+    when the key matches. Patterns ending in a wildcard are compiled into a
+    fallback regex which is tried for every path.
+    """
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self._literals = set()
+        by_name, by_suffix = {}, {}
+        ends_with_star, other = [], []
+        for pattern in self.patterns:
+            pattern = _normcase(pattern).rstrip('/')
+            tail_start = _literal_tail_start(pattern)
+            if tail_start < 0:
+                self._literals.add(pattern)
+                continue
+
+            tail = pattern[tail_start:]
+            if '/' in tail:
+                by_name.setdefault(tail.rsplit('/', 1)[1], []).append(pattern)
+            elif tail:
+                by_suffix.setdefault(tail, []).append(pattern)
+            elif pattern.endswith('*'):
+                # If this matches a directory, it also matches anything in it
+                ends_with_star.append(pattern)
+            else:
+                other.append(pattern)
+
+        self._by_name = {k: _compile(v) for k, v in by_name.items()}
+        self._by_suffix = {k: _compile(v) for k, v in by_suffix.items()}
+        self._suffix_lengths = sorted({len(k) for k in by_suffix})
+        self._ends_with_star = _compile(ends_with_star) if ends_with_star else None
+        self._other = _compile(other) if other else None
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def _match(self, path):
+        """Check if any pattern matches exactly this path"""
+        if path in self._literals:
+            return True
+        name = path[path.rfind('/') + 1:]
+        regex = self._by_name.get(name)
+        if regex is not None and regex.match(path):
+            return True
+        for n in self._suffix_lengths:
+            regex = self._by_suffix.get(name[-n:])
+            if regex is not None and regex.match(path):
+                return True
+        return self._other is not None and self._other.match(path) is not None
+
+    def __call__(self, path):
+        """Return True if path, or a directory containing it, is excluded
+
+        path is relative to the build directory, with either kind of slash.
+        """
+        path = _normcase(path).rstrip('/')
+        if self._ends_with_star is not None and self._ends_with_star.match(path):
+            return True
+        end = len(path)
+        while end > 0:
+            if self._match(path[:end]):
+                return True
+            end = path.rfind('/', 0, end)
+        return False
@@ -0,0 +1,110 @@
+"""Download everything some installers need into the cache, without building
+
+``pynsist fetch installer.cfg other.cfg ...`` reads each config file and
+downloads the embeddable Python builds and the ``pypi_wheels`` they use,
+several at a time. Builds from those configs can then run with ``--offline``.
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .wheels import NoWheelError, WheelGetter
+
+logger = logging.getLogger(__name__)
+
+
+def read_fetch_targets(config_path, use_lock=True):
+    """Read one config file, returning (python builds, wheel locators)
+
+    Python builds are (version, bitness) tuples. Wheel locators have a fetch()
+    method, and don't depend on the working directory.
+    """
+    from . import read_config_args
+    from .lockfile import lockfile_path, read_lockfile
+    cwd = os.getcwd()
+    try:
+        config_file, args = read_config_args(os.path.abspath(config_path))
+        lock = None
+        lockfile = lockfile_path(config_file)
+        if use_lock and os.path.isfile(lockfile):
+            lock = read_lockfile(lockfile)
+            for w in lock['wheels']:
+                if w.get('path'):
+                    w['path'] = os.path.abspath(w['path'])
+
+        # Relative paths in the config are from its directory
+        extra_sources = [Path(os.path.abspath(str(p)))
+                         for p in args['extra_wheel_sources']]
+        wg = WheelGetter(args['pypi_wheel_reqs'], [], None,
+                         py_version=args['py_version'],
+                         bitness=args['py_bitness'],
+                         extra_sources=extra_sources, lock=lock,
+                         index_urls=args['index_urls'],
+                         find_links=args['find_links'],
+                         resolve=args['resolve_dependencies'],
+                         build_sdists=args['build_sdists'])
+        locators = wg.requirement_locators()
+    finally:
+        os.chdir(cwd)
+
+    return [(args['py_version'], args['py_bitness'])], locators
+
+
+def fetch_all(pythons, locators, jobs=8):
+    """Download Python builds and wheels concurrently
+
+    Returns a list of (description, exception) for any which failed.
+    """
+    from . import get_python_embeddable
+    tasks = []
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for version, bitness in pythons:
+            tasks.append(('Python {} ({}-bit)'.format(version, bitness),
+                          pool.submit(get_python_embeddable, version, bitness)))
+        for wl in locators:
+            tasks.append(('{}=={}'.format(wl.name, wl.version),
+                          pool.submit(wl.fetch)))
+
+    failed = []
+    for description, future in tasks:
+        try:
+            future.result()
+        except Exception as e:
+            failed.append((description, e))
+    return failed
+
+
+def main(argv=None):
+    """Prefetch the Python builds and wheels for config files"""
+    import argparse
+    argp = argparse.ArgumentParser(prog='pynsist fetch')
+    argp.add_argument('config_files', nargs='+')
+    argp.add_argument('-j', '--jobs', type=int, default=8,
+        help='Number of files to download concurrently (default 8).'
+    )
+    argp.add_argument('--no-lock', action='store_true',
+        help="Ignore lockfiles written by 'pynsist lock'."
+    )
+    options = argp.parse_args(argv)
+
+    from .lockfile import LockfileError
+    from .resolver import ResolutionError
+    pythons = []
+    locators = []
+    for config_path in options.config_files:
+        try:
+            cfg_pythons, cfg_locators = read_fetch_targets(
+                config_path, use_lock=not options.no_lock)
+        except (LockfileError, ResolutionError, NoWheelError) as e:
+            logger.error('%s: %s', config_path, e)
+            return 1
+        pythons.extend(p for p in cfg_pythons if p not in pythons)
+        locators.extend(cfg_locators)
+
+    logger.info('Fetching %d Python builds and %d wheels',
+                len(pythons), len(locators))
+    failed = fetch_all(pythons, locators, jobs=options.jobs)
+    for description, e in failed:
+        logger.error('Failed to fetch %s: %s', description, e)
+    return 1 if failed else 0
@@ -0,0 +1,280 @@
+"""Put files in the build directory quickly
+
+Files are copied with :func:`os.copy_file_range` or :func:`os.sendfile` where
+the platform has them, so the data doesn't pass through Python, and on a pool
+of threads by :class:`CopyEngine`, so many small files can be copied at once.
+Where possible, files can also share storage with their source.
+"""
+import errno
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+if sys.platform.startswith('linux'):
+    import fcntl
+    # From linux/fs.h: _IOW(0x94, 9, int)
+    _FICLONE = 0x40049409
+else:
+    fcntl = None
+
+COPY_CHUNK = 1 << 20
+# Copying is mostly waiting for I/O, so use more threads than CPUs
+DEFAULT_COPY_THREADS = min(32, (os.cpu_count() or 1) + 4)
+# Errors meaning a fast copy function can't be used for these files
+_FAST_COPY_UNSUPPORTED = {errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                          errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF,
+                          errno.ETXTBSY, errno.EPERM}
+if hasattr(os, 'copy_file_range'):
+    _fast_copy_functions = [os.copy_file_range]
+else:
+    _fast_copy_functions = []
+if sys.platform.startswith('linux'):
+    # Elsewhere, sendfile may only write to sockets
+    _fast_copy_functions.append(os.sendfile)
+
+
+def _fast_copy(fsrc, fdst, size):
+    """Copy size bytes between open files in the kernel
+
+    Returns False if no fast copy function works for these files, before
+    anything is written.
+    """
+    infd, outfd = fsrc.fileno(), fdst.fileno()
+    for func in list(_fast_copy_functions):
+        copied = 0
+        try:
+            while copied < size:
+                if func is os.sendfile:
+                    n = func(outfd, infd, copied, size - copied)
+                else:
+                    n = func(infd, outfd, size - copied)
+                if n == 0:
+                    break  # The file got shorter, or a special file
+                copied += n
+        except OSError as e:
+            if copied or e.errno not in _FAST_COPY_UNSUPPORTED:
+                raise
+            if e.errno == errno.ENOSYS and func in _fast_copy_functions:
+                # Not supported by this kernel; don't try it again
+                _fast_copy_functions.remove(func)
+            continue
+        if copied:
+            # Carry on after the data copied, if the file grew
+            fsrc.seek(copied)
+            fdst.seek(copied)
+            return True
+    return False
+
+
+def copy_file_data(src, dst):
+    """Copy the contents of the file src to dst, like shutil.copyfile"""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        if size:
+            _fast_copy(fsrc, fdst, size)
+        shutil.copyfileobj(fsrc, fdst, COPY_CHUNK)
+
+
+def fast_copy2(src, dst):
+    """Copy a file with its metadata, like shutil.copy2
+
+    dst must be a file path, not a directory.
+    """
+    copy_file_data(src, dst)
+    shutil.copystat(src, dst)
+
+
+def reflink(src, dst):
+    """Make dst a copy-on-write clone of the file src
+
+    Raises OSError if the platform or filesystem can't do this.
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks not supported on this platform")
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.unlink(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def link_or_copy(src, dst):
+    """Put a copy of the file src at dst, sharing storage with it if possible
+
+    This tries a reflink, then a hard link, and then falls back to copying.
+    An existing file at dst is replaced rather than written to, so files which
+    share storage with another path are never modified.
+
+    Hard links mean that modifying dst in place would also modify src, so only
+    use this for files which will be read but not changed.
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        reflink(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    fast_copy2(src, dst)
+
+
+#: Ways to put files in the build directory, for :func:`stage_function`
+STAGE_MODES = ('copy', 'hardlink', 'reflink', 'symlink', 'auto')
+# Files which the build modifies after staging them, so they must be copies
+ALWAYS_COPY_SUFFIXES = ('._pth',)
+
+
+def _hardlink(src, dst):
+    os.link(src, dst)
+
+
+def _symlink(src, dst):
+    # makensis reads the file the link points to
+    os.symlink(os.path.realpath(src), dst)
+
+
+def _with_fallback(link):
+    def stage(src, dst):
+        if not dst.endswith(ALWAYS_COPY_SUFFIXES):
+            try:
+                return link(src, dst)
+            except OSError:
+                pass  # e.g. a different filesystem
+        fast_copy2(src, dst)
+    return stage
+
+
+def stage_function(mode):
+    """Get a function to put a file in the build directory, by mode
+
+    'copy' copies files. 'hardlink', 'reflink' and 'symlink' try to make that
+    kind of link, and copy the file if they can't. 'auto' tries a reflink,
+    then a hard link, then copying, as :func:`link_or_copy` does.
+
+    Links are only suitable for files which won't be modified in the build
+    directory. Files like ``python3x._pth``, which are, are always copied.
+    """
+    if mode == 'copy':
+        return fast_copy2
+    links = {
+        'hardlink': _hardlink,
+        'reflink': reflink,
+        'symlink': _symlink,
+        'auto': link_or_copy,
+    }
+    try:
+        return _with_fallback(links[mode])
+    except KeyError:
+        raise ValueError('Unknown stage mode {!r}, expected one of {}'
+                         .format(mode, ', '.join(STAGE_MODES)))
+
+
+class CopyEngine:
+    """Copy files on a pool of threads
+
+    Files are queued with :meth:`copy` or :meth:`copytree`, and copied in the
+    background. :meth:`wait` waits for the queued copies to finish, and raises
+    :exc:`shutil.Error` listing every file which failed, as
+    :func:`shutil.copytree` does. Used as a context manager, it waits for the
+    copies when the block finishes.
+
+    Directories are created as they are queued, so their names are taken
+    straight away.
+    """
+    def __init__(self, threads=None):
+        self.pool = ThreadPoolExecutor(
+            max_workers=threads or DEFAULT_COPY_THREADS,
+            thread_name_prefix='pynsist-copy')
+        self._futures = []
+        self._dirs = []  # (src, dst) to copy metadata for after the files
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if exc_type is None:
+                self.wait()
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the threads, after any copies in progress"""
+        self.pool.shutdown()
+
+    def copy(self, src, dst, copy_function=fast_copy2):
+        """Queue copying the file src to the path dst"""
+        future = self.pool.submit(copy_function, src, dst)
+        self._futures.append((future, src, dst))
+
+    def copytree(self, src, dst, ignore=None, copy_function=fast_copy2,
+                 dirs_exist_ok=False):
+        """Queue copying a directory, like shutil.copytree
+
+        The tree is listed once with os.scandir. ignore is called like
+        copytree's ignore callback, with a directory and a list of names in
+        it, and returns the names to skip. Symlinks are followed.
+        """
+        os.makedirs(dst, exist_ok=dirs_exist_ok)
+        stack = [(src, dst)]
+        while stack:
+            src_dir, dst_dir = stack.pop()
+            with os.scandir(src_dir) as it:
+                entries = list(it)
+            ignored = ignore(src_dir, [e.name for e in entries]) if ignore \
+                else ()
+            for entry in entries:
+                if entry.name in ignored:
+                    continue
+                dst_path = os.path.join(dst_dir, entry.name)
+                if entry.is_dir():
+                    os.makedirs(dst_path, exist_ok=dirs_exist_ok)
+                    stack.append((entry.path, dst_path))
+                else:
+                    self.copy(entry.path, dst_path, copy_function)
+            self.copystat_later(src_dir, dst_dir)
+
+    def copystat_later(self, src_dir, dst_dir):
+        """Copy a directory's metadata once the queued files are copied"""
+        self._dirs.append((src_dir, dst_dir))
+
+    def wait(self):
+        """Wait for the queued copies to finish
+
+        Raises shutil.Error if any copies failed.
+        """
+        errors = []
+        futures, self._futures = self._futures, []
+        for future, src, dst in futures:
+            try:
+                future.result()
+            except OSError as e:
+                errors.append((src, dst, str(e)))
+
+        # Like copytree, copy directory metadata after their contents
+        dirs, self._dirs = self._dirs, []
+        for src_dir, dst_dir in reversed(dirs):
+            try:
+                shutil.copystat(src_dir, dst_dir)
+            except OSError as e:
+                # Windows can't set the times of directories
+                if getattr(e, 'winerror', None) is None:
+                    errors.append((src_dir, dst_dir, str(e)))
+        if errors:
+            raise shutil.Error(errors)
+
+
+def copytree(src, dst, ignore=None, copy_function=fast_copy2, threads=None):
+    """Copy a directory like shutil.copytree, with several threads"""
+    with CopyEngine(threads) as engine:
+        engine.copytree(src, dst, ignore=ignore, copy_function=copy_function)
@@ -0,0 +1,132 @@
+"""Hash files, and keep hash records beside cached files to detect corruption
+
+When a file is downloaded to the cache, its sha256 hash, size and modification
+time are written to a sidecar file, ``<file>.sha256``. Before a cached file is
+used, :func:`check_cached_file` compares its size and modification time with
+the record. If they match, the file is trusted without reading it; if not, it
+is hashed again and compared with the recorded hash.
+"""
+import hashlib
+import json
+import logging
+import mmap
+import os
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 20
+SIDECAR_SUFFIX = '.sha256'
+
+
+def hash_file(path, algorithm='sha256'):
+    """Hash the contents of a file, returning the hex digest
+
+    The file is memory-mapped and hashed in chunks, which avoids copying it
+    into Python bytes objects. hashlib releases the GIL for each chunk, so
+    several files can be hashed in parallel threads.
+    """
+    h = hashlib.new(algorithm)
+    with open(str(path), 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files can't be mapped
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                h.update(chunk)
+            return h.hexdigest()
+
+        with mm:
+            view = memoryview(mm)
+            try:
+                for start in range(0, len(view), CHUNK_SIZE):
+                    h.update(view[start:start + CHUNK_SIZE])
+            finally:
+                view.release()
+    return h.hexdigest()
+
+
+def sidecar_path(path):
+    path = Path(path)
+    return path.with_name(path.name + SIDECAR_SUFFIX)
+
+
+def write_sidecar(path, sha256=None):
+    """Record the hash, size and modification time of a cached file"""
+    if sha256 is None:
+        sha256 = hash_file(path)
+    st = os.stat(str(path))
+    record = {'sha256': sha256, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    sidecar = sidecar_path(path)
+    tmp = sidecar.with_name(sidecar.name + '.tmp-%d' % os.getpid())
+    with tmp.open('w') as f:
+        json.dump(record, f)
+    os.replace(str(tmp), str(sidecar))
+    return record
+
+
+def read_sidecar(path):
+    try:
+        with sidecar_path(path).open() as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not all(k in record for k in ('sha256', 'size', 'mtime_ns')):
+        return None
+    return record
+
+
+def remove_sidecar(path):
+    try:
+        sidecar_path(path).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _unchanged(path, record):
+    st = os.stat(str(path))
+    return (st.st_size, st.st_mtime_ns) == (record['size'], record['mtime_ns'])
+
+
+def check_cached_file(path, writable=True, full=False):
+    """Check a cached file against its hash record
+
+    Returns (ok, sha256). If there is no record yet, e.g. for files cached by
+    older versions, the file is trusted. If writable is True, it is hashed and
+    a record written; otherwise, sha256 is None. full=True re-hashes the file
+    even if its size and modification time are unchanged.
+    """
+    record = read_sidecar(path)
+    if record is None:
+        if not writable:
+            return True, None
+        return True, write_sidecar(path)['sha256']
+
+    if not full and _unchanged(path, record):
+        return True, record['sha256']
+
+    sha256 = hash_file(path)
+    if sha256 != record['sha256']:
+        return False, sha256
+    if writable and not _unchanged(path, record):
+        # Same contents, e.g. after being touched or copied: refresh the record
+        write_sidecar(path, sha256)
+    return True, sha256
+
+
+def verify_cached_file(path, writable=True):
+    """Return True if a cached file can be used, False if it is corrupted
+
+    Corrupted files in a writable cache are deleted, so they will be
+    downloaded again.
+    """
+    ok, _ = check_cached_file(path, writable=writable)
+    if ok:
+        return True
+
+    logger.warning('Cached file %s does not match its recorded hash%s', path,
+                   '; removing it' if writable else '')
+    if writable:
+        os.unlink(str(path))
+        remove_sidecar(path)
+    return False
@@ -0,0 +1,245 @@
+"""Resolve wheels once and record them, so later builds need no index lookups
+
+``pynsist lock installer.cfg`` writes ``installer.lock.json`` beside the config
+file. It records the exact wheel file, URL and sha256 hash chosen for each
+``pypi_wheels`` requirement, and the files and hashes matched by each
+``local_wheels`` pattern. Builds from that config then use the lockfile.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+
+from requests_download import HashTracker
+
+from .cache import record_access
+from .hashing import check_cached_file, hash_file, remove_sidecar
+from .pypi import make_indexes
+from .util import download, cached_file_hit, get_cache_layers, wheel_cache_dir
+from .wheels import CompatibilityScorer, WheelLocator
+
+logger = logging.getLogger(__name__)
+
+LOCKFILE_FORMAT_VERSION = 1
+
+
+class LockfileError(ValueError):
+    pass
+
+
+def lockfile_path(config_file):
+    """Get the lockfile path for a config file, e.g. installer.lock.json"""
+    return os.path.splitext(config_file)[0] + '.lock.json'
+
+
+def _target_platform(bitness):
+    return 'win_amd64' if bitness == 64 else 'win32'
+
+
+def resolve_requirement(req, scorer, extra_sources=None, indexes=None):
+    """Find the wheel for one pypi_wheels requirement, and describe it
+
+    Returns a dict for the lockfile's ``wheels`` list.
+    """
+    wl = WheelLocator(req, scorer, extra_sources, indexes=indexes)
+    entry = {'requirement': req, 'name': wl.name, 'version': wl.version}
+
+    path = wl.check_extra_sources()
+    if path is not None:
+        entry.update(filename=path.name, path=str(path), url=None,
+                     sha256=hash_file(path))
+        return entry
+
+    release = wl.find_remote_wheel()
+    sha256 = release.sha256_digest
+    if not sha256:
+        # Old index metadata may not have the hash; get it from the file.
+        sha256 = hash_file(wl.get_from_pypi())
+    entry.update(filename=release.filename, path=None, url=release.url,
+                 sha256=sha256)
+    return entry
+
+
+def make_lock(builder_args, indexes=None):
+    """Resolve the wheels for an installer, returning the lockfile data
+
+    builder_args is a dict of arguments for :class:`nsist.InstallerBuilder`,
+    as returned by :func:`nsist.configreader.get_installer_builder_args`.
+    """
+    from . import DEFAULT_BITNESS, DEFAULT_PY_VERSION
+    py_version = builder_args.get('py_version', DEFAULT_PY_VERSION)
+    bitness = builder_args.get('py_bitness', DEFAULT_BITNESS)
+    scorer = CompatibilityScorer(py_version, _target_platform(bitness))
+    if indexes is None:
+        indexes = make_indexes(builder_args.get('index_urls'),
+                               builder_args.get('find_links'))
+
+    extra_sources = builder_args.get('extra_wheel_sources')
+    requirements = builder_args.get('pypi_wheel_reqs', [])
+    pins = requirements
+    if builder_args.get('resolve_dependencies'):
+        from .resolver import Resolver
+        pins = Resolver(scorer, indexes, py_version, bitness,
+                        extra_sources).resolve(requirements)
+
+    wheels = [
+        resolve_requirement(req, scorer, extra_sources, indexes=indexes)
+        for req in pins
+    ]
+
+    local_wheels = []
+    for glob_path in builder_args.get('local_wheels', []):
+        for path in sorted(glob.glob(glob_path)):
+            local_wheels.append({'pattern': glob_path, 'path': path,
+                                 'sha256': hash_file(path)})
+
+    lock = {
+        'lockfile_version': LOCKFILE_FORMAT_VERSION,
+        'python': {'version': py_version, 'bitness': bitness},
+        'wheels': wheels,
+        'local_wheels': local_wheels,
+    }
+    if builder_args.get('resolve_dependencies'):
+        # The wheels are for these requirements plus their dependencies
+        lock['resolved_from'] = requirements
+    return lock
+
+
+def write_lockfile(path, lock):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(lock, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def read_lockfile(path):
+    with open(path, encoding='utf-8') as f:
+        lock = json.load(f)
+    if lock.get('lockfile_version') != LOCKFILE_FORMAT_VERSION:
+        raise LockfileError("Unsupported lockfile format in {}".format(path))
+    return lock
+
+
+class LockedWheel(object):
+    """Fetch a wheel recorded in a lockfile, checking its hash
+
+    This can stand in for :class:`nsist.wheels.WheelLocator` in
+    :class:`nsist.wheels.WheelGetter`.
+    """
+    def __init__(self, entry):
+        self.entry = entry
+        self.name = entry['name']
+        self.version = entry['version']
+        self.sha256 = entry['sha256']
+
+    def _check_hash(self, path):
+        if hash_file(path) != self.sha256:
+            raise LockfileError(
+                "{} does not match the hash in the lockfile. Rerun 'pynsist "
+                "lock' if it has changed deliberately.".format(path))
+
+    def fetch(self, trackers=()):
+        if self.entry.get('path'):
+            self._check_hash(self.entry['path'])
+            return self.entry['path']
+
+        filename = self.entry['filename']
+        for i, layer in enumerate(get_cache_layers()):
+            cached = wheel_cache_dir(self.name, self.version,
+                                     None if i == 0 else layer) / filename
+            if not cached.is_file():
+                continue
+            # Uses the hash record if the file is unchanged since it was saved
+            ok, sha256 = check_cached_file(cached, writable=(i == 0))
+            if ok and sha256 is None:
+                sha256 = hash_file(cached)
+            if ok and sha256 == self.sha256:
+                logger.info('Using cached wheel: %s', cached)
+                cached = cached_file_hit(cached, layer)
+                record_access(cached, hit=True)
+                return cached
+
+        target = wheel_cache_dir(self.name, self.version) / filename
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if target.is_file():
+            logger.warning('Cached wheel %s has the wrong hash, discarding it',
+                           target)
+            target.unlink()
+            remove_sidecar(target)
+
+        from . import __version__
+        hasher = HashTracker(hashlib.sha256())
+        headers = {'user-agent': 'pynsist/'+__version__}
+        logger.info('Downloading wheel: %s', self.entry['url'])
+        download(self.entry['url'], str(target), headers=headers,
+                 trackers=(hasher,) + tuple(trackers))
+        if hasher.hashobj.hexdigest() != self.sha256:
+            target.unlink()
+            remove_sidecar(target)
+            raise LockfileError('Downloaded wheel does not match lockfile hash: {}'
+                                .format(self.entry['url']))
+        record_access(target, hit=False)
+        return target
+
+
+def check_lock_matches(lock, py_version, bitness):
+    """Raise LockfileError if the lockfile was made for another Python build"""
+    locked = lock['python']
+    if (locked['version'], locked['bitness']) != (py_version, bitness):
+        raise LockfileError(
+            "The lockfile was made for Python {} ({}-bit), not {} ({}-bit). "
+            "Rerun 'pynsist lock'.".format(locked['version'], locked['bitness'],
+                                           py_version, bitness))
+
+
+def locked_wheels_for(lock, requirements, resolved=False):
+    """Get LockedWheel objects for a list of pypi_wheels requirements
+
+    If resolved is True, the lockfile must have been made by resolving the
+    same requirements, and all the wheels it records are returned.
+    """
+    if resolved:
+        if lock.get('resolved_from') != list(requirements):
+            raise LockfileError("The lockfile's dependencies were not resolved "
+                                "for these requirements. Rerun 'pynsist lock'.")
+        return [LockedWheel(w) for w in lock['wheels']]
+
+    by_req = {w['requirement']: w for w in lock['wheels']}
+    res = []
+    for req in requirements:
+        if req not in by_req:
+            raise LockfileError("{} is not in the lockfile. Rerun 'pynsist lock'."
+                                .format(req))
+        res.append(LockedWheel(by_req[req]))
+    return res
+
+
+def locked_local_wheels(lock, glob_path):
+    """Get the paths recorded for one local_wheels pattern, checking hashes"""
+    entries = [w for w in lock['local_wheels'] if w['pattern'] == glob_path]
+    if not entries:
+        raise LockfileError("{} is not in the lockfile. Rerun 'pynsist lock'."
+                            .format(glob_path))
+    for w in entries:
+        if hash_file(w['path']) != w['sha256']:
+            raise LockfileError(
+                "{} does not match the hash in the lockfile. Rerun 'pynsist "
+                "lock' if it has changed deliberately.".format(w['path']))
+    return [w['path'] for w in entries]
+
+
+def main(argv=None):
+    """Resolve the wheels for a config file and write its lockfile"""
+    import argparse
+    from . import read_config_args
+    argp = argparse.ArgumentParser(prog='pynsist lock')
+    argp.add_argument('config_file')
+    options = argp.parse_args(argv)
+
+    config_file, args = read_config_args(options.config_file)
+    lock = make_lock(args)
+    path = lockfile_path(config_file)
+    write_lockfile(path, lock)
+    logger.info('Locked %d wheels in %s',
+                len(lock['wheels']) + len(lock['local_wheels']), path)
+    return 0
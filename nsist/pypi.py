@@ -0,0 +1,424 @@
+"""Look up release files on package indexes, caching the metadata on disk.
+
+Three kinds of source are supported:
+
+- The PyPI JSON API (the default).
+- 'Simple' repository indexes (:pep:`503` HTML or :pep:`691` JSON), such as
+  PyPI's ``/simple/`` or a devpi or Artifactory mirror.
+- Find-links pages: a single HTML page linking directly to files.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from html.parser import HTMLParser
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from urllib.parse import unquote, urldefrag, urljoin, urlsplit
+
+import requests
+
+from .util import canonical_name, get_cache_dir, get_session
+from .wheelindex import parse_wheel_filename
+
+logger = logging.getLogger(__name__)
+
+PYPI_JSON_URL = 'https://pypi.org/pypi/{}/json'
+
+# How long (in seconds) to trust cached project metadata before checking
+# with the index whether it has changed.
+DEFAULT_METADATA_TTL = 24 * 60 * 60
+METADATA_TTL_ENV_VAR = 'PYNSIST_METADATA_TTL'
+OFFLINE_ENV_VAR = 'PYNSIST_OFFLINE'
+
+SIMPLE_JSON_TYPE = 'application/vnd.pypi.simple.v1+json'
+SIMPLE_ACCEPT = ', '.join([
+    SIMPLE_JSON_TYPE,
+    'application/vnd.pypi.simple.v1+html; q=0.2',
+    'text/html; q=0.01',
+])
+
+_SDIST_EXTENSIONS = ('.tar.gz', '.zip', '.tar.bz2', '.tgz')
+
+
+class MetadataError(Exception):
+    pass
+
+
+def split_release_filename(filename):
+    """Get (normalized name, version) from a wheel or sdist filename
+
+    Returns None for other files.
+    """
+    parsed = parse_wheel_filename(filename)
+    if parsed is not None:
+        return parsed[:2]
+    for ext in _SDIST_EXTENSIONS:
+        if filename.endswith(ext):
+            name, sep, version = filename[:-len(ext)].rpartition('-')
+            if sep and name:
+                return canonical_name(name), version
+    return None
+
+
+class RemoteRelease(object):
+    """A file from a release on a package index
+
+    This has the same attributes as yarg's Release objects which
+    :meth:`nsist.wheels.WheelLocator.pick_best_wheel` looks at.
+    """
+    def __init__(self, filename, url, package_type, md5_digest=None,
+                 sha256_digest=None, has_metadata=False, metadata_sha256=None):
+        self.filename = filename
+        self.url = url
+        self.package_type = package_type
+        self.md5_digest = md5_digest
+        self.sha256_digest = sha256_digest
+        # True if the core metadata is available separately (PEP 658)
+        self.has_metadata = has_metadata
+        self.metadata_sha256 = metadata_sha256
+
+    @property
+    def metadata_url(self):
+        return (self.url + '.metadata') if self.has_metadata else None
+
+    @classmethod
+    def from_json(cls, d):
+        return cls(d['filename'], d['url'], d['package_type'],
+                   md5_digest=d.get('md5'), sha256_digest=d.get('sha256'),
+                   has_metadata=d.get('has_metadata', False),
+                   metadata_sha256=d.get('metadata_sha256'))
+
+    def to_json(self):
+        return {
+            'filename': self.filename,
+            'url': self.url,
+            'package_type': self.package_type,
+            'md5': self.md5_digest,
+            'sha256': self.sha256_digest,
+            'has_metadata': self.has_metadata,
+            'metadata_sha256': self.metadata_sha256,
+        }
+
+    def __repr__(self):
+        return '<RemoteRelease {}>'.format(self.filename)
+
+
+def _file_entry(filename, url, **kwargs):
+    """Make a cached file description, or None if it's not a release file"""
+    split = split_release_filename(filename)
+    if split is None:
+        return None
+    package_type = 'wheel' if filename.endswith('.whl') else 'sdist'
+    d = RemoteRelease(filename, url, package_type, **kwargs).to_json()
+    d['name'], d['version'] = split
+    return d
+
+
+def _ttl_from_env():
+    """Get the metadata TTL in seconds from the environment, or the default"""
+    value = os.environ.get(METADATA_TTL_ENV_VAR, '').strip()
+    if not value:
+        return DEFAULT_METADATA_TTL
+    try:
+        ttl = float(value)
+    except ValueError:
+        ttl = -1
+    if not (ttl >= 0):  # Also catches NaN
+        logger.warning("%s should be a number of seconds, not %r; using the "
+                       "default of %d seconds", METADATA_TTL_ENV_VAR, value,
+                       DEFAULT_METADATA_TTL)
+        return DEFAULT_METADATA_TTL
+    return ttl
+
+
+class CachedIndexSource(object):
+    """Base class for sources which list release files, caching the lists
+
+    Each page is stored as JSON under *cache_dir*, along with the ETag and
+    Last-Modified headers the server sent. Cached pages are used without a
+    request if they are younger than *ttl* seconds (and list the version we're
+    looking for). Otherwise, a conditional request checks if it has changed.
+    In *offline* mode, only cached data is used.
+
+    Subclasses define :meth:`page_url` and :meth:`parse`.
+    """
+    accept = None
+    # True if one page lists every project. A fresh copy is then trusted for
+    # projects and versions it doesn't list, rather than checked again.
+    single_page = False
+
+    def __init__(self, cache_dir, ttl=None, offline=None):
+        self.cache_dir = Path(cache_dir)
+        if ttl is None:
+            ttl = _ttl_from_env()
+        self.ttl = ttl
+        if offline is None:
+            offline = bool(os.environ.get(OFFLINE_ENV_VAR))
+        self.offline = offline
+
+    def page_url(self, name):
+        """Get (cache key, URL) of the page listing files for a project"""
+        raise NotImplementedError
+
+    def parse(self, response, name):
+        """Get a list of file descriptions (see _file_entry) from a response"""
+        raise NotImplementedError
+
+    def _cache_file(self, key):
+        return self.cache_dir / (key + '.json')
+
+    def _load(self, key):
+        try:
+            with self._cache_file(key).open(encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if 'files' in entry else None
+
+    def _store(self, key, entry):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file and rename it, so concurrent builds never
+        # see a partly written file.
+        with NamedTemporaryFile('w', encoding='utf-8', dir=str(self.cache_dir),
+                                suffix='.tmp', delete=False) as f:
+            json.dump(entry, f)
+        os.replace(f.name, str(self._cache_file(key)))
+
+    def _fetch(self, url, name, cached):
+        """Get a page, revalidating the cached copy
+
+        Returns the new cache entry, or None if the page doesn't exist.
+        """
+        from . import __version__
+        headers = {'user-agent': 'pynsist/'+__version__}
+        if self.accept:
+            headers['Accept'] = self.accept
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        logger.debug('Fetching metadata: %s', url)
+        r = get_session().get(url, headers=headers)
+        if r.status_code == 304 and cached:
+            cached['fetched'] = time.time()
+            return cached
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+
+        return {
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+            'fetched': time.time(),
+            'files': [d for d in self.parse(r, name) if d is not None],
+        }
+
+    def _files_for(self, entry, name):
+        name = canonical_name(name)
+        return [d for d in entry['files'] if d['name'] == name]
+
+    def get_releases(self, name, version=None):
+        """Get a dict of release file lists for a project, keyed by version
+
+        If version is given, cached data which doesn't include that
+        version is revalidated even if it hasn't expired.
+        Raises MetadataError if the project is not found.
+        """
+        key, url = self.page_url(name)
+        cached = self._load(key)
+        if cached is not None:
+            fresh = (time.time() - cached['fetched']) < self.ttl
+            if self.offline or (fresh and (
+                    version is None or self.single_page or any(
+                        d['version'] == version
+                        for d in self._files_for(cached, name)
+            ))):
+                return self._group(cached, name)
+        elif self.offline:
+            raise MetadataError("No cached metadata for {} (offline mode)"
+                                .format(name))
+
+        try:
+            entry = self._fetch(url, name, cached)
+        except requests.ConnectionError:
+            if cached is None:
+                raise
+            logger.warning("Couldn't reach %s; using cached metadata", url)
+            return self._group(cached, name)
+
+        if entry is None:
+            raise MetadataError("No package named {} found at {}".format(name, url))
+        self._store(key, entry)
+        return self._group(entry, name)
+
+    def _group(self, entry, name):
+        releases = {}
+        for d in self._files_for(entry, name):
+            releases.setdefault(d['version'], []).append(d)
+        return releases
+
+    def release_files(self, name, version):
+        """Get a list of RemoteRelease objects for one version of a project
+
+        Returns None if the version doesn't exist.
+        """
+        releases = self.get_releases(name, version)
+        if version not in releases:
+            return None
+        return [RemoteRelease.from_json(d) for d in releases[version]]
+
+
+class PyPIMetadataCache(CachedIndexSource):
+    """Find release files with the PyPI JSON API
+
+    Project metadata is cached in ``pypi-json/`` in the cache directory.
+    """
+    def __init__(self, cache_dir=None, ttl=None, offline=None,
+                 url_template=PYPI_JSON_URL):
+        if cache_dir is None:
+            cache_dir = get_cache_dir() / 'pypi-json'
+        super().__init__(cache_dir, ttl=ttl, offline=offline)
+        self.url_template = url_template
+
+    def page_url(self, name):
+        return canonical_name(name), self.url_template.format(name)
+
+    def parse(self, response, name):
+        name = canonical_name(name)
+        files = []
+        for version, version_files in response.json()['releases'].items():
+            for f in version_files:
+                package_type = f['packagetype']
+                if package_type == 'bdist_wheel':
+                    package_type = 'wheel'
+                d = RemoteRelease(
+                    f['filename'], f['url'], package_type,
+                    md5_digest=f.get('md5_digest'),
+                    sha256_digest=f.get('digests', {}).get('sha256'),
+                ).to_json()
+                d['name'], d['version'] = name, version
+                files.append(d)
+        return files
+
+
+def _url_key(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+
+
+class _LinkCollector(HTMLParser):
+    """Collect links (and data-* attributes) from an HTML page"""
+    def __init__(self):
+        super().__init__()
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            attrs = dict(attrs)
+            if attrs.get('href'):
+                self.links.append(attrs)
+
+
+def _metadata_hash(value):
+    """Get the sha256 hash from a PEP 658 metadata attribute, if it has one
+
+    In HTML, this looks like 'sha256=...'; in JSON, like {'sha256': ...}.
+    """
+    if isinstance(value, dict):
+        return value.get('sha256')
+    if isinstance(value, str) and value.startswith('sha256='):
+        return value[len('sha256='):]
+    return None
+
+
+def _parse_html_links(response):
+    """Get file descriptions from the links in a PEP 503 HTML page"""
+    collector = _LinkCollector()
+    collector.feed(response.text)
+    files = []
+    for attrs in collector.links:
+        url, fragment = urldefrag(urljoin(response.url, attrs['href']))
+        # e.g. a local version 'torch-2.0.0%2Bcpu-...' is really '2.0.0+cpu'
+        filename = unquote(urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1])
+        hashes = dict([fragment.split('=', 1)]) if '=' in fragment else {}
+        metadata = [attrs.get(a) for a in ('data-core-metadata',
+                                           'data-dist-info-metadata')
+                    if attrs.get(a) not in {None, 'false'}]
+        files.append(_file_entry(filename, url,
+                                 md5_digest=hashes.get('md5'),
+                                 sha256_digest=hashes.get('sha256'),
+                                 has_metadata=bool(metadata),
+                                 metadata_sha256=_metadata_hash(
+                                     metadata[0] if metadata else None)))
+    return files
+
+
+class SimpleIndex(CachedIndexSource):
+    """Find release files with a simple repository API (PEP 503 and 691)
+
+    We ask for the JSON form of the API, and fall back to parsing HTML if the
+    server doesn't provide it.
+    """
+    accept = SIMPLE_ACCEPT
+
+    def __init__(self, index_url, cache_dir=None, ttl=None, offline=None):
+        self.index_url = index_url.rstrip('/') + '/'
+        if cache_dir is None:
+            cache_dir = get_cache_dir() / 'index-cache' / _url_key(self.index_url)
+        super().__init__(cache_dir, ttl=ttl, offline=offline)
+
+    def page_url(self, name):
+        name = canonical_name(name)
+        return name, urljoin(self.index_url, name + '/')
+
+    def parse(self, response, name):
+        content_type = response.headers.get('Content-Type', '')
+        if not content_type.startswith(SIMPLE_JSON_TYPE):
+            return _parse_html_links(response)
+
+        files = []
+        for f in response.json()['files']:
+            metadata = f.get('core-metadata') or f.get('dist-info-metadata')
+            files.append(_file_entry(
+                f['filename'], urljoin(response.url, f['url']),
+                md5_digest=f['hashes'].get('md5'),
+                sha256_digest=f['hashes'].get('sha256'),
+                has_metadata=bool(metadata),
+                metadata_sha256=_metadata_hash(metadata),
+            ))
+        return files
+
+
+class FindLinks(CachedIndexSource):
+    """Find release files linked directly from one HTML page"""
+    single_page = True
+
+    def __init__(self, url, cache_dir=None, ttl=None, offline=None):
+        self.url = url
+        if cache_dir is None:
+            cache_dir = get_cache_dir() / 'index-cache' / _url_key(url)
+        super().__init__(cache_dir, ttl=ttl, offline=offline)
+
+    def page_url(self, name):
+        # The same page for every project
+        return 'find-links', self.url
+
+    def parse(self, response, name):
+        return _parse_html_links(response)
+
+
+def make_indexes(index_urls=None, find_links=None, offline=None):
+    """Make the list of sources to search for wheels, in priority order
+
+    Find-links pages are searched first, then the indexes. If no index URLs
+    are given, the PyPI JSON API is used.
+    """
+    sources = [FindLinks(url, offline=offline) for url in (find_links or [])]
+    if index_urls:
+        sources.extend(SimpleIndex(url, offline=offline) for url in index_urls)
+    else:
+        sources.append(PyPIMetadataCache(offline=offline))
+    return sources
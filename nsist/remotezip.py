@@ -0,0 +1,149 @@
+"""Read parts of a zip file (e.g. a wheel) on a web server without downloading it
+
+:class:`RemoteFile` is a seekable file object which fetches the bytes it's
+asked for using HTTP Range requests. Opening it with :class:`zipfile.ZipFile`
+reads only the end of the file (the central directory) and then any members
+which are read, so we can look inside large wheels cheaply.
+"""
+import io
+import logging
+import re
+import zipfile
+
+from .util import get_session
+
+logger = logging.getLogger(__name__)
+
+# Fetched in the first request, as the central directory is at the end.
+# This is enough for the whole directory of most wheels.
+TAIL_SIZE = 256 * 1024
+
+# The smallest request made after that. zipfile reads a member's local header
+# and then its data in separate small reads, so this saves round trips.
+BLOCK_SIZE = 64 * 1024
+
+_content_range_re = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+
+
+class RangeRequestsNotSupported(OSError):
+    """The server ignored a Range request, and would send the whole file"""
+
+
+class RemoteFile(io.RawIOBase):
+    """A read-only, seekable file object for a URL, fetched in pieces
+
+    Fetched data is kept in memory, in blocks of BLOCK_SIZE bytes, so reading
+    the same part twice makes only one request. ``bytes_fetched`` counts how
+    much has been downloaded.
+    """
+    def __init__(self, url, headers=None, session=None):
+        super().__init__()
+        self.url = url
+        self.headers = dict(headers or {})
+        self.session = session or get_session()
+        self.bytes_fetched = 0
+        self._blocks = {}  # block number -> bytes
+        self._pos = 0
+
+        # Get the size and the end of the file in one request
+        start, data, self.size = self._request('bytes=-{}'.format(TAIL_SIZE))
+        self._store(start, data)
+
+    def _request(self, range_header):
+        """Make a Range request, returning (start, data, total size)"""
+        headers = dict(self.headers, Range=range_header)
+        r = self.session.get(self.url, headers=headers, stream=True)
+        try:
+            if r.status_code != 206:
+                r.raise_for_status()
+                raise RangeRequestsNotSupported(
+                    "{} doesn't support range requests".format(self.url))
+            m = _content_range_re.match(r.headers.get('Content-Range', ''))
+            if not m:
+                raise RangeRequestsNotSupported(
+                    "Bad Content-Range header from {}".format(self.url))
+            data = r.content
+        finally:
+            r.close()
+        start, end, total = map(int, m.groups())
+        if len(data) != end - start + 1:
+            raise OSError("Got {} bytes from {}, expected {}".format(
+                len(data), self.url, end - start + 1))
+        self.bytes_fetched += len(data)
+        return start, data, total
+
+    def _store(self, start, data):
+        """Cache whole blocks from data, which starts at offset start"""
+        first = -(-start // BLOCK_SIZE)  # Round up to a block boundary
+        for block in range(first, (start + len(data)) // BLOCK_SIZE + 1):
+            offset = block * BLOCK_SIZE - start
+            chunk = data[offset:offset + BLOCK_SIZE]
+            end = block * BLOCK_SIZE + len(chunk)
+            # Keep only complete blocks (the last block of the file may be short)
+            if len(chunk) == BLOCK_SIZE or end == self.size:
+                self._blocks[block] = chunk
+
+    def _fetch_blocks(self, first, last):
+        """Make sure blocks first to last (inclusive) are in memory"""
+        missing = [b for b in range(first, last + 1) if b not in self._blocks]
+        if not missing:
+            return
+        # One request covering all the missing blocks
+        start = missing[0] * BLOCK_SIZE
+        end = min((missing[-1] + 1) * BLOCK_SIZE, self.size) - 1
+        logger.debug('Fetching bytes %d-%d of %s', start, end, self.url)
+        got_start, data, _ = self._request('bytes={}-{}'.format(start, end))
+        self._store(got_start, data)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence: {}".format(whence))
+        if pos < 0:
+            raise ValueError("Negative seek position {}".format(pos))
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        n = min(len(b), self.size - self._pos)
+        if n <= 0:
+            return 0
+        first = self._pos // BLOCK_SIZE
+        last = (self._pos + n - 1) // BLOCK_SIZE
+        self._fetch_blocks(first, last)
+
+        data = b''.join(self._blocks[i] for i in range(first, last + 1))
+        offset = self._pos - first * BLOCK_SIZE
+        b[:n] = data[offset:offset + n]
+        self._pos += n
+        return n
+
+
+class RemoteZipFile(zipfile.ZipFile):
+    """A ZipFile for a URL, downloading only the parts which are read
+
+    Raises :exc:`RangeRequestsNotSupported` if the server can't send parts of
+    the file; callers can then fall back to downloading all of it.
+    """
+    def __init__(self, url, headers=None, session=None):
+        self.remote = RemoteFile(url, headers=headers, session=session)
+        super().__init__(io.BufferedReader(self.remote, BLOCK_SIZE))
+
+    @property
+    def bytes_fetched(self):
+        return self.remote.bytes_fetched
+
@@ -0,0 +1,319 @@
+"""Find the dependencies of pypi_wheels requirements
+
+This is a simple resolver: it works through the dependency tree one level at a
+time, picking the newest version of each new dependency that satisfies the
+requirements seen so far and has a compatible wheel. It does not backtrack,
+so if a later requirement conflicts with a version already chosen, it stops
+with an error suggesting a pin to add to ``pypi_wheels``.
+
+Dependencies are read from the ``Requires-Dist`` fields of each wheel's
+metadata, evaluating environment markers for the target Python on Windows.
+"""
+import hashlib
+import logging
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import HeaderParser
+from pathlib import Path
+
+import requests
+from distlib.markers import Evaluator
+from distlib.util import parse_requirement
+from distlib.version import (
+    NormalizedMatcher, NormalizedVersion, UnsupportedVersionError,
+)
+from requests_download import HashTracker
+
+from .hashing import remove_sidecar
+from .pypi import MetadataError, RemoteRelease
+from .remotezip import RangeRequestsNotSupported
+from .util import canonical_name, download, find_in_cache, get_cache_dir
+from .wheels import NoWheelError, WheelLocator
+
+logger = logging.getLogger(__name__)
+
+
+class ResolutionError(ValueError):
+    pass
+
+
+def marker_environment(py_version, bitness):
+    """Values for environment markers on the target Windows Python"""
+    return {
+        'implementation_name': 'cpython',
+        'implementation_version': py_version,
+        'os_name': 'nt',
+        'platform_machine': 'AMD64' if bitness == 64 else 'x86',
+        'platform_python_implementation': 'CPython',
+        'platform_release': '',
+        'platform_system': 'Windows',
+        'platform_version': '',
+        'python_full_version': py_version,
+        'python_version': '.'.join(py_version.split('.')[:2]),
+        'sys_platform': 'win32',
+        'extra': '',
+    }
+
+
+class Requirement(object):
+    """A parsed requirement, e.g. from pypi_wheels or Requires-Dist"""
+    def __init__(self, spec):
+        parsed = parse_requirement(spec)
+        if parsed is None:
+            raise ResolutionError("Could not parse requirement {!r}".format(spec))
+        self.spec = spec
+        self.name = parsed.name
+        self.key = canonical_name(parsed.name)
+        self.extras = set(parsed.extras or [])
+        self.constraints = parsed.constraints or []
+        self.marker = parsed.marker
+        if self.constraints:
+            self.matcher = NormalizedMatcher('{} ({})'.format(
+                self.name, ', '.join(op + v for op, v in self.constraints)))
+        else:
+            self.matcher = None
+
+    def pinned_version(self):
+        """The version if this is exactly 'name==version', else None"""
+        if len(self.constraints) == 1 and self.constraints[0][0] == '==':
+            return self.constraints[0][1]
+        return None
+
+    def allows(self, version):
+        if self.matcher is None:
+            return True
+        try:
+            return self.matcher.match(version)
+        except UnsupportedVersionError:
+            return version == self.pinned_version()
+
+    def allows_prereleases(self):
+        return any(_is_prerelease(v) for _, v in self.constraints)
+
+    def __str__(self):
+        return self.spec
+
+
+def _is_prerelease(version):
+    try:
+        return NormalizedVersion(version).is_prerelease
+    except UnsupportedVersionError:
+        return False
+
+
+def _version_key(version):
+    try:
+        return NormalizedVersion(version)
+    except UnsupportedVersionError:
+        return None
+
+
+def requires_dist(metadata_text, extras, environment):
+    """Get Requirement objects for the dependencies in core metadata
+
+    Only dependencies whose markers match the environment (with any of the
+    requested extras) are included.
+    """
+    msg = HeaderParser().parsestr(metadata_text)
+    evaluator = Evaluator()
+    reqs = []
+    for spec in msg.get_all('Requires-Dist') or []:
+        req = Requirement(spec)
+        if req.marker is not None:
+            contexts = [dict(environment, extra=e) for e in ({''} | extras)]
+            if not any(evaluator.evaluate(req.marker, c) for c in contexts):
+                continue
+        reqs.append(req)
+    return reqs
+
+
+def _read_metadata(zf, whl_name):
+    for name in zf.namelist():
+        parts = name.split('/')
+        if len(parts) == 2 and parts[0].endswith('.dist-info') \
+                and parts[1] == 'METADATA':
+            return zf.read(name).decode('utf-8', 'replace')
+    raise NoWheelError("No METADATA file found in {}".format(whl_name))
+
+
+def read_wheel_metadata(whl_file):
+    """Read the core metadata (METADATA) from a wheel file"""
+    with zipfile.ZipFile(str(whl_file)) as zf:
+        return _read_metadata(zf, whl_file)
+
+
+class Resolver(object):
+    """Expand a list of requirements to include all their dependencies
+
+    :param scorer: A :class:`nsist.wheels.CompatibilityScorer` for the target
+    :param list indexes: Package indexes to search (see :mod:`nsist.pypi`)
+    :param str py_version: Target Python version, e.g. '3.8.3'
+    :param int bitness: 32 or 64
+    :param list extra_sources: Directories of local wheels
+    :param int jobs: How many wheels' metadata to fetch concurrently
+    """
+    def __init__(self, scorer, indexes, py_version, bitness,
+                 extra_sources=None, index=None, jobs=4):
+        self.scorer = scorer
+        self.indexes = indexes
+        self.extra_sources = extra_sources
+        self.index = index
+        self.environment = marker_environment(py_version, bitness)
+        self.jobs = max(jobs, 1)
+
+    def _locator(self, name, version):
+        return WheelLocator('{}=={}'.format(name, version), self.scorer,
+                            self.extra_sources, indexes=self.indexes,
+                            index=self.index)
+
+    def _candidate_versions(self, req):
+        """List versions allowed by req with compatible wheels, newest first"""
+        for index in self.indexes:
+            try:
+                releases = index.get_releases(req.name, req.pinned_version())
+            except MetadataError:
+                continue
+            allowed = [v for v in releases
+                       if req.allows(v) and _version_key(v) is not None]
+            if not req.allows_prereleases() and \
+                    any(not _is_prerelease(v) for v in allowed):
+                allowed = [v for v in allowed if not _is_prerelease(v)]
+            allowed.sort(key=_version_key, reverse=True)
+
+            wl = self._locator(req.name, '')
+            res = [v for v in allowed if wl.pick_best_wheel(
+                [RemoteRelease.from_json(d) for d in releases[v]])]
+            if res:
+                return res
+        return []
+
+    def _choose_version(self, req):
+        pinned = req.pinned_version()
+        if pinned is not None:
+            # Can be satisfied from extra_wheel_sources without an index
+            return pinned
+        candidates = self._candidate_versions(req)
+        if not candidates:
+            raise NoWheelError("No compatible wheels found for {}".format(req))
+        return candidates[0]
+
+    def get_metadata(self, name, version):
+        """Get the core metadata text for the wheel we'll use
+
+        Tries, in order: a local or cached wheel, a separate metadata file
+        (PEP 658), reading just that file from the remote wheel with range
+        requests, and finally downloading the wheel to the cache.
+        """
+        wl = self._locator(name, version)
+        local = wl.check_extra_sources() or wl.check_cache()
+        if local is not None:
+            return read_wheel_metadata(local)
+
+        release = wl.find_remote_wheel()
+        if release.metadata_url:
+            text = self._get_metadata_file(release)
+            if text is not None:
+                return text
+
+        try:
+            with wl.open_remote_wheel() as zf:
+                text = _read_metadata(zf, release.url)
+                logger.debug('Read metadata from %s with %d bytes of range '
+                             'requests', release.filename, zf.bytes_fetched)
+                return text
+        except RangeRequestsNotSupported:
+            pass
+
+        return read_wheel_metadata(wl.get_from_pypi())
+
+    @staticmethod
+    def _get_metadata_file(release):
+        """Get the separate metadata file for a wheel (PEP 658), or None
+
+        The file is cached, and checked against the hash from the index.
+        """
+        relpath = Path('metadata', release.filename + '.metadata')
+        cached = find_in_cache(relpath)
+        if cached is not None:
+            return cached.read_text('utf-8')
+
+        cache_file = get_cache_dir() / relpath
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        hasher = HashTracker(hashlib.sha256())
+        try:
+            download(release.metadata_url, cache_file, trackers=(hasher,))
+        except requests.HTTPError as e:
+            logger.debug("Couldn't get %s: %s", release.metadata_url, e)
+            return None
+        expected = release.metadata_sha256
+        if expected and hasher.hashobj.hexdigest() != expected:
+            cache_file.unlink()
+            remove_sidecar(cache_file)
+            logger.warning('Metadata file corrupted: %s', release.metadata_url)
+            return None
+        return cache_file.read_text('utf-8')
+
+    def resolve(self, requirements):
+        """Resolve requirement strings to a list of 'name==version' pins
+
+        The requirements given come first, in the same order, followed by
+        their dependencies.
+        """
+        pins = {}  # key -> (name, version)
+        required_by = {}  # key -> [(Requirement, parent)]
+        extras_done = {}  # key -> set of extras whose deps we've added
+
+        level = [(Requirement(r), None) for r in requirements]
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while level:
+                # Look up versions for the new requirements concurrently;
+                # the results are used in order below.
+                choices = {}
+                for req, _ in level:
+                    if req.key not in pins and req.key not in choices:
+                        choices[req.key] = pool.submit(self._choose_version, req)
+
+                to_expand = []
+                for req, parent in level:
+                    required_by.setdefault(req.key, []).append((req, parent))
+                    if req.key in pins:
+                        name, version = pins[req.key]
+                        if not req.allows(version):
+                            raise ResolutionError(self._conflict_message(
+                                req.key, version, required_by[req.key]))
+                    else:
+                        version = choices[req.key].result()
+                        for earlier, _ in required_by[req.key]:
+                            if not earlier.allows(version):
+                                raise ResolutionError(self._conflict_message(
+                                    req.key, version, required_by[req.key]))
+                        pins[req.key] = (req.name, version)
+                        logger.info('Resolved %s to %s', req, version)
+                        extras_done[req.key] = None
+
+                    done = extras_done[req.key]
+                    if done is None or not req.extras <= done:
+                        new_extras = req.extras | (done or set())
+                        extras_done[req.key] = new_extras
+                        to_expand.append((req.key, new_extras))
+
+                metadata = pool.map(
+                    lambda k: self.get_metadata(*pins[k]),
+                    [key for key, _ in to_expand]
+                )
+                level = []
+                for (key, extras), text in zip(to_expand, metadata):
+                    parent = '{}=={}'.format(*pins[key])
+                    for dep in requires_dist(text, extras, self.environment):
+                        level.append((dep, parent))
+
+        return ['{}=={}'.format(name, version) for name, version in pins.values()]
+
+    @staticmethod
+    def _conflict_message(key, version, requirers):
+        lines = ["Could not find a version of {} for all requirements "
+                 "(chose {}):".format(key, version)]
+        for req, parent in requirers:
+            lines.append('  {} (from {})'.format(req, parent or 'pypi_wheels'))
+        lines.append('Add a version that satisfies all of these to pypi_wheels.')
+        return '\n'.join(lines)
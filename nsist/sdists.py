@@ -0,0 +1,145 @@
+"""Build wheels from sdists for pure-Python packages which don't publish wheels
+
+If the chosen release of a ``pypi_wheels`` requirement has no compatible wheel
+but does have an sdist, and ``build_sdists`` is enabled, we download the sdist
+and run ``pip wheel`` on it. pip builds it in an isolated environment with the
+build requirements the project specifies. Only pure-Python wheels
+(``py*-none-any``) are accepted: a wheel with compiled code built here would be
+for the wrong platform.
+
+Built wheels are cached under ``built-wheels/<sdist sha256>/``, so each sdist
+is built only once. Each build runs ``pip wheel`` in a subprocess from the
+thread which needs the wheel, so wheels fetched in parallel are also built in
+parallel, up to a limit.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import threading
+from pathlib import Path
+from tempfile import mkdtemp
+
+from requests_download import HashTracker
+
+from .cache import record_access
+from .hashing import check_cached_file, remove_sidecar
+from .util import download, get_cache_dir, wheel_cache_dir
+from .wheelindex import parse_wheel_filename
+
+logger = logging.getLogger(__name__)
+
+
+class SdistBuildError(Exception):
+    pass
+
+
+def build_wheel(sdist_path, wheel_dir):
+    """Build a wheel from an sdist with pip, returning the wheel's filename"""
+    cmd = [sys.executable, '-m', 'pip', 'wheel', '--no-deps',
+           '--disable-pip-version-check', '--wheel-dir', wheel_dir, sdist_path]
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                         universal_newlines=True)
+    if res.returncode != 0:
+        raise SdistBuildError("Building a wheel from {} failed:\n{}".format(
+            os.path.basename(sdist_path), res.stdout[-3000:]))
+    wheels = [f for f in os.listdir(wheel_dir) if f.endswith('.whl')]
+    if len(wheels) != 1:
+        raise SdistBuildError("Expected 1 wheel from {}, found {}".format(
+            os.path.basename(sdist_path), wheels))
+    return wheels[0]
+
+
+def is_pure_python(whl_filename):
+    parsed = parse_wheel_filename(whl_filename)
+    if parsed is None:
+        return False
+    interpreter, abi, platform = parsed[2]
+    return all(i.startswith('py') for i in interpreter.split('.')) \
+        and abi == 'none' and platform == 'any'
+
+
+class SdistBuilder(object):
+    """Build and cache wheels from sdists
+
+    :param int jobs: The maximum number of builds to run at once
+    """
+    def __init__(self, jobs=1, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = get_cache_dir() / 'built-wheels'
+        self.cache_dir = Path(cache_dir)
+        self.jobs = max(jobs, 1)
+        self._slots = threading.BoundedSemaphore(self.jobs)
+
+    def _build(self, sdist_path, wheel_dir):
+        """Build the wheel, returning its filename
+
+        pip runs in a subprocess, so this thread only waits for it.
+        """
+        with self._slots:
+            return build_wheel(str(sdist_path), str(wheel_dir))
+
+    def fetch_sdist(self, wl, release):
+        """Download an sdist to the wheel cache, beside any wheels"""
+        target = wheel_cache_dir(wl.name, wl.version) / release.filename
+        if target.is_file() and check_cached_file(target)[0]:
+            record_access(target, hit=True)
+            return target
+        target.parent.mkdir(parents=True, exist_ok=True)
+
+        from . import __version__
+        hasher = HashTracker(hashlib.sha256())
+        logger.info('Downloading sdist: %s', release.url)
+        download(release.url, str(target),
+                 headers={'user-agent': 'pynsist/'+__version__},
+                 trackers=(hasher,))
+        if release.sha256_digest and \
+                hasher.hashobj.hexdigest() != release.sha256_digest:
+            target.unlink()
+            remove_sidecar(target)
+            raise ValueError('Downloaded sdist corrupted: {}'.format(release.url))
+        record_access(target, hit=False)
+        return target
+
+    def get_wheel(self, wl, release):
+        """Get a wheel built from the sdist described by release
+
+        wl is the :class:`nsist.wheels.WheelLocator` for the requirement.
+        Returns the path of the built wheel.
+        """
+        sdist = self.fetch_sdist(wl, release)
+        key = check_cached_file(sdist)[1]
+        built_dir = self.cache_dir / key
+        if built_dir.is_dir():
+            wheels = [p for p in built_dir.iterdir() if p.suffix == '.whl']
+            if wheels:
+                logger.info('Using wheel built from sdist: %s', wheels[0])
+                record_access(wheels[0], hit=True)
+                return wheels[0]
+
+        logger.info('Building a wheel from %s', sdist.name)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        td = Path(mkdtemp(dir=str(self.cache_dir), prefix='tmp-'))
+        try:
+            filename = self._build(sdist, td)
+            if not is_pure_python(filename):
+                raise SdistBuildError(
+                    "{} built {}, which contains compiled code. Build a wheel "
+                    "for Windows and use extra_wheel_sources or local_wheels."
+                    .format(sdist.name, filename))
+            if not wl.scorer.is_compatible(filename):
+                raise SdistBuildError("{} is not compatible with Python {}"
+                                      .format(filename, wl.scorer.py_version))
+            try:
+                os.rename(str(td), str(built_dir))
+            except OSError:
+                if not built_dir.is_dir():
+                    raise
+                # Another build finished the same sdist first
+        finally:
+            if td.is_dir():
+                shutil.rmtree(str(td))
+        record_access(built_dir / filename, hit=False)
+        return built_dir / filename
@@ -0,0 +1,232 @@
+"""Read zip members from their local file headers while the file downloads
+
+A zip file normally has to be complete before it can be read, because the
+central directory listing its members is at the end. But each member is also
+preceded by a local header with its name and (usually) its size, so members
+can be decompressed in order as the bytes arrive.
+
+The local headers aren't authoritative: a zip file may contain data which the
+central directory doesn't list, and members written with a data descriptor
+don't record their size up front. So anything read this way has to be checked
+against the central directory once the download is finished, with any
+mismatches read again from the complete file.
+"""
+import logging
+import struct
+import zlib
+
+logger = logging.getLogger(__name__)
+
+LOCAL_HEADER_SIG = b'PK\x03\x04'
+CENTRAL_DIR_SIG = b'PK\x01\x02'
+END_OF_CENTRAL_DIR_SIG = b'PK\x05\x06'
+DATA_DESCRIPTOR_SIG = b'PK\x07\x08'
+
+# signature, version, flags, method, time, date, crc, csize, usize,
+# filename length, extra length
+LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+
+STORED = 0
+DEFLATED = 8
+
+FLAG_ENCRYPTED = 0x1
+FLAG_DATA_DESCRIPTOR = 0x8
+FLAG_UTF8 = 0x800
+
+
+class StreamedMember(object):
+    """A member of a zip file which was read from the stream"""
+    def __init__(self, name, crc, size):
+        self.name = name
+        self.crc = crc
+        self.size = size
+
+
+def _parse_zip64_extra(extra, usize, csize):
+    """Get the real sizes from a zip64 extra field, if there is one"""
+    i = 0
+    while i + 4 <= len(extra):
+        field_id, length = struct.unpack_from('<HH', extra, i)
+        if field_id == 1:
+            data = extra[i + 4:i + 4 + length]
+            j = 0
+            if usize == 0xFFFFFFFF and j + 8 <= len(data):
+                usize, = struct.unpack_from('<Q', data, j)
+                j += 8
+            if csize == 0xFFFFFFFF and j + 8 <= len(data):
+                csize, = struct.unpack_from('<Q', data, j)
+            return usize, csize, True
+        i += 4 + length
+    return usize, csize, False
+
+
+class StreamingZipReader(object):
+    """Decompress zip members from chunks of data as they arrive
+
+    open_member(name) is called as each member starts, and returns a file
+    object to write its contents to, or None to skip it. The file is closed
+    once the member is complete, and a :class:`StreamedMember` is added to
+    :attr:`members`.
+
+    If the reader meets something it can't handle, it stops and sets
+    :attr:`failed` to a description. :attr:`done` is set when it reaches the
+    central directory.
+    """
+    def __init__(self, open_member):
+        self.open_member = open_member
+        self.members = []
+        self.done = False
+        self.failed = None
+        self._buf = bytearray()
+        self._state = self._read_header
+        self._member = None
+
+    def feed(self, data):
+        if self.done or self.failed:
+            return
+        self._buf += data
+        try:
+            # Each state handler returns False when it needs more data
+            while not (self.done or self.failed) and self._state():
+                pass
+        except (zlib.error, OSError) as e:
+            self._stop('{}: {}'.format(type(e).__name__, e))
+
+    def close(self):
+        """Discard any incomplete member"""
+        if self._member is not None and self._member['file'] is not None:
+            self._member['file'].close()
+        self._member = None
+        self._buf = bytearray()
+
+    def _stop(self, reason):
+        logger.debug('Stopped streaming zip members: %s', reason)
+        self.failed = reason
+        self.close()
+
+    def _read_header(self):
+        buf = self._buf
+        if len(buf) < 4:
+            return False
+        sig = bytes(buf[:4])
+        if sig in (CENTRAL_DIR_SIG, END_OF_CENTRAL_DIR_SIG):
+            self.done = True
+            self._buf = bytearray()
+            return False
+        if sig != LOCAL_HEADER_SIG:
+            self._stop('unexpected signature {!r}'.format(sig))
+            return False
+        if len(buf) < LOCAL_HEADER.size:
+            return False
+        (_, _, flags, method, _, _, crc, csize, usize, name_len, extra_len
+         ) = LOCAL_HEADER.unpack_from(buf)
+        header_len = LOCAL_HEADER.size + name_len + extra_len
+        if len(buf) < header_len:
+            return False
+
+        raw_name = bytes(buf[LOCAL_HEADER.size:LOCAL_HEADER.size + name_len])
+        extra = bytes(buf[LOCAL_HEADER.size + name_len:header_len])
+        del buf[:header_len]
+        # The same rule as the zipfile module
+        name = raw_name.decode('utf-8' if flags & FLAG_UTF8 else 'cp437')
+        usize, csize, zip64 = _parse_zip64_extra(extra, usize, csize)
+
+        if flags & FLAG_ENCRYPTED:
+            self._stop('{} is encrypted'.format(name))
+            return False
+        has_descriptor = bool(flags & FLAG_DATA_DESCRIPTOR)
+        sizes_known = not has_descriptor or csize != 0
+        if method not in (STORED, DEFLATED) or name.endswith('/'):
+            if not sizes_known:
+                self._stop("can't find the end of {}".format(name))
+                return False
+            # Skip it; it will be read from the complete file if needed
+            self._member = self._new_member(name, None, csize, has_descriptor,
+                                            zip64, decompress=False)
+        elif method == STORED and not sizes_known:
+            self._stop("can't find the end of {}".format(name))
+            return False
+        else:
+            f = self.open_member(name)
+            self._member = self._new_member(
+                name, f, csize if sizes_known else None, has_descriptor, zip64,
+                decompress=(method == DEFLATED and f is not None)
+            )
+            if f is None and not sizes_known:
+                # We still have to decompress it to find where it ends
+                self._member['decompressor'] = zlib.decompressobj(-15)
+        self._state = self._read_data
+        return True
+
+    @staticmethod
+    def _new_member(name, f, remaining, has_descriptor, zip64, decompress):
+        return {
+            'name': name, 'file': f, 'remaining': remaining,
+            'descriptor': has_descriptor, 'zip64': zip64,
+            'decompressor': zlib.decompressobj(-15) if decompress else None,
+            'crc': 0, 'size': 0,
+        }
+
+    def _write(self, data):
+        m = self._member
+        if m['file'] is None or not data:
+            return
+        m['file'].write(data)
+        m['crc'] = zlib.crc32(data, m['crc'])
+        m['size'] += len(data)
+
+    def _read_data(self):
+        m = self._member
+        buf = self._buf
+        if not buf:
+            return False
+        d = m['decompressor']
+
+        if m['remaining'] is None:
+            # Size unknown: the deflate stream marks its own end
+            self._write(d.decompress(bytes(buf)))
+            self._buf = bytearray(d.unused_data)
+            if not d.eof:
+                return False
+        else:
+            n = min(m['remaining'], len(buf))
+            chunk = bytes(buf[:n])
+            del buf[:n]
+            m['remaining'] -= n
+            if m['file'] is not None:
+                self._write(d.decompress(chunk) if d else chunk)
+            if m['remaining']:
+                return False
+            if d is not None:
+                self._write(d.flush())
+
+        self._state = self._read_descriptor if m['descriptor'] \
+            else self._finish_member
+        return True
+
+    def _read_descriptor(self):
+        # The signature is optional, and the sizes may be 4 or 8 bytes each
+        buf = self._buf
+        if len(buf) < 28:
+            # The central directory follows, so there's always more data
+            return False
+        offset = 4 if bytes(buf[:4]) == DATA_DESCRIPTOR_SIG else 0
+        if self._member['zip64']:
+            length = offset + 20
+        else:
+            length = offset + 12
+            if bytes(buf[length:length + 2]) != b'PK' \
+                    and bytes(buf[offset + 20:offset + 22]) == b'PK':
+                length = offset + 20
+        del buf[:length]
+        self._state = self._finish_member
+        return True
+
+    def _finish_member(self):
+        m = self._member
+        self._member = None
+        if m['file'] is not None:
+            m['file'].close()
+            self.members.append(StreamedMember(m['name'], m['crc'], m['size']))
+        self._state = self._read_header
+        return True
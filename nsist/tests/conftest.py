@@ -0,0 +1,27 @@
+import io
+from zipfile import ZipFile
+
+import pytest
+
+from nsist.util import CACHE_ENV_VAR, CACHE_LAYERS_ENV_VAR
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache(tmp_path, monkeypatch):
+    """Keep tests from reading or writing the developer's real cache
+
+    Each test gets an empty cache at ``tmp_path / 'cache'``.
+    """
+    cache_dir = tmp_path / 'cache'
+    monkeypatch.setenv(CACHE_ENV_VAR, str(cache_dir))
+    monkeypatch.delenv(CACHE_LAYERS_ENV_VAR, raising=False)
+    return cache_dir
+
+
+def make_wheel(files):
+    """Make the bytes of a zip file, from a dict of filename -> data"""
+    buf = io.BytesIO()
+    with ZipFile(buf, 'w') as zf:
+        for name, data in files.items():
+            zf.writestr(name, data)
+    return buf.getvalue()
@@ -0,0 +1,116 @@
+import os
+import time
+
+import pytest
+from testpath import assert_isfile, assert_not_path_exists
+
+from nsist import main
+from nsist.cache import (
+    CacheUsage, load_artifacts, parse_age, parse_size, record_access,
+    select_for_pruning,
+)
+
+@pytest.fixture()
+def cache_dir(tmp_path):
+    d = tmp_path / 'cache'
+    for name, size in [('a', 1000), ('b', 2000), ('c', 3000)]:
+        release_dir = d / 'pypi' / name / '1.0'
+        release_dir.mkdir(parents=True)
+        (release_dir / '{}-1.0-py3-none-any.whl'.format(name)).write_bytes(b'x' * size)
+    (d / 'python-3.8.3-embed-amd64.zip').write_bytes(b'x' * 500)
+    return d
+
+def wheel(cache_dir, name):
+    return cache_dir / 'pypi' / name / '1.0' / '{}-1.0-py3-none-any.whl'.format(name)
+
+def test_record_access(cache_dir):
+    record_access(wheel(cache_dir, 'a'), hit=False)
+    record_access(wheel(cache_dir, 'a'), hit=True)
+    record_access(wheel(cache_dir, 'a'), hit=True)
+    # Files outside the cache are ignored
+    record_access(cache_dir.parent / 'elsewhere.whl', hit=True)
+
+    usage = CacheUsage(cache_dir)
+    last_access, hits, misses = usage.get('pypi/a/1.0/a-1.0-py3-none-any.whl')
+    assert (hits, misses) == (2, 1)
+    assert time.time() - last_access < 60
+    assert len(usage.all()) == 1
+
+def test_select_lru(cache_dir):
+    # Access times are recorded, rather than using modification times
+    now = time.time()
+    for name in 'abc':
+        os.utime(str(wheel(cache_dir, name)), (now, now))
+    usage = CacheUsage(cache_dir)
+    for name, age in [('a', 10), ('b', 30), ('c', 20)]:
+        usage.record(wheel(cache_dir, name), hit=True)
+        usage._conn.execute("UPDATE access SET last_access = ? WHERE path = ?",
+                            (now - age * 86400, 'pypi/{0}/1.0/{0}-1.0-py3-none-any.whl'.format(name)))
+    usage._conn.commit()
+    artifacts = load_artifacts(cache_dir, usage)
+    assert len(artifacts) == 4
+
+    by_size = select_for_pruning(artifacts, max_size=3500, now=now)
+    assert [a.relpath for a in by_size] == [
+        'pypi/b/1.0/b-1.0-py3-none-any.whl', 'pypi/c/1.0/c-1.0-py3-none-any.whl'
+    ]
+    by_age = select_for_pruning(artifacts, older_than=15 * 86400, now=now)
+    assert {a.relpath for a in by_age} == {
+        'pypi/b/1.0/b-1.0-py3-none-any.whl', 'pypi/c/1.0/c-1.0-py3-none-any.whl'
+    }
+
+def test_prune_command(cache_dir, capsys):
+    now = time.time()
+    os.utime(str(wheel(cache_dir, 'a')), (now - 100, now - 100))
+    record_access(wheel(cache_dir, 'b'), hit=True)
+    record_access(wheel(cache_dir, 'c'), hit=True)
+
+    assert main(['cache', 'prune', '--max-size', '5K', '--dry-run']) == 0
+    assert_isfile(wheel(cache_dir, 'a'))
+
+    assert main(['cache', 'prune', '--max-size', '5K']) == 0
+    # The zip and 'a' had no recorded use and older modification times
+    assert_not_path_exists(cache_dir / 'python-3.8.3-embed-amd64.zip')
+    assert_not_path_exists(cache_dir / 'pypi' / 'a')
+    assert_isfile(wheel(cache_dir, 'b'))
+    assert_isfile(wheel(cache_dir, 'c'))
+
+    assert main(['cache', 'info', '--list']) == 0
+    out = capsys.readouterr().out
+    assert 'Total size: 4.9 KiB in 2 items' in out
+    assert 'pypi/c/1.0/c-1.0-py3-none-any.whl' in out
+
+def test_sdists_and_built_wheels(cache_dir):
+    sdist = cache_dir / 'pypi' / 'd' / '1.0' / 'd-1.0.tar.gz'
+    sdist.parent.mkdir(parents=True)
+    sdist.write_bytes(b'x' * 100)
+    built = cache_dir / 'built-wheels' / 'abc123' / 'd-1.0-py3-none-any.whl'
+    built.parent.mkdir(parents=True)
+    built.write_bytes(b'x' * 200)
+    # An unfinished build isn't listed
+    in_progress = cache_dir / 'built-wheels' / 'tmp-xyz' / 'e-1.0-py3-none-any.whl'
+    in_progress.parent.mkdir()
+    in_progress.write_bytes(b'')
+
+    usage = CacheUsage(cache_dir)
+    kinds = {a.relpath: a.kind for a in load_artifacts(cache_dir, usage)}
+    assert kinds['pypi/d/1.0/d-1.0.tar.gz'] == 'sdist'
+    assert kinds['built-wheels/abc123/d-1.0-py3-none-any.whl'] == 'built'
+    assert len(kinds) == 6
+
+    # They're checked by verify, and removed by prune
+    assert main(['cache', 'verify']) == 0
+    assert_isfile(str(built) + '.sha256')
+    assert main(['cache', 'prune', '--older-than', '0']) == 0
+    assert_not_path_exists(cache_dir / 'pypi' / 'd')
+    assert_not_path_exists(built.parent)
+    assert_isfile(in_progress)
+
+def test_parse_size_age():
+    assert parse_size('500') == 500
+    assert parse_size('2G') == 2 << 30
+    assert parse_size('1.5MiB') == 3 << 19
+    assert parse_age('30d') == parse_age('30') == 30 * 86400
+    assert parse_age('12h') == 12 * 3600
+    with pytest.raises(ValueError):
+        parse_size('lots')
@@ -1,5 +1,7 @@
+import hashlib
 import os
 import sys
+import zipimport
 
 import pytest
 from testpath import assert_isfile, assert_isdir
@@ -60,3 +62,95 @@ def test_module_not_found(tmpdir):
     tmpdir = str(tmpdir)
     with pytest.raises(ImportError):
         copy_modules(['nonexistant'], tmpdir, '3.3.5', sample_path)
+
+def test_modules_not_found_together(tmpdir):
+    tmpdir = str(tmpdir)
+    with pytest.raises(ImportError, match="'nonexistant', 'missing'"):
+        copy_modules(['plainmod', 'nonexistant', 'missing'], tmpdir, '3.3.5',
+                     sample_path)
+
+def test_resolver_matches_pathfinder():
+    import importlib.machinery
+    from nsist.copymodules import ModuleResolver
+    path = sample_path + sys.path
+    resolver = ModuleResolver(path)
+    for modname in ['plainmod', 'plainpkg', 'zippedmod2', 'zippedpkg2',
+                    'pytest', 'json', 'nonexistant']:
+        expected = importlib.machinery.PathFinder.find_spec(modname, path)
+        spec = resolver.find_spec(modname)
+        if expected is None:
+            assert spec is None
+        else:
+            assert spec.origin == expected.origin
+
+class LegacyZipFinder:
+    """A zipimporter as on Python < 3.10, with find_loader but no find_spec"""
+    def __init__(self, importer):
+        self.importer = importer
+
+    def find_loader(self, fullname):
+        try:
+            self.importer.get_filename(fullname)
+        except zipimport.ZipImportError:
+            return None, []
+        return self.importer, []
+
+def test_copy_from_zipfile_legacy_finder(tmpdir, monkeypatch):
+    from nsist import copymodules
+    get_finder = copymodules._get_finder
+    def legacy_get_finder(entry):
+        finder = get_finder(entry)
+        if isinstance(finder, zipimport.zipimporter):
+            return LegacyZipFinder(finder)
+        return finder
+    monkeypatch.setattr(copymodules, '_get_finder', legacy_get_finder)
+
+    spec = copymodules.ModuleResolver(sample_path).find_spec('zippedpkg2')
+    assert spec.submodule_search_locations
+    tmpdir = str(tmpdir)
+    copy_modules(['zippedmod2', 'zippedpkg2'], tmpdir, running_python,
+                 sample_path)
+    assert_isfile(pjoin(tmpdir, 'zippedmod2.py'))
+    assert_isdir(pjoin(tmpdir, 'zippedpkg2'))
+
+def test_copy_from_built_zipfile(tmp_path):
+    import zipfile
+    zip_path = str(tmp_path / 'lib.zip')
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        zf.writestr('sub/zpkg/__init__.py', '')
+        zf.writestr('sub/zpkg/inner/mod.py', 'x = 1')
+        zf.writestr('sub/zpkg2/__init__.py', '')
+        zf.writestr('sub/zmod.py', 'y = 2')
+    target = tmp_path / 'target'
+    target.mkdir()
+    copy_modules(['zpkg', 'zmod'], str(target), running_python,
+                 [zip_path + '/sub'])
+    assert_isfile(str(target / 'zpkg' / 'inner' / 'mod.py'))
+    assert (target / 'zmod.py').read_text() == 'y = 2'
+    # zpkg2 shares a prefix with zpkg, but isn't part of it
+    assert sorted(os.listdir(str(target))) == ['zmod.py', 'zpkg']
+
+def test_copy_exclude_and_manifest(tmp_path):
+    src = tmp_path / 'src' / 'bigpkg'
+    (src / 'sub' / 'tests').mkdir(parents=True)
+    (src / '__init__.py').write_text('')
+    (src / 'sub' / 'mod.py').write_text('x = 1')
+    (src / 'sub' / 'mod.pyc').write_bytes(b'')
+    (src / 'sub' / 'tests' / 'test_x.py').write_text('')
+    (src / 'data.txt').write_text('data')
+    target = tmp_path / 'target'
+    target.mkdir()
+
+    manifest = copy_modules(['bigpkg'], str(target), '3.3.5',
+                            [str(tmp_path / 'src')],
+                            exclude=['pkgs/bigpkg/sub/tests', 'pkgs/*/*.txt'])
+    assert sorted(manifest) == ['pkgs/bigpkg/__init__.py',
+                                'pkgs/bigpkg/sub/mod.py']
+    entry = manifest['pkgs/bigpkg/sub/mod.py']
+    assert entry.size == 5
+    assert entry.sha256 == hashlib.sha256(b'x = 1').hexdigest()
+    assert entry.source == str(src / 'sub' / 'mod.py')
+    assert_isfile(str(target / 'bigpkg' / 'sub' / 'mod.py'))
+    assert not (target / 'bigpkg' / 'sub' / 'tests').exists()
+    assert not (target / 'bigpkg' / 'sub' / 'mod.pyc').exists()
+    assert not (target / 'bigpkg' / 'data.txt').exists()
@@ -0,0 +1,66 @@
+import fnmatch
+import os
+
+import pytest
+
+from nsist.excludes import ExcludeMatcher
+
+PATTERNS = ['pkgs/foo/tests', 'pkgs/*/examples', 'pkgs/bar/*.txt',
+            '*.pyc', 'data_dir/ignored?', 'pkgs/baz/']
+
+@pytest.mark.parametrize('path, expected', [
+    ('pkgs/foo/tests', True),
+    ('pkgs/foo/tests/test_a.py', True),
+    ('pkgs/foo/testsuite.py', False),
+    ('pkgs/foo/__init__.py', False),
+    ('pkgs/anything/examples/x/y.py', True),
+    ('pkgs/bar/readme.txt', True),
+    ('pkgs/bar/sub/notes.txt', True),  # * matches across directories
+    ('pkgs/barrel/readme.txt', False),
+    ('pkgs/qux/mod.pyc', True),
+    ('data_dir/ignored1', True),
+    ('data_dir/ignored12', False),
+    ('pkgs/baz/mod.py', True),
+    ('pkgs/baz', True),
+    ('pkgs\\foo\\tests\\test_b.py', True),
+])
+def test_exclude_matcher(path, expected):
+    assert ExcludeMatcher(PATTERNS)(path) is expected
+
+BRACKET_PATTERNS = ['pkgs/foo/[ab].py', 'pkgs/*[0-9]', 'pkgs/foo/data[[]1].txt',
+                    'pkgs/[!x]y', 'pkgs/odd[', 'pkgs/q[]]']
+
+@pytest.mark.parametrize('path, expected', [
+    ('pkgs/foo/a.py', True),
+    ('pkgs/foo/c.py', False),
+    ('pkgs/lib2', True),
+    ('pkgs/lib2/mod.py', True),
+    ('pkgs/lib', False),
+    ('pkgs/foo/data[1].txt', True),
+    ('pkgs/foo/data1.txt', False),
+    ('pkgs/ay', True),
+    ('pkgs/xy', False),
+    ('pkgs/odd[', True),  # An unclosed [ is a literal character
+    ('pkgs/q]', True),
+])
+def test_bracket_patterns(path, expected):
+    assert ExcludeMatcher(BRACKET_PATTERNS)(path) is expected
+
+def test_matches_fnmatch():
+    paths = ['pkgs/foo/a.py', 'pkgs/foo/b.py', 'pkgs/lib2', 'pkgs/foo/data[1].txt',
+             'pkgs/ay', 'pkgs/odd[', 'pkgs/q]', 'pkgs/bar/readme.txt',
+             'pkgs/foo/tests', 'data_dir/ignored1', 'pkgs/x/examples']
+    for pattern in PATTERNS + BRACKET_PATTERNS:
+        matcher = ExcludeMatcher([pattern])
+        norm = pattern.rstrip('/')
+        for path in paths:
+            assert matcher(path) is fnmatch.fnmatchcase(path, norm), (pattern, path)
+
+def test_no_patterns():
+    matcher = ExcludeMatcher([])
+    assert not matcher
+    assert not matcher('pkgs/foo.py')
+
+@pytest.mark.skipif(os.name != 'nt', reason='Case-insensitive on Windows only')
+def test_case_insensitive():
+    assert ExcludeMatcher(['pkgs/Foo/Tests'])('pkgs/foo/tests/a.py')
@@ -0,0 +1,75 @@
+import os
+
+import pytest
+from testpath import assert_isfile
+
+import nsist
+from nsist import main
+
+from .test_indexes import IndexServer, FOO_WHL, BAR_WHL
+
+CFG = """\
+[Application]
+name=App {n}
+version=1.0
+entry_point=app:main
+
+[Python]
+version={py}
+bitness={bits}
+
+[Include]
+pypi_wheels={wheels}
+index_urls={url}/simple
+"""
+
+@pytest.fixture()
+def server():
+    s = IndexServer()
+    s.routes['/files/foo-1.0-py3-none-any.whl'] = ('application/octet-stream', FOO_WHL)
+    s.routes['/files/bar-2.0-py3-none-any.whl'] = ('application/octet-stream', BAR_WHL)
+    s.routes['/simple/foo/'] = ('text/html', b"""<html>
+    <a href="/files/foo-1.0-py3-none-any.whl">foo</a></html>""")
+    s.routes['/simple/bar/'] = ('text/html', b"""<html>
+    <a href="/files/bar-2.0-py3-none-any.whl">bar</a></html>""")
+    yield s
+    s.stop()
+
+def test_fetch(server, tmp_path, monkeypatch):
+    cache = tmp_path / 'cache'
+    cache.mkdir()
+    (cache / 'python-3.8.3-embed-amd64.zip').write_bytes(b'cached')
+    downloaded = []
+    def fake_download(url, target, **kwargs):
+        downloaded.append(url)
+        with open(str(target), 'wb') as f:
+            f.write(b'downloaded')
+    monkeypatch.setattr(nsist, 'download', fake_download)
+
+    paths = []
+    for n, (py, bits, wheels) in enumerate([
+        ('3.8.3', 64, 'foo==1.0'), ('3.9.1', 32, 'foo==1.0\n  bar==2.0'),
+    ]):
+        d = tmp_path / 'app{}'.format(n)
+        d.mkdir()
+        (d / 'installer.cfg').write_text(CFG.format(
+            n=n, py=py, bits=bits, wheels=wheels, url=server.url))
+        paths.append(str(d / 'installer.cfg'))
+
+    cwd = os.getcwd()
+    assert main(['fetch', '-j', '4'] + paths) == 0
+    assert os.getcwd() == cwd
+
+    assert downloaded == [
+        'https://www.python.org/ftp/python/3.9.1/python-3.9.1-embed-win32.zip'
+    ]
+    assert_isfile(cache / 'python-3.9.1-embed-win32.zip')
+    assert_isfile(cache / 'pypi' / 'foo' / '1.0' / 'foo-1.0-py3-none-any.whl')
+    assert_isfile(cache / 'pypi' / 'bar' / '2.0' / 'bar-2.0-py3-none-any.whl')
+
+def test_fetch_missing(server, tmp_path):
+    (tmp_path / 'installer.cfg').write_text(CFG.format(
+        n=0, py='3.8.3', bits=64, wheels='nope==1.0', url=server.url))
+    (tmp_path / 'cache').mkdir()
+    (tmp_path / 'cache' / 'python-3.8.3-embed-amd64.zip').write_bytes(b'')
+    assert main(['fetch', str(tmp_path / 'installer.cfg')]) == 1
@@ -0,0 +1,88 @@
+import os
+import shutil
+
+import pytest
+from testpath import assert_isfile
+
+from nsist import fileops
+from nsist.fileops import (CopyEngine, STAGE_MODES, copy_file_data,
+                           fast_copy2, stage_function)
+
+def test_fast_copy2(tmp_path):
+    src = tmp_path / 'src'
+    data = os.urandom(3 * fileops.COPY_CHUNK + 5)
+    src.write_bytes(data)
+    os.utime(str(src), (1000000, 1000000))
+    fast_copy2(str(src), str(tmp_path / 'dst'))
+    assert (tmp_path / 'dst').read_bytes() == data
+    assert os.stat(str(tmp_path / 'dst')).st_mtime == 1000000
+
+    (tmp_path / 'empty').write_bytes(b'')
+    fast_copy2(str(tmp_path / 'empty'), str(tmp_path / 'dst2'))
+    assert (tmp_path / 'dst2').read_bytes() == b''
+
+def test_copy_without_fast_functions(tmp_path, monkeypatch):
+    monkeypatch.setattr(fileops, '_fast_copy_functions', [])
+    (tmp_path / 'src').write_bytes(b'abc' * 1000)
+    copy_file_data(str(tmp_path / 'src'), str(tmp_path / 'dst'))
+    assert (tmp_path / 'dst').read_bytes() == b'abc' * 1000
+
+def test_copytree(tmp_path):
+    src = tmp_path / 'src'
+    for i in range(50):
+        d = src / 'd{}'.format(i % 5) / 'sub'
+        d.mkdir(parents=True, exist_ok=True)
+        (d / 'f{}.py'.format(i)).write_text(str(i))
+    (src / 'd0' / 'skip.txt').write_text('')
+    (src / 'd1' / 'skip.txt').mkdir()
+
+    ignore = shutil.ignore_patterns('skip.txt')
+    with CopyEngine(threads=4) as engine:
+        engine.copytree(str(src), str(tmp_path / 'dst'), ignore=ignore)
+        engine.copy(str(src / 'd0' / 'sub' / 'f0.py'), str(tmp_path / 'f0.py'))
+
+    for i in range(50):
+        f = tmp_path / 'dst' / 'd{}'.format(i % 5) / 'sub' / 'f{}.py'.format(i)
+        assert f.read_text() == str(i)
+    assert not (tmp_path / 'dst' / 'd0' / 'skip.txt').exists()
+    assert not (tmp_path / 'dst' / 'd1' / 'skip.txt').exists()
+    assert_isfile(str(tmp_path / 'f0.py'))
+
+def test_copy_errors(tmp_path):
+    (tmp_path / 'a').write_text('')
+    with pytest.raises(shutil.Error) as info:
+        with CopyEngine() as engine:
+            engine.copy(str(tmp_path / 'missing'), str(tmp_path / 'x'))
+            engine.copy(str(tmp_path / 'a'), str(tmp_path / 'nodir' / 'a'))
+            engine.copy(str(tmp_path / 'a'), str(tmp_path / 'b'))
+    errors = info.value.args[0]
+    assert [e[0] for e in errors] == [str(tmp_path / 'missing'),
+                                      str(tmp_path / 'a')]
+    assert_isfile(str(tmp_path / 'b'))
+
+@pytest.mark.parametrize('mode', STAGE_MODES)
+def test_stage_modes(tmp_path, mode):
+    stage = stage_function(mode)
+    for name in ('mod.py', 'python38._pth'):
+        (tmp_path / name).write_text('x')
+        stage(str(tmp_path / name), str(tmp_path / ('staged-' + name)))
+        assert (tmp_path / ('staged-' + name)).read_text() == 'x'
+
+    staged = tmp_path / 'staged-mod.py'
+    if mode == 'hardlink':
+        assert os.path.samefile(str(staged), str(tmp_path / 'mod.py'))
+    elif mode == 'symlink':
+        assert staged.is_symlink()
+    elif mode == 'copy':
+        assert os.stat(str(staged)).st_nlink == 1
+    # ._pth files are modified after staging, so they're always copies
+    pth = tmp_path / 'staged-python38._pth'
+    assert not pth.is_symlink() and os.stat(str(pth)).st_nlink == 1
+
+def test_stage_fallback(tmp_path, monkeypatch):
+    def fail(src, dst):
+        raise OSError('no links here')
+    monkeypatch.setattr(os, 'link', fail)
+    (tmp_path / 'src').write_text('x')
+    stage_function('hardlink')(str(tmp_path / 'src'), str(tmp_path / 'dst'))
+    assert (tmp_path / 'dst').read_text() == 'x'
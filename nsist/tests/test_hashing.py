@@ -0,0 +1,90 @@
+import hashlib
+import os
+
+import responses
+from testpath import assert_isfile, assert_not_path_exists
+
+from nsist import main
+from nsist.hashing import (
+    check_cached_file, hash_file, read_sidecar, sidecar_path, verify_cached_file,
+)
+from nsist.util import download, find_in_cache
+
+DATA = os.urandom(3 * 1024 * 1024 + 5)
+URL = 'https://example.com/python-3.8.3-embed-amd64.zip'
+
+def test_hash_file(tmp_path):
+    f = tmp_path / 'data'
+    f.write_bytes(DATA)
+    assert hash_file(f) == hashlib.sha256(DATA).hexdigest()
+    assert hash_file(f, 'md5') == hashlib.md5(DATA).hexdigest()
+    (tmp_path / 'empty').write_bytes(b'')
+    assert hash_file(tmp_path / 'empty') == hashlib.sha256(b'').hexdigest()
+
+def test_download_records_hash(tmp_path):
+    target = tmp_path / 'python.zip'
+    with responses.RequestsMock() as rsps:
+        rsps.add('GET', URL, body=DATA)
+        download(URL, target)
+
+    record = read_sidecar(target)
+    assert record['sha256'] == hashlib.sha256(DATA).hexdigest()
+    assert record['size'] == len(DATA)
+
+def corrupt(path, keep_mtime):
+    st = os.stat(str(path))
+    with open(str(path), 'r+b') as f:
+        f.write(b'XXXX')
+    if keep_mtime:
+        os.utime(str(path), ns=(st.st_atime_ns, st.st_mtime_ns))
+    else:
+        os.utime(str(path), ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+def test_check_cached_file(tmp_path):
+    f = tmp_path / 'python.zip'
+    f.write_bytes(DATA)
+    # No record yet: trusted, and a record written
+    assert check_cached_file(f) == (True, hashlib.sha256(DATA).hexdigest())
+    assert_isfile(sidecar_path(f))
+
+    # Touching the file without changing it refreshes the record
+    os.utime(str(f), ns=(0, 10**18))
+    assert check_cached_file(f)[0]
+    assert read_sidecar(f)['mtime_ns'] == 10**18
+
+    # Unchanged size & mtime are trusted, unless we ask for a full check
+    corrupt(f, keep_mtime=True)
+    assert check_cached_file(f)[0]
+    assert not check_cached_file(f, full=True)[0]
+
+    corrupt(f, keep_mtime=False)
+    assert not check_cached_file(f)[0]
+    assert not verify_cached_file(f, writable=False)
+    assert_isfile(f)
+    assert not verify_cached_file(f)
+    assert_not_path_exists(f)
+    assert_not_path_exists(sidecar_path(f))
+
+def test_corrupt_cache_file_skipped(isolated_cache):
+    isolated_cache.mkdir()
+    f = isolated_cache / 'python-3.8.3-embed-amd64.zip'
+    f.write_bytes(DATA)
+    assert find_in_cache(f.name) == f
+    corrupt(f, keep_mtime=False)
+    assert find_in_cache(f.name) is None
+
+def test_verify_command(isolated_cache):
+    good = isolated_cache / 'pypi' / 'a' / '1.0' / 'a-1.0-py3-none-any.whl'
+    bad = isolated_cache / 'pypi' / 'b' / '1.0' / 'b-1.0-py3-none-any.whl'
+    for f in (good, bad):
+        f.parent.mkdir(parents=True)
+        f.write_bytes(DATA)
+        check_cached_file(f)
+    corrupt(bad, keep_mtime=True)
+
+    assert main(['cache', 'verify', '-j', '2']) == 1
+    assert_isfile(bad)
+    assert main(['cache', 'verify', '--delete']) == 1
+    assert_not_path_exists(bad)
+    assert_isfile(good)
+    assert main(['cache', 'verify']) == 0
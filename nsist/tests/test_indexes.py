@@ -0,0 +1,164 @@
+"""Test finding wheels on simple indexes and find-links pages
+
+A local HTTP server stands in for the package index.
+"""
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from testpath import assert_isfile
+
+from nsist.pypi import SimpleIndex, FindLinks, SIMPLE_JSON_TYPE
+from nsist.wheels import WheelLocator, WheelGetter, CompatibilityScorer
+
+from .conftest import make_wheel
+
+FOO_WHL = make_wheel({'foo.py': b'', 'foo-1.0.dist-info/METADATA': b''})
+FOO_SHA = hashlib.sha256(FOO_WHL).hexdigest()
+BAR_WHL = make_wheel({'bar.py': b''})
+
+class IndexServer:
+    """A minimal package index, serving fixed responses"""
+    def __init__(self):
+        self.routes = {}   # path -> (content type, body)
+        self.requests = []   # (path, headers, client port)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server.requests.append((self.path, self.headers, self.client_address[1]))
+                if self.path not in server.routes:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                content_type, body = server.routes[self.path]
+                if callable(body):
+                    body = body(self.headers)
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+@pytest.fixture()
+def server():
+    s = IndexServer()
+    s.routes['/files/foo-1.0-py3-none-any.whl'] = ('application/octet-stream', FOO_WHL)
+    s.routes['/files/bar-2.0-py3-none-any.whl'] = ('application/octet-stream', BAR_WHL)
+    yield s
+    s.stop()
+
+SCORER = CompatibilityScorer('3.8.0', 'win_amd64')
+
+def test_simple_html(server, tmp_path):
+    server.routes['/simple/foo/'] = ('text/html', """<!DOCTYPE html><html><body>
+    <a href="../../files/foo-1.0-py3-none-any.whl#sha256={}"
+       data-dist-info-metadata="true">foo-1.0-py3-none-any.whl</a>
+    <a href="../../files/foo-1.0.tar.gz">foo-1.0.tar.gz</a>
+    <a href="../../files/foo-0.9-py3-none-any.whl">foo-0.9-py3-none-any.whl</a>
+    </body></html>""".format(FOO_SHA).encode())
+    index = SimpleIndex(server.url + '/simple', cache_dir=tmp_path / 'ix')
+
+    rels = index.release_files('Foo', '1.0')
+    assert sorted(r.filename for r in rels) == ['foo-1.0-py3-none-any.whl', 'foo-1.0.tar.gz']
+    whl = [r for r in rels if r.package_type == 'wheel'][0]
+    assert whl.url == server.url + '/files/foo-1.0-py3-none-any.whl'
+    assert whl.sha256_digest == FOO_SHA
+    assert whl.metadata_url == whl.url + '.metadata'
+    assert server.requests[0][1]['Accept'].startswith(SIMPLE_JSON_TYPE)
+
+def test_simple_html_quoted_filename(server, tmp_path):
+    server.routes['/files/foo-1.0%2Blocal-py3-none-any.whl?x=1'] = (
+        'application/octet-stream', FOO_WHL)
+    server.routes['/simple/foo/'] = ('text/html', b"""<html>
+    <a href="/files/foo-1.0%2Blocal-py3-none-any.whl?x=1">foo</a></html>""")
+    index = SimpleIndex(server.url + '/simple', cache_dir=tmp_path / 'ix')
+
+    assert list(index.get_releases('foo')) == ['1.0+local']
+    wl = WheelLocator('foo==1.0+local', SCORER, indexes=[index])
+    whl = wl.get_from_pypi()
+    assert whl.name == 'foo-1.0+local-py3-none-any.whl'
+
+def test_simple_json(server, tmp_path):
+    server.routes['/simple/foo/'] = (SIMPLE_JSON_TYPE, json.dumps({
+        'meta': {'api-version': '1.0'},
+        'name': 'foo',
+        'files': [{'filename': 'foo-1.0-py3-none-any.whl',
+                   'url': '/files/foo-1.0-py3-none-any.whl',
+                   'hashes': {'sha256': FOO_SHA}}],
+    }).encode())
+    index = SimpleIndex(server.url + '/simple/', cache_dir=tmp_path / 'ix')
+
+    wl = WheelLocator('foo==1.0', SCORER, indexes=[index])
+    whl = wl.get_from_pypi()
+    assert_isfile(whl)
+    assert whl.name == 'foo-1.0-py3-none-any.whl'
+
+    # Metadata and download shared one keep-alive connection
+    assert len({port for (_, _, port) in server.requests}) == 1
+
+def test_index_priority(server, tmp_path):
+    server.routes['/links.html'] = ('text/html', b"""<html>
+    <a href="files/bar-2.0-py3-none-any.whl">bar</a></html>""")
+    server.routes['/simple/foo/'] = ('text/html', b"""<html>
+    <a href="/files/foo-1.0-py3-none-any.whl">foo</a></html>""")
+    server.routes['/other/foo/'] = ('text/html', b"""<html>
+    <a href="/files/foo-1.0-py3-none-win_amd64.whl">foo</a></html>""")
+
+    indexes = [
+        FindLinks(server.url + '/links.html', cache_dir=tmp_path / 'fl'),
+        SimpleIndex(server.url + '/missing', cache_dir=tmp_path / 'ix0'),
+        SimpleIndex(server.url + '/simple', cache_dir=tmp_path / 'ix1'),
+        SimpleIndex(server.url + '/other', cache_dir=tmp_path / 'ix2'),
+    ]
+    # The first index with a compatible wheel wins
+    wl = WheelLocator('foo==1.0', SCORER, indexes=indexes)
+    assert wl.find_remote_wheel().url == server.url + '/files/foo-1.0-py3-none-any.whl'
+    wl = WheelLocator('bar==2.0', SCORER, indexes=indexes)
+    assert wl.find_remote_wheel().url == server.url + '/files/bar-2.0-py3-none-any.whl'
+
+def test_find_links_fresh_page_authoritative(server, tmp_path):
+    server.routes['/links.html'] = ('text/html', b"""<html>
+    <a href="files/bar-2.0-py3-none-any.whl">bar</a></html>""")
+    fl = FindLinks(server.url + '/links.html', cache_dir=tmp_path / 'fl')
+    assert list(fl.get_releases('bar')) == ['2.0']
+    n_requests = len(server.requests)
+
+    # Within the TTL, the page isn't fetched again for projects or versions
+    # it doesn't list
+    assert '3.0' not in fl.get_releases('bar', '3.0')
+    assert fl.get_releases('foo') == {}
+    assert fl.get_releases('foo', '1.0') == {}
+    assert len(server.requests) == n_requests
+
+def test_wheelgetter_index_urls(server, tmp_path):
+    server.routes['/simple/foo/'] = ('text/html', b"""<html>
+    <a href="/files/foo-1.0-py3-none-any.whl">foo</a></html>""")
+    server.routes['/links.html'] = ('text/html', b"""<html>
+    <a href="files/bar-2.0-py3-none-any.whl">bar</a></html>""")
+    pkgs = tmp_path / 'pkgs'
+    pkgs.mkdir()
+
+    wg = WheelGetter(['foo==1.0', 'bar==2.0'], [], str(pkgs), '3.8.0', 64,
+                     index_urls=[server.url + '/simple'],
+                     find_links=[server.url + '/links.html'])
+    wg.get_all()
+    assert_isfile(pkgs / 'foo.py')
+    assert_isfile(pkgs / 'bar.py')
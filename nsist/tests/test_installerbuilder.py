@@ -1,3 +1,4 @@
+import hashlib
 import io
 import os
 from os.path import join as pjoin
@@ -68,3 +69,111 @@ def test_copy_installer_nsi(tmpdir):
 
     assert_isfile(pjoin(tmpdir, 'installer.1.nsi'))
     assert ib.install_files == [('installer.1.nsi', '$INSTDIR')]
+
+def test_copy_extra_files_exclude(tmpdir):
+    tmpdir = str(tmpdir)
+    files = [
+        (pjoin(test_dir, 'data_files', 'dir1'), '$INSTDIR'),
+    ]
+    # Patterns are relative to the build directory
+    ib = InstallerBuilder("Test App", "1.0", {}, extra_files=files,
+                          exclude=['dir1/subdir', 'dir1/*.nsi'],
+                          build_dir=tmpdir)
+    ib.copy_extra_files()
+
+    assert os.listdir(pjoin(tmpdir, 'dir1')) == ['eg-data.txt']
+
+def test_prune_packages(tmp_path):
+    pkgs = tmp_path / 'pkgs'
+    (pkgs / 'app').mkdir(parents=True)
+    (pkgs / 'app' / '__init__.py').write_text('import used')
+    (pkgs / 'used.py').write_text('')
+    (pkgs / 'unused.py').write_text('x = 1')
+    (pkgs / 'plugin.py').write_text('')
+    ib = InstallerBuilder("Test App", "1.0", {}, build_dir=str(tmp_path),
+                          commands={'app': {'entry_point': 'app:main'}},
+                          prune_modules=True, keep_modules=['plug*'])
+    report = ib.prune_packages()
+
+    assert sorted(os.listdir(str(pkgs))) == ['app', 'plugin.py', 'used.py']
+    assert report.bytes_by_package == {'unused': 5}
+
+def test_prune_packages_to_profile(tmp_path):
+    from nsist.tracing import PROFILE_VERSION, write_profile
+    pkgs = tmp_path / 'pkgs'
+    pkgs.mkdir()
+    (pkgs / 'used.py').write_text('')
+    (pkgs / 'unused.py').write_text('x = 1')
+    profile = str(tmp_path / 'app.trace.json')
+    write_profile(profile, {'pynsist_trace_profile': PROFILE_VERSION,
+                            'commands': [], 'top_level': ['used.py', 'unused.py'],
+                            'files': ['used.py']})
+    ib = InstallerBuilder("Test App", "1.0", {}, build_dir=str(tmp_path),
+                          prune_profile=profile)
+    report = ib.prune_packages_to_profile()
+
+    assert os.listdir(str(pkgs)) == ['used.py']
+    assert report.bytes_by_package == {'unused': 5}
+
+def test_stage_mode_hardlink(tmp_path, monkeypatch):
+    import zipfile
+    import nsist
+    embed_zip = tmp_path / 'python-3.6.3-embed-amd64.zip'
+    with zipfile.ZipFile(str(embed_zip), 'w') as zf:
+        zf.writestr('python.exe', b'MZ')
+        zf.writestr('python36._pth', b'python36.zip\r\n.')
+    monkeypatch.setattr(nsist, 'get_python_embeddable',
+                        lambda *args, **kwargs: embed_zip)
+    data = tmp_path / 'data.txt'
+    data.write_text('data')
+    build_dir = tmp_path / 'build'
+    build_dir.mkdir()
+
+    ib = InstallerBuilder("Test App", "1.0", {}, build_dir=str(build_dir),
+                          extra_files=[(str(data), '$INSTDIR')],
+                          stage_mode='hardlink')
+    ib.fetch_python_embeddable()
+    ib.copy_extra_files()
+
+    assert os.path.samefile(str(build_dir / 'data.txt'), str(data))
+    sha256 = hashlib.sha256(embed_zip.read_bytes()).hexdigest()
+    cached = tmp_path / 'cache' / 'extracted' / ('python-' + sha256)
+    assert os.path.samefile(str(build_dir / 'Python' / 'python.exe'),
+                            str(cached / 'python.exe'))
+    # The ._pth file is modified, so it's copied, leaving the cache unchanged
+    assert (cached / 'python36._pth').read_bytes() == b'python36.zip\r\n.'
+    assert b'pkgs' in (build_dir / 'Python' / 'python36._pth').read_bytes()
+
+    # A zip with the same name but different contents is extracted again
+    with zipfile.ZipFile(str(embed_zip), 'w') as zf:
+        zf.writestr('python.exe', b'MZ2')
+        zf.writestr('python36._pth', b'python36.zip\r\n.')
+    build_dir2 = tmp_path / 'build2'
+    build_dir2.mkdir()
+    InstallerBuilder("Test App", "1.0", {}, build_dir=str(build_dir2),
+                     stage_mode='hardlink').fetch_python_embeddable()
+    assert (build_dir2 / 'Python' / 'python.exe').read_bytes() == b'MZ2'
+    assert (cached / 'python.exe').read_bytes() == b'MZ'
+
+def test_python_from_shared_layer(tmp_path, monkeypatch):
+    import zipfile
+    from nsist.hashing import sidecar_path
+    from nsist.util import CACHE_LAYERS_ENV_VAR
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    embed_zip = shared / 'python-3.6.3-embed-amd64.zip'
+    with zipfile.ZipFile(str(embed_zip), 'w') as zf:
+        zf.writestr('python.exe', b'MZ')
+    monkeypatch.setenv(CACHE_LAYERS_ENV_VAR, str(shared))
+    build_dir = tmp_path / 'build'
+    build_dir.mkdir()
+
+    ib = InstallerBuilder("Test App", "1.0", {}, build_dir=str(build_dir),
+                          py_version='3.6.3', py_bitness=64,
+                          stage_mode='hardlink')
+    ib.fetch_python_embeddable()
+    assert (build_dir / 'Python' / 'python.exe').read_bytes() == b'MZ'
+    # Nothing is written to the read-only layer
+    assert os.listdir(str(shared)) == [embed_zip.name]
+    assert not sidecar_path(embed_zip).exists()
+
@@ -8,7 +8,7 @@ from zipfile import ZipFile
 import pytest
 from testpath import assert_isfile, assert_isdir, assert_not_path_exists
 
-from nsist.wheels import WheelGetter, extract_wheel
+from nsist.wheels import WheelGetter, extract_wheel, ExtractedWheelCache
 
 # To exclude tests requiring network on an unplugged machine, use: pytest -m "not network"
 
@@ -41,6 +41,19 @@ def test_duplicate_wheel_files_raise(tmpdir):
     with pytest.raises(ValueError, match='Multiple wheels specified'):
         wg.get_all()
 
+def test_duplicate_wheel_names_normalized(tmp_path):
+    wheels = tmp_path / 'wheels'
+    wheels.mkdir()
+    for name in ['Foo_Bar-1.0-py3-none-any.whl', 'foo.bar-2.0-py3-none-any.whl']:
+        with ZipFile(str(wheels / name), 'w') as zf:
+            zf.writestr('foo_bar.py', b'')
+
+    wg = WheelGetter([], [str(wheels / '*.whl')], str(tmp_path / 'pkgs'),
+                     '3.8.0', 64)
+    with pytest.raises(ValueError, match='Multiple wheels specified for foo-bar'):
+        for path in sorted(glob.glob(str(wheels / '*.whl'))):
+            wg.validate_wheel(path)
+
 def test_invalid_wheel_file_raise(tmpdir):
     td1 = str(tmpdir.mkdir('wheels'))
     td2 = str(tmpdir.mkdir('pkgs'))
@@ -115,3 +128,105 @@ def test_extract_data_lib_sitepkg(tmpdir):
     assert_isfile(str(pkgs / 'osgeo' / 'bar.txt'))
     assert_isfile(str(pkgs / 'osgeo' / 'abc.txt'))
     assert_isfile(str(pkgs / 'osgeo' / 'def.txt'))
+
+@pytest.mark.parametrize('use_cache', [True, False])
+def test_get_requirements_pipelined(tmpdir, use_cache):
+    extracted = Path(str(tmpdir / 'extracted'))
+    src = Path(str(tmpdir.mkdir('wheels')))
+    pkgs = tmpdir.mkdir('pkgs')
+
+    reqs = []
+    for i in range(8):
+        with ZipFile(str(src / 'pkg{}-1.0-py3-none-any.whl'.format(i)), 'w') as zf:
+            zf.writestr('pkg{}/__init__.py'.format(i), b'')
+            # Every wheel writes this file; the last requirement should win
+            zf.writestr('shared.txt', 'pkg{}'.format(i))
+        reqs.append('pkg{}==1.0'.format(i))
+
+    wg = WheelGetter(reqs, [], str(pkgs), '3.8.0', 64,
+                     extra_sources=[src], jobs=4,
+                     extract_cache=use_cache and ExtractedWheelCache(extracted))
+    wg.get_requirements()
+    assert extracted.is_dir() == use_cache
+    assert_not_path_exists(str(tmpdir / 'cache' / 'extracted'))
+
+    for i in range(8):
+        assert_isfile(str(pkgs / 'pkg{}'.format(i) / '__init__.py'))
+    assert (pkgs / 'shared.txt').read_text('utf-8') == 'pkg7'
+    assert list(wg.got_distributions) == ['pkg{}'.format(i) for i in range(8)]
+
+def test_extract_cached(tmp_path):
+    whl_file = tmp_path / 'foo-1.0-py3-none-any.whl'
+    with ZipFile(str(whl_file), 'w') as zf:
+        zf.writestr('foo/__init__.py', b'')
+        zf.writestr('foo/tests/test_foo.py', b'')
+        zf.writestr('foo-1.0.data/purelib/bar.py', b'')
+
+    cache = ExtractedWheelCache(tmp_path / 'extracted')
+    for target in ['pkgs1', 'pkgs2']:
+        (tmp_path / target).mkdir()
+        extract_wheel(whl_file, tmp_path / target, cache=cache)
+        assert_isfile(tmp_path / target / 'foo' / '__init__.py')
+        assert_isfile(tmp_path / target / 'foo' / 'tests' / 'test_foo.py')
+        assert_isfile(tmp_path / target / 'bar.py')
+        assert_not_path_exists(tmp_path / target / 'foo-1.0.data')
+    assert len(os.listdir(str(tmp_path / 'extracted'))) == 1
+
+    # Different exclude patterns get a separate extracted tree
+    (tmp_path / 'pkgs3').mkdir()
+    extract_wheel(whl_file, tmp_path / 'pkgs3', cache=cache,
+                  exclude=['pkgs/foo/tests'])
+    assert_isfile(tmp_path / 'pkgs3' / 'foo' / '__init__.py')
+    assert_not_path_exists(tmp_path / 'pkgs3' / 'foo' / 'tests')
+    assert len(os.listdir(str(tmp_path / 'extracted'))) == 2
+
+    # Overwriting a materialised file doesn't change the cached copy
+    (tmp_path / 'pkgs4').mkdir()
+    (tmp_path / 'pkgs4' / 'bar.py').write_text('x = 1')
+    extract_wheel(whl_file, tmp_path / 'pkgs4', cache=cache)
+    assert (tmp_path / 'pkgs4' / 'bar.py').read_text() == ''
+
+def test_extract_data_overrides(tmp_path):
+    whl_file = tmp_path / 'foo-1.0-py3-none-any.whl'
+    with ZipFile(str(whl_file), 'w') as zf:
+        zf.writestr('foo/__init__.py', b'root')
+        zf.writestr('foo/root_only.py', b'root')
+        zf.writestr('foo-1.0.data/platlib/foo/__init__.py', b'platlib')
+        zf.writestr('foo-1.0.data/purelib/foo/__init__.py', b'purelib')
+        zf.writestr('foo-1.0.data/purelib/foo/pure_only.py', b'purelib')
+        zf.writestr('foo-1.0.data/scripts/foo.exe', b'')
+        zf.writestr('foo-1.0.dist-info/METADATA', b'')
+        zf.writestr('../escape.txt', b'')
+
+    pkgs = tmp_path / 'pkgs'
+    pkgs.mkdir()
+    (pkgs / 'existing.txt').write_bytes(b'')
+    extract_wheel(whl_file, pkgs)
+
+    assert sorted(os.listdir(str(pkgs))) == [
+        'escape.txt', 'existing.txt', 'foo', 'foo-1.0.dist-info'
+    ]
+    assert sorted(os.listdir(str(pkgs / 'foo'))) == [
+        '__init__.py', 'pure_only.py', 'root_only.py'
+    ]
+    assert (pkgs / 'foo' / '__init__.py').read_bytes() == b'platlib'
+    assert_not_path_exists(tmp_path / 'escape.txt')
+
+def test_extract_clash(tmp_path):
+    whl_file = tmp_path / 'foo-1.0-py3-none-any.whl'
+    with ZipFile(str(whl_file), 'w') as zf:
+        zf.writestr('foo/bar.py', b'')
+
+    pkgs = tmp_path / 'pkgs'
+    pkgs.mkdir()
+    (pkgs / 'foo').write_bytes(b'')
+    with pytest.raises(RuntimeError, match='clashes'):
+        extract_wheel(whl_file, pkgs)
+
+def test_extract_nothing(tmp_path):
+    whl_file = tmp_path / 'foo-1.0-py3-none-any.whl'
+    with ZipFile(str(whl_file), 'w') as zf:
+        zf.writestr('foo-1.0.data/scripts/foo.exe', b'')
+
+    with pytest.raises(RuntimeError, match='Did not find any files'):
+        extract_wheel(whl_file, tmp_path)
@@ -0,0 +1,118 @@
+import hashlib
+import json
+
+import pytest
+import responses
+from testpath import assert_isfile
+
+from nsist import main
+from nsist.lockfile import (
+    make_lock, read_lockfile, write_lockfile, LockfileError,
+)
+from nsist.wheels import WheelGetter
+
+from .conftest import make_wheel
+
+ASTSEARCH_WHL = make_wheel({'astsearch.py': b'', 'astsearch-0.1.2.dist-info/METADATA': b''})
+ASTSEARCH_URL = 'https://files.example/astsearch-0.1.2-py3-none-any.whl'
+
+def add_pypi_responses(rsps):
+    rsps.add('GET', 'https://pypi.org/pypi/astsearch/json', json={'releases': {
+        '0.1.2': [{
+            'filename': 'astsearch-0.1.2-py3-none-any.whl',
+            'url': ASTSEARCH_URL,
+            'packagetype': 'bdist_wheel',
+            'md5_digest': hashlib.md5(ASTSEARCH_WHL).hexdigest(),
+            'digests': {'sha256': hashlib.sha256(ASTSEARCH_WHL).hexdigest()},
+        }]
+    }})
+
+@pytest.fixture()
+def sources(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'extra').mkdir()
+    (tmp_path / 'extra' / 'foo-1.0-py3-none-any.whl').write_bytes(
+        make_wheel({'foo.py': b''}))
+    (tmp_path / 'local').mkdir()
+    (tmp_path / 'local' / 'bar-2.0-py3-none-any.whl').write_bytes(
+        make_wheel({'bar.py': b''}))
+    return tmp_path
+
+def builder_args(tmp_path):
+    return {
+        'py_version': '3.8.3', 'py_bitness': 64,
+        'pypi_wheel_reqs': ['astsearch==0.1.2', 'foo==1.0'],
+        'extra_wheel_sources': [tmp_path / 'extra'],
+        'local_wheels': ['local/*.whl'],
+    }
+
+def test_lock_and_build(sources):
+    with responses.RequestsMock() as rsps:
+        add_pypi_responses(rsps)
+        lock = make_lock(builder_args(sources))
+
+    astsearch, foo = lock['wheels']
+    assert astsearch['url'] == ASTSEARCH_URL
+    assert astsearch['sha256'] == hashlib.sha256(ASTSEARCH_WHL).hexdigest()
+    assert foo['url'] is None
+    assert foo['path'].endswith('foo-1.0-py3-none-any.whl')
+    assert [w['path'] for w in lock['local_wheels']] == ['local/bar-2.0-py3-none-any.whl']
+
+    write_lockfile('installer.lock.json', lock)
+    lock = read_lockfile('installer.lock.json')
+
+    # Building from the lockfile downloads by URL, with no metadata lookup
+    for target in ['pkgs1', 'pkgs2']:
+        (sources / target).mkdir()
+        wg = WheelGetter(['astsearch==0.1.2', 'foo==1.0'], ['local/*.whl'],
+                         str(sources / target), '3.8.3', 64, lock=lock)
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            rsps.add('GET', ASTSEARCH_URL, body=ASTSEARCH_WHL)
+            wg.get_all()
+            n_requests = len(rsps.calls)
+
+        for mod in ['astsearch.py', 'foo.py', 'bar.py']:
+            assert_isfile(sources / target / mod)
+        # The second time, the wheel is found in the cache by its hash
+        assert n_requests == (1 if target == 'pkgs1' else 0)
+
+def test_lock_hash_mismatch(sources):
+    with responses.RequestsMock() as rsps:
+        add_pypi_responses(rsps)
+        lock = make_lock(builder_args(sources))
+
+    (sources / 'local' / 'bar-2.0-py3-none-any.whl').write_bytes(b'changed')
+    wg = WheelGetter([], ['local/*.whl'], str(sources), '3.8.3', 64, lock=lock)
+    with pytest.raises(LockfileError, match='does not match'):
+        wg.get_globs()
+
+def test_lock_missing_requirement(sources):
+    with responses.RequestsMock() as rsps:
+        add_pypi_responses(rsps)
+        lock = make_lock(builder_args(sources))
+
+    wg = WheelGetter(['baz==1.0'], [], str(sources), '3.8.3', 64, lock=lock)
+    with pytest.raises(LockfileError, match='not in the lockfile'):
+        wg.get_requirements()
+
+    with pytest.raises(LockfileError, match='Python 3.8.3'):
+        WheelGetter([], [], str(sources), '3.9.0', 64, lock=lock)
+
+def test_lock_command(sources):
+    (sources / 'installer.cfg').write_text("""
+[Application]
+name=Lock test
+version=1.0
+entry_point=bar:main
+
+[Python]
+version=3.8.3
+bitness=64
+
+[Include]
+local_wheels=local/*.whl
+""")
+    assert main(['lock', str(sources / 'installer.cfg')]) == 0
+    with (sources / 'installer.lock.json').open() as f:
+        lock = json.load(f)
+    assert [w['path'] for w in lock['local_wheels']] == ['local/bar-2.0-py3-none-any.whl']
@@ -1,12 +1,18 @@
 from os.path import join as pjoin
 from pathlib import Path
 import pytest
+import responses
 from testpath import assert_isfile
 
 from nsist.wheels import (
     WheelLocator, extract_wheel, CachedRelease, merge_dir_to, NoWheelError,
     CompatibilityScorer,
 )
+from nsist.pypi import (
+    DEFAULT_METADATA_TTL, METADATA_TTL_ENV_VAR, PyPIMetadataCache, MetadataError,
+)
+from nsist.util import CACHE_ENV_VAR, CACHE_LAYERS_ENV_VAR, CACHE_PROMOTE_ENV_VAR
+from nsist.wheelindex import WheelIndex, parse_wheel_filename
 
 # To exclude tests requiring network on an unplugged machine, use: pytest -m "not network"
 
@@ -24,13 +30,13 @@ def test_download(tmpdir):
 @pytest.mark.network
 def test_bad_name():
     # Packages can't be named after stdlib modules like os
-    wl = WheelLocator("os==1.0", "3.5.1", 64)
+    wl = WheelLocator("os==1.0", CompatibilityScorer("3.5.1", "win_amd64"))
     with pytest.raises(NoWheelError):
         wl.get_from_pypi()
 
 @pytest.mark.network
 def test_bad_version():
-    wl = WheelLocator("pynsist==0.99.99", "3.5.1", 64)
+    wl = WheelLocator("pynsist==0.99.99", CompatibilityScorer("3.5.1", "win_amd64"))
     with pytest.raises(NoWheelError):
         wl.get_from_pypi()
 
@@ -163,3 +169,179 @@ def test_merge_dir_to(tmpdir):
         merge_dir_to(td2, td1)
     with pytest.raises(RuntimeError):
         merge_dir_to(td1, td2)
+
+def _project_json(*filenames):
+    return {'releases': {'0.1.2': [
+        {'filename': fn, 'url': 'https://files.example/' + fn,
+         'packagetype': 'bdist_wheel', 'md5_digest': 'abc',
+         'digests': {'sha256': 'def'}}
+        for fn in filenames
+    ]}}
+
+@responses.activate
+def test_metadata_cache(tmp_path):
+    url = 'https://pypi.org/pypi/astsearch/json'
+    responses.add('GET', url, json=_project_json('astsearch-0.1.2-py3-none-any.whl'),
+                  headers={'ETag': '"v1"'})
+    cache = PyPIMetadataCache(cache_dir=tmp_path, ttl=3600)
+
+    rels = cache.release_files('astsearch', '0.1.2')
+    assert [r.filename for r in rels] == ['astsearch-0.1.2-py3-none-any.whl']
+    assert rels[0].package_type == 'wheel'
+    assert rels[0].sha256_digest == 'def'
+    assert len(responses.calls) == 1
+
+    # Within the TTL, the cached metadata is used
+    cache.release_files('AstSearch', '0.1.2')
+    assert len(responses.calls) == 1
+
+    # A version we haven't seen forces a conditional request
+    responses.replace('GET', url, status=304)
+    assert cache.release_files('astsearch', '0.2.0') is None
+    assert len(responses.calls) == 2
+    assert responses.calls[1].request.headers['If-None-Match'] == '"v1"'
+
+@responses.activate
+def test_metadata_cache_expired(tmp_path):
+    url = 'https://pypi.org/pypi/astsearch/json'
+    responses.add('GET', url, json=_project_json('astsearch-0.1.2-py3-none-any.whl'),
+                  headers={'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+    cache = PyPIMetadataCache(cache_dir=tmp_path, ttl=0)
+    cache.release_files('astsearch', '0.1.2')
+
+    responses.replace('GET', url, json=_project_json(
+        'astsearch-0.1.2-py3-none-any.whl', 'astsearch-0.1.2-py3-none-win32.whl'
+    ))
+    rels = cache.release_files('astsearch', '0.1.2')
+    assert len(rels) == 2
+    assert responses.calls[1].request.headers['If-Modified-Since'] \
+        == 'Wed, 21 Oct 2015 07:28:00 GMT'
+
+@responses.activate
+def test_metadata_cache_offline(tmp_path):
+    responses.add('GET', 'https://pypi.org/pypi/astsearch/json',
+                  json=_project_json('astsearch-0.1.2-py3-none-any.whl'))
+    PyPIMetadataCache(cache_dir=tmp_path).release_files('astsearch', '0.1.2')
+
+    offline = PyPIMetadataCache(cache_dir=tmp_path, ttl=0, offline=True)
+    assert len(offline.release_files('astsearch', '0.1.2')) == 1
+    with pytest.raises(MetadataError, match='offline'):
+        offline.release_files('pynsist', '2.8')
+    assert len(responses.calls) == 1
+
+@responses.activate
+def test_metadata_cache_not_found(tmp_path):
+    responses.add('GET', 'https://pypi.org/pypi/os/json', status=404)
+    scorer = CompatibilityScorer("3.8.0", "win_amd64")
+    wl = WheelLocator("os==1.0", scorer,
+                      indexes=[PyPIMetadataCache(cache_dir=tmp_path)])
+    with pytest.raises(NoWheelError, match='No package named os'):
+        wl.get_from_pypi()
+
+def test_extra_sources_indexed(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'astsearch-0.1.2-py3-none-any.whl').touch()
+    (src / 'astsearch-0.1.3-py3-none-any.whl').touch()
+    (src / 'Foo_Bar-1.0-cp38-cp38-win_amd64.whl').touch()
+    (src / 'README.txt').touch()
+    index = WheelIndex(tmp_path / 'index.sqlite3')
+    scorer = CompatibilityScorer("3.8.0", "win_amd64")
+
+    wl = WheelLocator("astsearch==0.1.2", scorer, extra_sources=[src], index=index)
+    assert wl.check_extra_sources() == src / 'astsearch-0.1.2-py3-none-any.whl'
+
+    # Names are compared after normalization
+    wl = WheelLocator("foo-bar==1.0", scorer, extra_sources=[src], index=index)
+    assert wl.check_extra_sources() == src / 'Foo_Bar-1.0-cp38-cp38-win_amd64.whl'
+    assert index.find(src, 'FOO.bar', '1.0') == [
+        ('Foo_Bar-1.0-cp38-cp38-win_amd64.whl', ('cp38', 'cp38', 'win_amd64'))
+    ]
+
+    # Changes to the directory are picked up
+    (src / 'astsearch-0.1.2-py3-none-any.whl').unlink()
+    (src / 'astsearch-0.1.2-py3-none-win_amd64.whl').touch()
+    wl = WheelLocator("astsearch==0.1.2", scorer, extra_sources=[src], index=index)
+    assert wl.check_extra_sources() == src / 'astsearch-0.1.2-py3-none-win_amd64.whl'
+
+    # Missing directories are skipped
+    wl = WheelLocator("astsearch==0.1.2", scorer, index=index,
+                      extra_sources=[tmp_path / 'missing', src])
+    assert wl.check_extra_sources() == src / 'astsearch-0.1.2-py3-none-win_amd64.whl'
+
+def test_wheel_index_incremental(tmp_path, monkeypatch):
+    from nsist import wheelindex
+    src = tmp_path / 'src'
+    src.mkdir()
+    for i in range(10):
+        (src / 'pkg{}-1.0-py3-none-any.whl'.format(i)).touch()
+    index = WheelIndex(tmp_path / 'index.sqlite3')
+    assert len(index.find(src, 'pkg0', '1.0')) == 1
+
+    parsed = []
+    def parse(filename):
+        parsed.append(filename)
+        return parse_wheel_filename(filename)
+    monkeypatch.setattr(wheelindex, 'parse_wheel_filename', parse)
+
+    # Only the changes are parsed and stored
+    (src / 'pkg0-1.0-py3-none-any.whl').unlink()
+    (src / 'new-2.0-py3-none-any.whl').touch()
+    assert index.find(src, 'new', '2.0') == [
+        ('new-2.0-py3-none-any.whl', ('py3', 'none', 'any'))
+    ]
+    assert index.find(src, 'pkg0', '1.0') == []
+    assert len(index.find(src, 'pkg9', '1.0')) == 1
+    assert parsed == ['new-2.0-py3-none-any.whl']
+
+def test_check_cache_layers(tmp_path, monkeypatch):
+    local, shared = tmp_path / 'local', tmp_path / 'shared'
+    monkeypatch.setenv(CACHE_ENV_VAR, str(local))
+    monkeypatch.setenv(CACHE_LAYERS_ENV_VAR, str(shared))
+    release_dir = shared / 'pypi' / 'astsearch' / '0.1.2'
+    release_dir.mkdir(parents=True)
+    (release_dir / 'astsearch-0.1.2-py3-none-any.whl').write_bytes(b'whl')
+    scorer = CompatibilityScorer("3.8.0", "win_amd64")
+
+    wl = WheelLocator("astsearch==0.1.2", scorer)
+    assert wl.check_cache() == release_dir / 'astsearch-0.1.2-py3-none-any.whl'
+    assert WheelLocator("astsearch==0.1.3", scorer).check_cache() is None
+
+    # Promoted to the local cache if requested
+    monkeypatch.setenv(CACHE_PROMOTE_ENV_VAR, '1')
+    promoted = local / 'pypi' / 'astsearch' / '0.1.2' / 'astsearch-0.1.2-py3-none-any.whl'
+    assert wl.check_cache() == promoted
+    assert promoted.read_bytes() == b'whl'
+
+def test_wheel_index_shared_and_corrupt(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'astsearch-0.1.2-py3-none-any.whl').touch()
+    expected = [('astsearch-0.1.2-py3-none-any.whl', ('py3', 'none', 'any'))]
+
+    # Two builds sharing one index database
+    db = tmp_path / 'index.sqlite3'
+    index1, index2 = WheelIndex(db), WheelIndex(db)
+    assert index1.find(src, 'astsearch', '0.1.2') == expected
+    assert index2.find(src, 'astsearch', '0.1.2') == expected
+    index1.close()
+    index2.close()
+
+    # A corrupt database falls back to listing the directory
+    bad = tmp_path / 'bad.sqlite3'
+    bad.write_bytes(b'this is not a database' * 100)
+    index = WheelIndex(bad)
+    assert index.find(src, 'astsearch', '0.1.2') == expected
+    assert index.find(tmp_path / 'missing', 'astsearch', '0.1.2') == []
+
+@pytest.mark.parametrize('value, expected', [
+    ('60', 60), ('0', 0), ('', DEFAULT_METADATA_TTL),
+    ('1 day', DEFAULT_METADATA_TTL), ('-5', DEFAULT_METADATA_TTL),
+    ('nan', DEFAULT_METADATA_TTL),
+])
+def test_metadata_ttl_env(tmp_path, monkeypatch, caplog, value, expected):
+    monkeypatch.setenv(METADATA_TTL_ENV_VAR, value)
+    assert PyPIMetadataCache(cache_dir=tmp_path).ttl == expected
+    warned = METADATA_TTL_ENV_VAR in caplog.text
+    assert warned is (value != '' and expected == DEFAULT_METADATA_TTL)
+
@@ -0,0 +1,85 @@
+import io
+import os
+import re
+from zipfile import ZipFile, ZIP_STORED
+
+import pytest
+import responses
+
+from nsist.pypi import RemoteRelease
+from nsist.remotezip import RemoteZipFile, RangeRequestsNotSupported
+from nsist.wheels import WheelLocator, CompatibilityScorer
+
+URL = 'https://example.com/files/big-1.0-py3-none-any.whl'
+
+def make_big_wheel():
+    buf = io.BytesIO()
+    with ZipFile(buf, 'w', ZIP_STORED) as zf:
+        zf.writestr('big/__init__.py', b'')
+        zf.writestr('big/blob.bin', os.urandom(3 * 1024 * 1024))
+        for i in range(200):
+            zf.writestr('big/mod{}.py'.format(i), b'x = %d\n' % i)
+        zf.writestr('big-1.0.dist-info/METADATA', b'Name: big\nVersion: 1.0\n')
+    return buf.getvalue()
+
+WHL = make_big_wheel()
+
+def serve_ranges(data):
+    def callback(req):
+        if 'Range' not in req.headers:
+            return 200, {}, data
+        start, end = re.match(r'bytes=(\d*)-(\d*)', req.headers['Range']).groups()
+        if not start:
+            start, end = max(len(data) - int(end), 0), len(data) - 1
+        else:
+            start, end = int(start), min(int(end or len(data) - 1), len(data) - 1)
+        return 206, {'Content-Range': 'bytes {}-{}/{}'.format(
+            start, end, len(data))}, data[start:end + 1]
+    return callback
+
+def test_read_member():
+    with responses.RequestsMock() as rsps:
+        rsps.add_callback('GET', URL, callback=serve_ranges(WHL))
+        with RemoteZipFile(URL) as zf:
+            assert len(zf.namelist()) == 203
+            assert zf.read('big-1.0.dist-info/METADATA').startswith(b'Name: big')
+            assert zf.bytes_fetched < len(WHL) / 5
+
+            # Members spanning several blocks are read correctly
+            with ZipFile(io.BytesIO(WHL)) as local_zf:
+                assert zf.read('big/blob.bin') == local_zf.read('big/blob.bin')
+
+def make_small_zip():
+    buf = io.BytesIO()
+    with ZipFile(buf, 'w') as zf:
+        zf.writestr('a.txt', b'abc')
+    return buf.getvalue()
+
+def test_small_file():
+    data = make_small_zip()
+    with responses.RequestsMock() as rsps:
+        rsps.add_callback('GET', URL, callback=serve_ranges(data))
+        with RemoteZipFile(URL) as zf:
+            assert zf.read('a.txt') == b'abc'
+        # The first request got the whole file
+        assert len(rsps.calls) == 1
+
+def test_no_range_support():
+    with responses.RequestsMock() as rsps:
+        rsps.add('GET', URL, body=WHL)
+        with pytest.raises(RangeRequestsNotSupported):
+            RemoteZipFile(URL)
+
+class FakeIndex:
+    offline = False
+
+    def release_files(self, name, version):
+        return [RemoteRelease('big-1.0-py3-none-any.whl', URL, 'wheel')]
+
+def test_open_remote_wheel():
+    wl = WheelLocator('big==1.0', CompatibilityScorer('3.8.0', 'win_amd64'),
+                      indexes=[FakeIndex()])
+    with responses.RequestsMock() as rsps:
+        rsps.add_callback('GET', URL, callback=serve_ranges(WHL))
+        with wl.open_remote_wheel() as zf:
+            assert 'big/mod199.py' in zf.namelist()
@@ -0,0 +1,146 @@
+import hashlib
+import json
+
+import pytest
+from testpath import assert_isfile
+
+from nsist.lockfile import LockfileError, make_lock
+from nsist.pypi import SimpleIndex, SIMPLE_JSON_TYPE
+from nsist.resolver import (
+    Resolver, ResolutionError, marker_environment, requires_dist,
+)
+from nsist.wheels import CompatibilityScorer, WheelGetter
+
+from .conftest import make_wheel
+from .test_indexes import IndexServer
+
+SCORER = CompatibilityScorer('3.8.0', 'win_amd64')
+
+def metadata(name, version, *requires):
+    lines = ['Metadata-Version: 2.1', 'Name: ' + name, 'Version: ' + version]
+    lines += ['Requires-Dist: ' + r for r in requires]
+    return '\n'.join(lines) + '\n'
+
+def test_requires_dist_markers():
+    text = metadata('app', '1.0',
+        'dep (>=1.0)',
+        'colorama; sys_platform == "win32"',
+        'uvloop; sys_platform != "win32"',
+        'typing-extensions; python_version < "3.8"',
+        'pysocks; extra == "socks"',
+        'wmi; platform_machine == "AMD64"',
+    )
+    names = [r.name for r in requires_dist(text, set(),
+                                           marker_environment('3.7.9', 64))]
+    assert names == ['dep', 'colorama', 'typing-extensions', 'wmi']
+
+    names = [r.name for r in requires_dist(text, {'socks'},
+                                           marker_environment('3.8.0', 32))]
+    assert names == ['dep', 'colorama', 'pysocks']
+
+@pytest.fixture()
+def server():
+    s = IndexServer()
+    packages = {
+        # (name, version): (requirements, serve .metadata separately)
+        ('app', '1.0'): (['dep (>=1.0)'], True),
+        ('app', '2.0'): (['dep (>=1.5)', 'win-only; sys_platform == "win32"',
+                          'other[extra]'], True),
+        ('dep', '1.0'): ([], False),
+        ('dep', '1.5'): ([], False),
+        ('dep', '2.0b1'): ([], False),
+        ('win-only', '1.0'): ([], False),
+        ('other', '1.0'): (['dep (<2)', 'extradep; extra == "extra"'], True),
+        # The index gives the wrong hash for this metadata file
+        ('extradep', '3.0'): ([], 'corrupt'),
+    }
+    for (name, version), (requires, has_metadata) in packages.items():
+        fn = '{}-{}-py3-none-any.whl'.format(name.replace('-', '_'), version)
+        md = metadata(name, version, *requires).encode()
+        whl = make_wheel({
+            name.replace('-', '_') + '.py': b'',
+            '{}-{}.dist-info/METADATA'.format(name.replace('-', '_'), version): md,
+        })
+        s.routes['/files/' + fn] = ('application/octet-stream', whl)
+        if has_metadata:
+            s.routes['/files/' + fn + '.metadata'] = ('text/plain', md)
+        page = s.routes.setdefault('/simple/{}/'.format(name), [])
+        md_hash = hashlib.sha256(md if has_metadata is True else b'').hexdigest()
+        page.append({'filename': fn, 'url': '/files/' + fn, 'hashes': {},
+                     'core-metadata': bool(has_metadata) and {'sha256': md_hash}})
+
+    for path, files in list(s.routes.items()):
+        if path.startswith('/simple/'):
+            s.routes[path] = (SIMPLE_JSON_TYPE, json.dumps(
+                {'meta': {'api-version': '1.0'}, 'files': files}).encode())
+    yield s
+    s.stop()
+
+def test_resolve(server, tmp_path, monkeypatch):
+    index = SimpleIndex(server.url + '/simple', cache_dir=tmp_path / 'ix')
+    # Candidate versions are checked without reloading the cached page for
+    # each one; release_files is only used to find the chosen wheels.
+    looked_up = []
+    real_release_files = index.release_files
+    def release_files(name, version):
+        looked_up.append((name, version))
+        return real_release_files(name, version)
+    monkeypatch.setattr(index, 'release_files', release_files)
+    resolver = Resolver(SCORER, [index], '3.8.0', 64)
+    assert resolver.resolve(['app']) == [
+        'app==2.0', 'dep==1.5', 'win-only==1.0', 'other==1.0', 'extradep==3.0'
+    ]
+    assert ('app', '1.0') not in looked_up
+    assert ('dep', '1.0') not in looked_up
+
+    paths = [p for (p, _, _) in server.requests]
+    # Metadata came from .metadata files where the index offered them
+    assert '/files/app-2.0-py3-none-any.whl.metadata' in paths
+    assert '/files/app-2.0-py3-none-any.whl' not in paths
+    assert '/files/dep-1.5-py3-none-any.whl' in paths
+    # A metadata file not matching its hash is discarded
+    assert '/files/extradep-3.0-py3-none-any.whl.metadata' in paths
+    assert '/files/extradep-3.0-py3-none-any.whl' in paths
+    metadata_dir = tmp_path / 'cache' / 'metadata'
+    assert sorted(p.name for p in metadata_dir.glob('*.metadata')) == [
+        'app-2.0-py3-none-any.whl.metadata', 'other-1.0-py3-none-any.whl.metadata'
+    ]
+
+def test_resolve_pinned(server, tmp_path):
+    index = SimpleIndex(server.url + '/simple', cache_dir=tmp_path / 'ix')
+    resolver = Resolver(SCORER, [index], '3.8.0', 64)
+    assert resolver.resolve(['app==1.0', 'dep==1.0']) == ['app==1.0', 'dep==1.0']
+
+def test_resolve_conflict(server, tmp_path):
+    index = SimpleIndex(server.url + '/simple', cache_dir=tmp_path / 'ix')
+    resolver = Resolver(SCORER, [index], '3.8.0', 64)
+    with pytest.raises(ResolutionError, match='dep'):
+        resolver.resolve(['app==2.0', 'dep==1.0'])
+
+def test_wheelgetter_resolve(server, tmp_path):
+    pkgs = tmp_path / 'pkgs'
+    pkgs.mkdir()
+    wg = WheelGetter(['app==1.0'], [], str(pkgs), '3.8.0', 64,
+                     index_urls=[server.url + '/simple'], resolve=True)
+    wg.get_all()
+    assert_isfile(pkgs / 'app.py')
+    assert_isfile(pkgs / 'dep.py')
+    assert set(wg.got_distributions) == {'app', 'dep'}
+
+def test_lock_resolved(server, tmp_path):
+    lock = make_lock({'pypi_wheel_reqs': ['app==1.0'], 'py_version': '3.8.0', 'py_bitness': 64,
+                      'index_urls': [server.url + '/simple'],
+                      'resolve_dependencies': True})
+    assert [w['filename'] for w in lock['wheels']] == [
+        'app-1.0-py3-none-any.whl', 'dep-1.5-py3-none-any.whl'
+    ]
+
+    pkgs = tmp_path / 'pkgs'
+    pkgs.mkdir()
+    WheelGetter(['app==1.0'], [], str(pkgs), '3.8.0', 64, lock=lock,
+                resolve=True).get_all()
+    assert_isfile(pkgs / 'dep.py')
+
+    with pytest.raises(LockfileError):
+        WheelGetter(['app==2.0'], [], str(pkgs), '3.8.0', 64, lock=lock,
+                    resolve=True).get_all()
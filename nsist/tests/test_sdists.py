@@ -0,0 +1,105 @@
+import io
+import tarfile
+
+import pytest
+from testpath import assert_not_path_exists
+
+from nsist.hashing import sidecar_path
+from nsist.pypi import SimpleIndex
+from nsist.sdists import SdistBuilder, SdistBuildError, build_wheel
+from nsist.wheels import CompatibilityScorer, NoWheelError, WheelLocator
+
+from .conftest import make_wheel
+from .test_indexes import IndexServer
+
+SCORER = CompatibilityScorer('3.8.0', 'win_amd64')
+
+def make_sdist(name='foo', version='1.0'):
+    files = {
+        'pyproject.toml': (
+            '[build-system]\nrequires = ["setuptools>=61"]\n'
+            'build-backend = "setuptools.build_meta"\n\n'
+            '[project]\nname = "{}"\nversion = "{}"\n'.format(name, version)
+        ),
+        '{}.py'.format(name): 'x = 1\n',
+        'PKG-INFO': 'Metadata-Version: 2.1\nName: {}\nVersion: {}\n'.format(
+            name, version),
+    }
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tf:
+        for path, content in files.items():
+            data = content.encode()
+            info = tarfile.TarInfo('{}-{}/{}'.format(name, version, path))
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+class FakeBuilder(SdistBuilder):
+    """Copies a prepared wheel instead of running pip"""
+    def __init__(self, wheel_name, **kwargs):
+        super().__init__(**kwargs)
+        self.wheel_name = wheel_name
+        self.builds = 0
+
+    def _build(self, sdist_path, wheel_dir):
+        self.builds += 1
+        (wheel_dir / self.wheel_name).write_bytes(make_wheel({'foo.py': b''}))
+        return self.wheel_name
+
+@pytest.fixture()
+def index(tmp_path):
+    s = IndexServer()
+    s.routes['/files/foo-1.0.tar.gz'] = ('application/octet-stream', make_sdist())
+    s.routes['/simple/foo/'] = ('text/html', b"""<html>
+    <a href="/files/foo-1.0.tar.gz">foo-1.0.tar.gz</a></html>""")
+    yield SimpleIndex(s.url + '/simple', cache_dir=tmp_path / 'ix')
+    s.stop()
+
+def test_build_from_sdist(index):
+    builder = FakeBuilder('foo-1.0-py3-none-any.whl')
+    wl = WheelLocator('foo==1.0', SCORER, indexes=[index], sdist_builder=builder)
+    whl = wl.fetch()
+    assert whl.name == 'foo-1.0-py3-none-any.whl'
+    assert whl.parent.parent.name == 'built-wheels'
+
+    # The built wheel is cached
+    assert wl.fetch() == whl
+    assert builder.builds == 1
+
+    # Without a builder, there's no wheel to use
+    with pytest.raises(NoWheelError):
+        WheelLocator('foo==1.0', SCORER, indexes=[index]).fetch()
+
+def test_reject_compiled(index):
+    builder = FakeBuilder('foo-1.0-cp38-cp38-linux_x86_64.whl')
+    wl = WheelLocator('foo==1.0', SCORER, indexes=[index], sdist_builder=builder)
+    with pytest.raises(SdistBuildError, match='compiled'):
+        wl.fetch()
+
+@pytest.mark.network
+def test_build_wheel(tmp_path):
+    sdist = tmp_path / 'foo-1.0.tar.gz'
+    sdist.write_bytes(make_sdist())
+    (tmp_path / 'out').mkdir()
+    assert build_wheel(str(sdist), str(tmp_path / 'out')) == 'foo-1.0-py3-none-any.whl'
+
+def test_sdist_hash_mismatch(tmp_path):
+    s = IndexServer()
+    s.routes['/files/foo-1.0.tar.gz'] = ('application/octet-stream', make_sdist())
+    s.routes['/simple/foo/'] = ('text/html', """<html>
+    <a href="/files/foo-1.0.tar.gz#sha256={}">foo-1.0.tar.gz</a></html>"""
+                                .format('0' * 64).encode())
+    index = SimpleIndex(s.url + '/simple', cache_dir=tmp_path / 'ix')
+    builder = FakeBuilder('foo-1.0-py3-none-any.whl')
+    wl = WheelLocator('foo==1.0', SCORER, indexes=[index], sdist_builder=builder)
+    try:
+        with pytest.raises(ValueError, match='corrupted'):
+            wl.fetch()
+    finally:
+        s.stop()
+
+    # Neither the sdist nor its hash record are left in the cache
+    sdist = tmp_path / 'cache' / 'pypi' / 'foo' / '1.0' / 'foo-1.0.tar.gz'
+    assert_not_path_exists(sdist)
+    assert_not_path_exists(sidecar_path(sdist))
+    assert builder.builds == 0
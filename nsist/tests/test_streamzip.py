@@ -0,0 +1,100 @@
+import io
+import os
+import zipfile
+
+import pytest
+from testpath import assert_isfile
+
+from nsist.pypi import SimpleIndex
+from nsist.streamzip import StreamingZipReader
+from nsist.wheels import ExtractedWheelCache, WheelLocator
+
+from .test_indexes import IndexServer, SCORER
+
+FILES = {
+    'foo/__init__.py': b'import foo.bar\n' * 100,
+    'foo/bar.py': os.urandom(100000),
+    'foo/empty.py': b'',
+    'foo-1.0.data/purelib/foo/extra.py': b'x = 1\n',
+    'foo-1.0.dist-info/METADATA': b'Name: foo\nVersion: 1.0\n',
+}
+
+class Unseekable(io.RawIOBase):
+    """Forces zipfile to write data descriptors"""
+    def __init__(self):
+        self.buf = io.BytesIO()
+    def writable(self):
+        return True
+    def write(self, b):
+        return self.buf.write(b)
+
+def make_zip(compression, unseekable=False, zip64=False):
+    out = Unseekable() if unseekable else io.BytesIO()
+    with zipfile.ZipFile(out, 'w', compression=compression) as zf:
+        for name, data in FILES.items():
+            with zf.open(name, 'w', force_zip64=zip64) as f:
+                f.write(data)
+    return (out.buf if unseekable else out).getvalue()
+
+def stream(data, chunk_size):
+    got = {}
+    def open_member(name):
+        got[name] = io.BytesIO()
+        got[name].close = lambda: None
+        return got[name]
+    reader = StreamingZipReader(open_member)
+    for i in range(0, len(data), chunk_size):
+        reader.feed(data[i:i + chunk_size])
+    return reader, {k: v.getvalue() for k, v in got.items()}
+
+@pytest.mark.parametrize('compression', [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+@pytest.mark.parametrize('unseekable', [False, True])
+@pytest.mark.parametrize('zip64', [False, True])
+def test_stream_members(compression, unseekable, zip64):
+    if unseekable and compression == zipfile.ZIP_STORED:
+        pytest.skip("zipfile can't write stored members to unseekable files")
+    data = make_zip(compression, unseekable, zip64)
+    for chunk_size in (7, 4096, len(data)):
+        reader, got = stream(data, chunk_size)
+        assert reader.done and not reader.failed
+        assert got == FILES
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            assert {m.name: (m.crc, m.size) for m in reader.members} == \
+                {z.filename: (z.CRC, z.file_size) for z in zf.infolist()}
+
+def test_stream_garbage():
+    reader, got = stream(b'this is not a zip file', 4)
+    assert reader.failed and not reader.done
+    assert got == {}
+
+@pytest.fixture()
+def index(tmp_path):
+    s = IndexServer()
+    s.routes['/files/foo-1.0-py3-none-any.whl'] = (
+        'application/octet-stream', make_zip(zipfile.ZIP_DEFLATED, unseekable=True))
+    s.routes['/simple/foo/'] = ('text/html', b"""<html>
+    <a href="/files/foo-1.0-py3-none-any.whl">foo-1.0-py3-none-any.whl</a></html>""")
+    yield SimpleIndex(s.url + '/simple', cache_dir=tmp_path / 'ix')
+    s.stop()
+
+def test_extract_while_downloading(index, tmp_path):
+    cache = ExtractedWheelCache(tmp_path / 'extracted')
+    stream = cache.streaming_extractor(exclude=['pkgs/foo/empty.py'])
+    wl = WheelLocator('foo==1.0', SCORER, indexes=[index])
+    whl = wl.fetch(trackers=(stream,))
+    stream.finish(whl)
+
+    # Everything except the excluded file came from the stream
+    assert stream.streamed_count == 4
+    tree = cache.cache_dir / cache.key(whl, ['pkgs/foo/empty.py'])
+    assert (tree / 'foo' / 'bar.py').read_bytes() == FILES['foo/bar.py']
+    assert_isfile(tree / 'foo' / 'extra.py')
+    assert not (tree / 'foo' / 'empty.py').exists()
+    assert not (tree / 'foo-1.0.data').exists()
+    # Only the finished tree is left in the cache
+    assert os.listdir(str(cache.cache_dir)) == [tree.name]
+
+    # Already cached: nothing is streamed
+    stream = cache.streaming_extractor()
+    stream.finish(wl.fetch(trackers=(stream,)))
+    assert stream.streamed_count == 0
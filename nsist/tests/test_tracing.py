@@ -0,0 +1,72 @@
+import sys
+
+import pytest
+from testpath import assert_isfile, assert_not_path_exists
+
+from nsist import tracing
+from nsist.tracing import prune_to_profile, run_traced
+
+from .test_treeshake import make_tree
+
+FILES = {
+    'app/__init__.py': 'import importlib\n'
+                       'importlib.import_module("lib." + "dynamic")\n',
+    'app/data/used.txt': 'x',
+    'app/data/unused.txt': 'x' * 100,
+    'app/unused.py': '',
+    'lib/__init__.py': '',
+    'lib/dynamic.py': 'import os\n'
+                      'open(os.path.join(os.path.dirname(__file__), '
+                      '"..", "app", "data", "used.txt")).close()\n',
+    'lib/fast.pyd': '',
+    'lib/tests/__init__.py': '',
+    'lib/tests/test_it.py': '',
+    'lib-1.0.dist-info/METADATA': '',
+    'top_mod.py': '',
+}
+
+def test_trace_and_prune(tmp_path):
+    pkgs = tmp_path / 'pkgs'
+    make_tree(pkgs, FILES)
+    returncode, files = run_traced(str(pkgs), [sys.executable, '-c', 'import app'],
+                                   cwd=str(tmp_path))
+    assert returncode == 0
+    assert files == {'app/__init__.py', 'app/data/used.txt',
+                     'lib/__init__.py', 'lib/dynamic.py'}
+    assert_not_path_exists(str(pkgs / 'app' / '__pycache__'))
+
+    profile = {'top_level': ['app', 'lib', 'lib-1.0.dist-info', 'top_mod.py'],
+               'files': sorted(files)}
+    (pkgs / 'newpkg').mkdir()
+    (pkgs / 'newpkg' / 'mod.py').write_text('')
+    report = prune_to_profile(str(pkgs), profile)
+
+    for kept in list(files) + ['lib/fast.pyd', 'lib-1.0.dist-info/METADATA',
+                               'newpkg/mod.py']:
+        assert_isfile(str(pkgs / kept))
+    for removed in ['app/data/unused.txt', 'app/unused.py', 'lib/tests',
+                    'top_mod.py']:
+        assert_not_path_exists(str(pkgs / removed))
+    assert report.bytes_by_package['app'] == 100
+    assert report.size_before['app'] > 100
+
+def test_trace_with_other_sitecustomize(tmp_path, monkeypatch):
+    pkgs = tmp_path / 'pkgs'
+    make_tree(pkgs, FILES)
+    site_dir = tmp_path / 'site'
+    site_dir.mkdir()
+    (site_dir / 'sitecustomize.py').write_text('import builtins, top_mod\n'
+                                               'builtins.CUSTOMIZED = True\n')
+    monkeypatch.setenv('PYTHONPATH', str(site_dir))
+    returncode, files = run_traced(
+        str(pkgs), [sys.executable, '-c', 'import builtins; assert CUSTOMIZED'],
+        cwd=str(tmp_path))
+    # The hidden sitecustomize ran, and its imports were recorded
+    assert returncode == 0
+    assert files == {'top_mod.py'}
+
+def test_trace_needs_py38(monkeypatch, capsys):
+    monkeypatch.setattr(tracing.sys, 'version_info', (3, 7, 9))
+    with pytest.raises(SystemExit):
+        tracing.main(['installer.cfg', '--', 'python', '-c', 'pass'])
+    assert 'Python 3.8' in capsys.readouterr().err
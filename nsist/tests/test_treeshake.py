@@ -0,0 +1,91 @@
+import ast
+
+from testpath import assert_isfile, assert_not_path_exists
+
+from nsist import treeshake
+from nsist.treeshake import find_imports, prune_unused_modules
+
+def make_tree(root, files):
+    for path, content in files.items():
+        p = root / path
+        p.parent.mkdir(parents=True, exist_ok=True)
+        p.write_text(content)
+
+FILES = {
+    'app/__init__.py': '',
+    'app/main.py': 'from . import util\nfrom .sub import thing\n'
+                   'import lib.core\n',
+    'app/util.py': 'import importlib\n'
+                   'def f():\n    importlib.import_module("lib.lazy")\n',
+    'app/unused.py': 'import bigpkg\n',
+    'app/sub/__init__.py': 'from .. import util\n',
+    'app/sub/thing.py': '',
+    'lib/__init__.py': '',
+    'lib/core.py': 'from .fast import x\n',
+    'lib/lazy.py': '',
+    'lib/fast.pyd': '',
+    'lib/helper.py': '',
+    'lib/tests/__init__.py': '',
+    'lib/tests/test_core.py': 'import lib.core\n',
+    'bigpkg/__init__.py': 'from bigpkg.a import *\n',
+    'bigpkg/a.py': '',
+    'bigpkg/data.json': '{}',
+    'plugins/__init__.py': '',
+    'plugins/one.py': 'import lib.helper\n',
+    'top_mod.py': '',
+    'foo-1.0.dist-info/METADATA': '',
+}
+
+def test_find_imports(tmp_path):
+    make_tree(tmp_path, FILES)
+    assert find_imports(str(tmp_path / 'app' / 'main.py')) == [
+        ('', 1, ['util']), ('sub', 1, ['thing']), ('lib.core', 0, None),
+    ]
+    (tmp_path / 'bad.py').write_text('def (')
+    assert find_imports(str(tmp_path / 'bad.py')) is None
+
+def test_prune(tmp_path):
+    make_tree(tmp_path, FILES)
+    report = prune_unused_modules(str(tmp_path), ['app.main'],
+                                  keep=['plugins.*'])
+
+    for kept in ['app/main.py', 'app/util.py', 'app/sub/__init__.py',
+                 'app/sub/thing.py', 'lib/core.py', 'lib/lazy.py',
+                 'lib/fast.pyd', 'plugins/__init__.py', 'plugins/one.py',
+                 'foo-1.0.dist-info/METADATA']:
+        assert_isfile(str(tmp_path / kept))
+    # lib.helper is a sibling of an extension module, and imported by a plugin
+    assert_isfile(str(tmp_path / 'lib' / 'helper.py'))
+
+    assert_not_path_exists(str(tmp_path / 'app' / 'unused.py'))
+    assert_not_path_exists(str(tmp_path / 'bigpkg'))
+    assert_not_path_exists(str(tmp_path / 'lib' / 'tests'))
+    assert_not_path_exists(str(tmp_path / 'top_mod.py'))
+
+    assert sorted(report.removed) == [
+        'app/unused.py', 'bigpkg', 'lib/tests', 'top_mod.py']
+    assert report.bytes_by_package['bigpkg'] == len(
+        FILES['bigpkg/__init__.py'] + FILES['bigpkg/data.json'])
+    assert report.total_bytes == sum(len(FILES[f]) for f in [
+        'app/unused.py', 'bigpkg/__init__.py', 'bigpkg/a.py',
+        'bigpkg/data.json', 'lib/tests/__init__.py', 'lib/tests/test_core.py'])
+
+def test_prune_parallel(tmp_path):
+    files = {'app.py': 'import big\n', 'big/__init__.py': ''}
+    for i in range(100):
+        files['big/__init__.py'] += 'from . import m{}\n'.format(i)
+        files['big/m{}.py'.format(i)] = ''
+        files['unused/m{}.py'.format(i)] = ''
+    make_tree(tmp_path, files)
+    report = prune_unused_modules(str(tmp_path), ['app'], jobs=2)
+    assert_isfile(str(tmp_path / 'big' / 'm99.py'))
+    assert len(report.removed) == 100
+
+def test_const_str_py37(monkeypatch):
+    class Str(ast.AST):
+        _fields = ('s',)
+    monkeypatch.setattr(treeshake, '_Str', Str)
+    # Python 3.6 and 3.7 give string literals as ast.Str nodes
+    assert treeshake._const_str(Str(s='lib.lazy')) == 'lib.lazy'
+    assert treeshake._const_str(ast.Constant(value='lib.lazy')) == 'lib.lazy'
+    assert treeshake._const_str(ast.Constant(value=1)) is None
@@ -0,0 +1,125 @@
+import hashlib
+import threading
+
+import pytest
+import requests
+import responses
+from requests_download import HashTracker
+from testpath import assert_isfile, assert_not_path_exists
+
+from nsist.util import (
+    CACHE_ENV_VAR, download, migrate_wheel_cache, wheel_cache_dir,
+)
+
+URL = 'https://example.com/python-3.8.3-embed-amd64.zip'
+DATA = bytes(range(256)) * 100
+
+def test_download(tmp_path):
+    target = tmp_path / 'python.zip'
+    with responses.RequestsMock() as rsps:
+        rsps.add('GET', URL, body=DATA)
+        download(URL, target)
+
+    assert target.read_bytes() == DATA
+    assert_not_path_exists(tmp_path / 'python.zip.part')
+
+def test_download_resume(tmp_path):
+    target = tmp_path / 'python.zip'
+    (tmp_path / 'python.zip.part').write_bytes(DATA[:1000])
+
+    def respond_range(req):
+        assert req.headers['Range'] == 'bytes=1000-'
+        return 206, {'Content-Range': 'bytes 1000-{}/{}'.format(
+            len(DATA) - 1, len(DATA))}, DATA[1000:]
+
+    hasher = HashTracker(hashlib.sha256())
+    with responses.RequestsMock() as rsps:
+        rsps.add_callback('GET', URL, callback=respond_range)
+        download(URL, target, trackers=(hasher,))
+
+    assert target.read_bytes() == DATA
+    assert hasher.hashobj.hexdigest() == hashlib.sha256(DATA).hexdigest()
+
+def test_download_resume_ignored(tmp_path):
+    # The server sends the whole file instead of the requested range
+    target = tmp_path / 'python.zip'
+    (tmp_path / 'python.zip.part').write_bytes(b'garbage')
+
+    with responses.RequestsMock() as rsps:
+        rsps.add('GET', URL, body=DATA)
+        rsps.add('GET', URL, body=DATA)
+        download(URL, target)
+
+    assert target.read_bytes() == DATA
+
+def test_download_interrupted(tmp_path):
+    target = tmp_path / 'python.zip'
+    with responses.RequestsMock() as rsps:
+        rsps.add('GET', URL, body=requests.ConnectionError('Network down'))
+        with pytest.raises(requests.ConnectionError):
+            download(URL, target)
+
+    assert_not_path_exists(target)
+
+def test_download_concurrent(tmp_path):
+    target = tmp_path / 'python.zip'
+    errors = []
+
+    def fetch():
+        try:
+            download(URL, target)
+        except Exception as e:
+            errors.append(e)
+
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+        rsps.add('GET', URL, body=DATA)
+        threads = [threading.Thread(target=fetch) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(rsps.calls) == 1
+
+    assert not errors
+    assert_isfile(target)
+
+def test_wheel_cache_migration(tmp_path, monkeypatch):
+    monkeypatch.setenv(CACHE_ENV_VAR, str(tmp_path))
+    for name, fn in [('PyQt5', 'PyQt5-5.15.4-cp36-abi3-win_amd64.whl'),
+                     ('pyqt5', 'PyQt5-5.15.4-cp36-abi3-win32.whl'),
+                     ('PyQt_5', 'PyQt5-5.15.4-cp36-abi3-win32.whl')]:
+        d = tmp_path / 'pypi' / name / '5.15.4'
+        d.mkdir(parents=True)
+        (d / fn).write_bytes(name.encode())
+
+    d = wheel_cache_dir('PyQt5', '5.15.4')
+    assert d == tmp_path / 'pypi' / 'pyqt5' / '5.15.4'
+    assert sorted(p.name for p in d.iterdir()) == [
+        'PyQt5-5.15.4-cp36-abi3-win32.whl', 'PyQt5-5.15.4-cp36-abi3-win_amd64.whl'
+    ]
+    assert sorted(p.name for p in (tmp_path / 'pypi').iterdir()) == [
+        '.normalized-names', 'pyqt-5', 'pyqt5'
+    ]
+    assert wheel_cache_dir('PyQt_5', '5.15.4') == tmp_path / 'pypi' / 'pyqt-5' / '5.15.4'
+
+def test_wheel_cache_migration_case_insensitive(tmp_path, monkeypatch):
+    import os
+    d = tmp_path / 'pypi' / 'PyQt5' / '5.15.4'
+    d.mkdir(parents=True)
+    (d / 'PyQt5-5.15.4-cp36-abi3-win32.whl').write_bytes(b'whl')
+    # Simulate a case-insensitive filesystem: 'pyqt5' is the same directory,
+    # and stops existing once 'PyQt5' is renamed.
+    (tmp_path / 'pypi' / 'pyqt5').symlink_to('PyQt5')
+    real_rename = os.rename
+    def rename(src, dst):
+        if os.path.islink(dst):
+            os.unlink(dst)
+        real_rename(src, dst)
+    monkeypatch.setattr(os, 'rename', rename)
+
+    migrate_wheel_cache(tmp_path)
+    assert [p.name for p in (tmp_path / 'pypi' / 'pyqt5' / '5.15.4').iterdir()] \
+        == ['PyQt5-5.15.4-cp36-abi3-win32.whl']
+    assert sorted(p.name for p in (tmp_path / 'pypi').iterdir()) == [
+        '.normalized-names', 'pyqt5'
+    ]
@@ -0,0 +1,291 @@
+"""Record which files in pkgs/ an application uses, and remove the rest
+
+``pynsist trace installer.cfg -- python -m pytest tests`` collects the
+packages for an installer, as a build would, and runs the command with the
+collected ``pkgs`` directory at the start of ``sys.path``, ahead of the
+script's directory. An audit hook
+(:pep:`578`) in every Python process the command starts records the modules
+imported and the files opened from ``pkgs``. These are saved as a profile,
+``installer.trace.json``.
+
+The hook is loaded as a ``sitecustomize`` module, so the command must run on
+Python 3.8 or above. Any other ``sitecustomize`` on the path is run after it.
+
+Builds with ``prune_profile = installer.trace.json`` then remove Python
+modules and package data files which aren't in the profile. Extension
+modules, DLLs and package metadata are always kept, as the command runs on
+the build machine, which can't load compiled code built for Windows.
+"""
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+
+from .treeshake import PruneReport, _module_name_for_file
+
+logger = logging.getLogger(__name__)
+
+PROFILE_VERSION = 1
+# Files with these suffixes are never removed
+NEVER_PRUNE_SUFFIXES = ('.pyd', '.so', '.dll', '.pth')
+
+# Runs at startup in each traced process, as sitecustomize
+HOOK_SOURCE = '''\
+import os, sys
+
+if not hasattr(sys, 'addaudithook'):
+    # Exit rather than let the command run without recording anything
+    sys.stderr.write('pynsist trace: Python %d.%d has no audit hooks; run the '
+                     'command with Python 3.8 or above\\n' % sys.version_info[:2])
+    sys.stderr.flush()
+    os._exit(1)
+
+_pkgs = os.environ['PYNSIST_TRACE_PKGS'] + os.sep
+_out = open(os.path.join(os.environ['PYNSIST_TRACE_DIR'],
+                         'trace-%d.txt' % os.getpid()), 'a', buffering=1)
+_seen = set()
+
+def _record(path):
+    path = os.path.abspath(path)
+    if path.startswith(_pkgs) and path not in _seen:
+        _seen.add(path)
+        _out.write(path + '\\n')
+
+def _hook(event, args):
+    if event == 'open' and isinstance(args[0], (str, bytes, os.PathLike)):
+        _record(os.fsdecode(args[0]))
+
+def _record_modules():
+    # Modules imported before the hook was installed
+    for mod in list(sys.modules.values()):
+        path = getattr(mod, '__file__', None)
+        if isinstance(path, str):
+            _record(path)
+
+class _PkgsFirst:
+    # The script's directory goes before pkgs on sys.path, and may contain
+    # the application's source; import top-level modules from pkgs instead.
+    @staticmethod
+    def find_spec(name, path=None, target=None):
+        if path is None:
+            from importlib.machinery import PathFinder
+            return PathFinder.find_spec(name, [_pkgs[:-1]])
+
+def _run_hidden_sitecustomize():
+    # This module hides any other sitecustomize on sys.path, so run that too
+    from importlib.machinery import PathFinder
+    from importlib.util import module_from_spec
+    here = os.path.dirname(os.path.abspath(__file__))
+    path = [p for p in sys.path if os.path.abspath(p or '.') != here]
+    spec = PathFinder.find_spec('sitecustomize', path)
+    if spec is not None:
+        mod = module_from_spec(spec)
+        sys.modules['sitecustomize'] = mod
+        spec.loader.exec_module(mod)
+
+sys.meta_path.insert(0, _PkgsFirst)
+sys.addaudithook(_hook)
+import atexit
+atexit.register(_record_modules)
+_run_hidden_sitecustomize()
+'''
+
+
+def profile_path(config_file):
+    """Get the profile path for a config file, e.g. installer.trace.json"""
+    return os.path.splitext(config_file)[0] + '.trace.json'
+
+
+def read_profile(path):
+    with open(path, encoding='utf-8') as f:
+        profile = json.load(f)
+    if profile.get('pynsist_trace_profile') != PROFILE_VERSION:
+        raise ValueError('{} is not a trace profile from this version of '
+                         'Pynsist'.format(path))
+    return profile
+
+
+def write_profile(path, profile):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(profile, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def run_traced(pkgs_dir, command, cwd=None):
+    """Run command with pkgs_dir on sys.path, recording the files it uses
+
+    Returns (returncode, files), where files is a set of paths relative to
+    pkgs_dir, with '/' separators.
+    """
+    pkgs_dir = os.path.abspath(pkgs_dir)
+    with TemporaryDirectory(prefix='pynsist-trace-') as td:
+        hook_dir = os.path.join(td, 'hook')
+        out_dir = os.path.join(td, 'out')
+        os.mkdir(hook_dir)
+        os.mkdir(out_dir)
+        with open(os.path.join(hook_dir, 'sitecustomize.py'), 'w') as f:
+            f.write(HOOK_SOURCE)
+
+        env = os.environ.copy()
+        path = [hook_dir, pkgs_dir]
+        if env.get('PYTHONPATH'):
+            path.append(env['PYTHONPATH'])
+        env.update({
+            'PYTHONPATH': os.pathsep.join(path),
+            # Don't write __pycache__ directories into pkgs
+            'PYTHONDONTWRITEBYTECODE': '1',
+            'PYNSIST_TRACE_PKGS': pkgs_dir,
+            'PYNSIST_TRACE_DIR': out_dir,
+        })
+        returncode = subprocess.call(command, cwd=cwd, env=env)
+
+        files = set()
+        for fn in os.listdir(out_dir):
+            with open(os.path.join(out_dir, fn), encoding='utf-8') as f:
+                for line in f:
+                    path = line.rstrip('\n')
+                    if os.path.isfile(path):
+                        rel = os.path.relpath(path, pkgs_dir)
+                        files.add(rel.replace(os.sep, '/'))
+    return returncode, files
+
+
+def _prunable(relpath):
+    """Can this file be removed if it's not in the profile?
+
+    Only Python modules and data files in packages are removed.
+    """
+    parts = relpath.split('/')
+    if relpath.endswith(NEVER_PRUNE_SUFFIXES):
+        return False
+    if len(parts) == 1:
+        return _module_name_for_file(parts[0]) is not None
+    # Skip directories like foo-1.0.dist-info or numpy.libs
+    return parts[0].isidentifier()
+
+
+def prune_to_profile(pkgs_dir, profile):
+    """Remove files in pkgs_dir which weren't used when the profile was made
+
+    Top-level packages which weren't there when the profile was recorded are
+    left alone. Package __init__.py files are kept if anything in the package
+    is kept. Returns a :class:`nsist.treeshake.PruneReport`.
+    """
+    keep = set(profile['files'])
+    traced_top_level = set(profile['top_level'])
+    report = PruneReport()
+
+    candidates = []  # (relpath, path) of files to remove
+    live_dirs = set()  # Directories with files we're keeping
+    inits = []
+    for dirpath, dirnames, filenames in os.walk(pkgs_dir):
+        reldir = os.path.relpath(dirpath, pkgs_dir).replace(os.sep, '/')
+        reldir = '' if reldir == '.' else reldir + '/'
+        if not reldir:
+            new = [n for n in dirnames + filenames if n not in traced_top_level]
+            if new:
+                logger.warning('Not pruning %s, which were not in pkgs when '
+                               'the profile was recorded', ', '.join(sorted(new)))
+            dirnames[:] = [d for d in dirnames if d in traced_top_level]
+            filenames = [f for f in filenames if f in traced_top_level]
+        for fn in filenames:
+            relpath = reldir + fn
+            path = os.path.join(dirpath, fn)
+            top = relpath.split('/')[0]
+            top = _module_name_for_file(top) or top
+            size = os.path.getsize(path)
+            report.size_before[top] = report.size_before.get(top, 0) + size
+            if relpath in keep or not _prunable(relpath):
+                live_dirs.add(reldir)
+            elif fn == '__init__.py':
+                inits.append((relpath, path))
+            else:
+                candidates.append((relpath, path))
+
+    # Directories containing a live directory are also live
+    for d in list(live_dirs):
+        parts = d.rstrip('/').split('/')
+        live_dirs.update('/'.join(parts[:i]) + '/' for i in range(1, len(parts)))
+    candidates.extend((relpath, path) for (relpath, path) in inits
+                      if relpath[:-len('__init__.py')] not in live_dirs)
+
+    for relpath, path in sorted(candidates):
+        report.add(pkgs_dir, path)
+        os.unlink(path)
+
+    # Clear out directories left empty
+    for dirpath, dirnames, filenames in os.walk(pkgs_dir, topdown=False):
+        if dirpath != pkgs_dir and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+    return report
+
+
+def main(argv=None):
+    """Record the files an application uses from its packages"""
+    import argparse
+    from . import InstallerBuilder, read_config_args
+    from .lockfile import lockfile_path
+    argp = argparse.ArgumentParser(
+        prog='pynsist trace',
+        usage='pynsist trace [options] config_file -- command ...',
+    )
+    argp.add_argument('config_file')
+    argp.add_argument('command', nargs=argparse.REMAINDER,
+        help='The command to run, e.g. a smoke test or test suite.'
+    )
+    argp.add_argument('-o', '--output',
+        help='Profile file to write (default: <config>.trace.json)'
+    )
+    argp.add_argument('--merge', action='store_true',
+        help='Add to the existing profile, e.g. to trace several commands.'
+    )
+    options = argp.parse_args(argv)
+    if sys.version_info < (3, 8):
+        argp.error('Tracing needs audit hooks, which were added in Python 3.8; '
+                   'run pynsist trace with a newer Python')
+    command = options.command
+    if command and command[0] == '--':
+        command = command[1:]
+    if not command:
+        argp.error('No command given to trace')
+
+    output = os.path.abspath(options.output) if options.output else None
+    config_file, args = read_config_args(options.config_file)
+    output = output or os.path.abspath(profile_path(config_file))
+    # Collect the packages without removing any
+    args.update(prune_modules=False, prune_profile=None)
+    lockfile = lockfile_path(config_file)
+    if not os.path.isfile(lockfile):
+        lockfile = None
+    builder = InstallerBuilder(**args, lockfile=lockfile)
+
+    shutil.rmtree(builder.build_dir, ignore_errors=True)
+    os.makedirs(builder.build_dir)
+    builder.prepare_packages()
+    pkgs_dir = os.path.join(builder.build_dir, 'pkgs')
+
+    logger.info('Running %s', ' '.join(command))
+    returncode, files = run_traced(pkgs_dir, command)
+    if returncode != 0:
+        logger.error('Command failed (exit code %d); not writing profile',
+                     returncode)
+        return 1
+
+    profile = {
+        'pynsist_trace_profile': PROFILE_VERSION,
+        'commands': [command],
+        'top_level': sorted(os.listdir(pkgs_dir)),
+        'files': sorted(files),
+    }
+    if options.merge and os.path.isfile(output):
+        old = read_profile(output)
+        profile['commands'] = old['commands'] + profile['commands']
+        profile['top_level'] = sorted(set(old['top_level'] + profile['top_level']))
+        profile['files'] = sorted(set(old['files']).union(files))
+    write_profile(output, profile)
+    logger.info('Recorded %d files used from pkgs in %s',
+                len(profile['files']), output)
+    return 0
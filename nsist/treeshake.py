@@ -0,0 +1,336 @@
+"""Remove modules from the build directory which the application never imports
+
+Starting from the modules used by shortcuts and commands, we follow ``import``
+statements (found by parsing the source with :mod:`ast`) through the modules
+in ``pkgs/``. Modules which can't be reached this way are deleted.
+
+This can't see imports which are made dynamically, e.g. by plugin systems,
+or from compiled code. Modules which are imported like this can be listed as
+``keep_modules``. As a precaution, modules (but not subpackages) in the same
+package as a reachable extension module are kept, as extension modules often
+import their siblings.
+"""
+import ast
+import fnmatch
+import logging
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+EXTENSION_SUFFIXES = ('.pyd', '.so')
+# Imported by the site module at startup if they exist
+STARTUP_MODULES = ('sitecustomize', 'usercustomize')
+# Parsing fewer files than this in other processes isn't worth the overhead
+PARALLEL_MIN_FILES = 32
+
+
+class ModuleInfo(object):
+    """A module found in the pkgs directory"""
+    def __init__(self, name, path, is_package=False):
+        self.name = name
+        self.path = path  # The .py or extension file (__init__.py for packages)
+        self.is_package = is_package
+
+    @property
+    def is_extension(self):
+        return self.path.endswith(EXTENSION_SUFFIXES)
+
+    @property
+    def package(self):
+        """The package relative imports in this module are relative to"""
+        return self.name if self.is_package else self.name.rpartition('.')[0]
+
+
+def _module_name_for_file(filename):
+    """Get a module name from a filename, or None"""
+    if filename.endswith('.py'):
+        name = filename[:-3]
+    elif filename.endswith(EXTENSION_SUFFIXES):
+        # e.g. foo.cp38-win_amd64.pyd
+        name = filename.split('.', 1)[0]
+    else:
+        return None
+    return name if name.isidentifier() else None
+
+
+def scan_modules(pkgs_dir):
+    """Find the importable modules in a directory
+
+    Returns a dict of module name to :class:`ModuleInfo`. Directories without
+    an __init__.py are treated as namespace packages.
+    """
+    modules = {}
+    stack = [(pkgs_dir, '')]
+    while stack:
+        directory, prefix = stack.pop()
+        with os.scandir(directory) as it:
+            entries = list(it)
+        for entry in entries:
+            if entry.is_dir():
+                if entry.name.isidentifier():
+                    stack.append((entry.path, prefix + entry.name + '.'))
+                continue
+            name = _module_name_for_file(entry.name)
+            if name is None:
+                continue
+            if name == '__init__' and prefix:
+                pkg_name = prefix[:-1]
+                modules[pkg_name] = ModuleInfo(pkg_name, entry.path, True)
+            elif name != '__init__':
+                modules.setdefault(prefix + name, ModuleInfo(prefix + name,
+                                                             entry.path))
+    return modules
+
+
+# Before Python 3.8, string literals are parsed as ast.Str, not ast.Constant
+_Str = ast.Str if sys.version_info < (3, 8) else None
+
+def _const_str(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if _Str is not None and isinstance(node, _Str):
+        return node.s
+    return None
+
+
+def find_imports(path):
+    """Find the imports in a Python source file
+
+    Returns a list of (module, level, names) tuples. names is None for
+    'import x' statements, or a list of names for 'from x import a, b'.
+    Calls to importlib.import_module() and __import__() with constant
+    arguments are included. Returns None if the file can't be parsed.
+    """
+    try:
+        with open(path, 'rb') as f:
+            tree = ast.parse(f.read(), filename=path)
+    except (SyntaxError, ValueError, OSError):
+        return None
+
+    imports = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                imports.append((alias.name, 0, None))
+        elif isinstance(node, ast.ImportFrom):
+            imports.append((node.module or '', node.level,
+                            [alias.name for alias in node.names]))
+        elif isinstance(node, ast.Call) and node.args:
+            func = node.func
+            func_name = func.attr if isinstance(func, ast.Attribute) else \
+                getattr(func, 'id', None)
+            if func_name not in ('import_module', '__import__'):
+                continue
+            target = _const_str(node.args[0])
+            if target is None:
+                continue
+            level = len(target) - len(target.lstrip('.'))
+            imports.append((target[level:], level, None))
+    return imports
+
+
+def _absolute_name(module, level, info):
+    """Resolve a possibly relative import inside the module info"""
+    if level == 0:
+        return module
+    base = info.package.split('.') if info.package else []
+    if level > 1:
+        base = base[:-(level - 1)]
+    return '.'.join(base + ([module] if module else []))
+
+
+def _with_parents(name):
+    """'a.b.c' -> ['a', 'a.b', 'a.b.c']"""
+    parts = name.split('.')
+    return ['.'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+
+class ImportGraph(object):
+    """Follow imports through the modules in a pkgs directory
+
+    :param dict modules: From :func:`scan_modules`
+    :param int jobs: How many processes to use for parsing files
+    """
+    def __init__(self, modules, jobs=1):
+        self.modules = modules
+        self.jobs = jobs
+        # Module name -> list of names it imports, for modules seen so far
+        self.imports = {}
+
+    def _submodules(self, package, packages=True):
+        """List the direct submodules of a package
+
+        If packages is False, subpackages are left out.
+        """
+        prefix = package + '.'
+        return [n for n, info in self.modules.items()
+                if n.startswith(prefix) and '.' not in n[len(prefix):]
+                and (packages or not info.is_package)]
+
+    def _parse_all(self, infos, pool):
+        sources = [i for i in infos if not i.is_extension]
+        paths = [i.path for i in sources]
+        if pool is not None and len(sources) >= PARALLEL_MIN_FILES:
+            results = pool.map(find_imports, paths, chunksize=16)
+        else:
+            results = map(find_imports, paths)
+        return dict(zip((i.name for i in sources), results))
+
+    def _resolve(self, info, raw_imports):
+        """Turn the imports found in one module into module names"""
+        if info.is_extension:
+            # We can't see what compiled code imports; assume its siblings
+            if not info.package:
+                return []
+            return self._submodules(info.package, packages=False)
+        if raw_imports is None:
+            logger.warning("Couldn't parse %s; keeping all modules in its "
+                           "package", info.path)
+            top = info.name.split('.')[0]
+            return [n for n in self.modules
+                    if n == top or n.startswith(top + '.')]
+
+        names = []
+        for module, level, fromlist in raw_imports:
+            base = _absolute_name(module, level, info)
+            if base:
+                names.extend(_with_parents(base))
+            for name in fromlist or []:
+                if name == '*':
+                    names.extend(self._submodules(base))
+                elif base:
+                    names.append(base + '.' + name)
+                else:
+                    names.append(name)
+        return names
+
+    def reachable(self, roots):
+        """Find all the modules reachable from the root module names"""
+        seen = set()
+        frontier = []
+
+        def add(name):
+            for n in _with_parents(name):
+                if n in self.modules and n not in seen:
+                    seen.add(n)
+                    frontier.append(self.modules[n])
+
+        for root in roots:
+            add(root)
+        pool = ProcessPoolExecutor(max_workers=self.jobs) if self.jobs > 1 \
+            else None
+        try:
+            # Parse each 'layer' of newly found modules together
+            while frontier:
+                infos, frontier = frontier, []
+                parsed = self._parse_all(infos, pool)
+                for info in infos:
+                    names = self._resolve(info, parsed.get(info.name))
+                    self.imports[info.name] = names
+                    for name in names:
+                        add(name)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return seen
+
+
+class PruneReport(object):
+    """What was removed by :func:`prune_unused_modules`
+
+    Also used by :func:`nsist.tracing.prune_to_profile`.
+    """
+    def __init__(self):
+        self.removed = []  # Paths relative to the pkgs directory
+        self.bytes_by_package = {}
+        # Sizes of packages before pruning, if known
+        self.size_before = {}
+
+    @property
+    def total_bytes(self):
+        return sum(self.bytes_by_package.values())
+
+    def add(self, pkgs_dir, path):
+        size = 0
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                for fn in filenames:
+                    size += os.path.getsize(os.path.join(dirpath, fn))
+        else:
+            size = os.path.getsize(path)
+        relpath = os.path.relpath(path, pkgs_dir).replace(os.sep, '/')
+        top = relpath.split('/')[0]
+        top = _module_name_for_file(top) or top
+        self.removed.append(relpath)
+        self.bytes_by_package[top] = self.bytes_by_package.get(top, 0) + size
+
+    def log(self):
+        from .cache import format_size
+        for pkg, size in sorted(self.bytes_by_package.items(),
+                                key=lambda x: -x[1]):
+            before = self.size_before.get(pkg)
+            if before:
+                logger.info('  %-30s %10s of %10s (%.0f%%)', pkg,
+                            format_size(size), format_size(before),
+                            100 * size / before)
+            else:
+                logger.info('  %-30s %10s', pkg, format_size(size))
+        logger.info('Removed %d unused modules, packages and files, saving %s',
+                    len(self.removed), format_size(self.total_bytes))
+
+
+def entry_point_modules(entry_points):
+    """Get module names from 'module:function' entry points"""
+    return [ep.split(':')[0].strip() for ep in entry_points]
+
+
+def script_imports(paths):
+    """Get the absolute imports from scripts, e.g. launchers or preambles"""
+    names = []
+    for path in paths:
+        for module, level, fromlist in find_imports(path) or []:
+            if level == 0 and module:
+                names.append(module)
+                names.extend(module + '.' + n for n in fromlist or []
+                             if n != '*')
+    return names
+
+
+def prune_unused_modules(pkgs_dir, roots, keep=(), jobs=1):
+    """Delete modules in pkgs_dir which can't be reached from roots
+
+    roots are module names. keep is a list of module names or glob patterns
+    (like ``pkg.plugins.*``) for modules which are imported in ways we can't
+    see; they are kept along with everything they import. Files which aren't
+    Python modules are left alone, unless their package is removed.
+
+    Returns a :class:`PruneReport`.
+    """
+    modules = scan_modules(pkgs_dir)
+    roots = list(roots) + [m for m in STARTUP_MODULES if m in modules]
+    for pattern in keep:
+        roots.extend(fnmatch.filter(modules, pattern))
+
+    graph = ImportGraph(modules, jobs=jobs)
+    reachable = graph.reachable(roots)
+
+    report = PruneReport()
+    removed_packages = []
+    for name in sorted(modules):
+        if name in reachable:
+            continue
+        if any(name.startswith(p + '.') for p in removed_packages):
+            continue  # Already removed with its package
+        info = modules[name]
+        if info.is_package:
+            path = os.path.dirname(info.path)
+            report.add(pkgs_dir, path)
+            shutil.rmtree(path)
+            removed_packages.append(name)
+        else:
+            report.add(pkgs_dir, info.path)
+            os.unlink(info.path)
+    return report
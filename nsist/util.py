@@ -1,31 +1,160 @@
+import hashlib
 import os
+import re
 import logging
 from pathlib import Path
 import requests
+import requests.adapters
+import shutil
 import sys
+from requests_download import HashTracker
+
+from .hashing import sidecar_path, verify_cached_file, write_sidecar
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
 
 logger = logging.getLogger(__name__)
 
 
-def download(url, target):
+_session = None
+
+def get_session():
+    """Get a requests Session shared by all downloads and index lookups
+
+    This keeps connections open, so repeated requests to the same host don't
+    each need a new connection.
+    """
+    global _session
+    if _session is None:
+        s = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=8,
+                                                pool_maxsize=32)
+        s.mount('https://', adapter)
+        s.mount('http://', adapter)
+        _session = s
+    return _session
+
+
+class FileLock(object):
+    """An exclusive lock on a file, which works between processes
+
+    Use as a context manager; entering it waits until the lock is available.
+    The lock file is left in place afterwards.
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        self._f = None
+
+    def __enter__(self):
+        self._f = open(self.path, 'a+b')
+        if os.name == 'nt':
+            # LK_LOCK gives up after 10 seconds, so keep trying
+            while True:
+                try:
+                    msvcrt.locking(self._f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        else:
+            fcntl.flock(self._f.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if os.name == 'nt':
+            self._f.seek(0)
+            msvcrt.locking(self._f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+        self._f.close()
+        self._f = None
+
+
+def _feed_trackers(path, trackers):
+    """Pass the contents of an existing file to download trackers"""
+    with open(str(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            for t in trackers:
+                t.on_chunk(chunk)
+
+
+def download(url, target, headers=None, trackers=()):
     """Download a file using requests.
     
     This is like urllib.request.urlretrieve, but requests validates SSL
     certificates by default.
+
+    Data is written to ``<target>.part`` and renamed to target when it is
+    complete, so target never contains a partial download. An interrupted
+    download is resumed using an HTTP Range request. While downloading, we
+    hold a lock on ``<target>.lock``, so concurrent builds sharing a cache wait
+    for one download instead of repeating it.
+
+    trackers are objects like those from :mod:`requests_download`, with
+    ``on_start``, ``on_chunk`` and ``on_finish`` methods. They see the whole
+    file, even if part of it was downloaded earlier.
+
+    The sha256 hash of the file is recorded beside it, to check it when it's
+    used from the cache (see :mod:`nsist.hashing`).
     """
-    if isinstance(target, Path):
-        target = str(target)
+    target = Path(target)
+    part = target.with_name(target.name + '.part')
 
     from . import __version__
-    headers = {'user-agent': 'Pynsist/'+__version__}
-    r = requests.get(url, headers=headers, stream=True)
-    r.raise_for_status()
-    with open(target, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024): 
-            if chunk:
-                f.write(chunk)
+    headers = dict(headers or {})
+    headers.setdefault('user-agent', 'Pynsist/'+__version__)
+
+    sha256 = HashTracker(hashlib.sha256())
+    trackers = tuple(trackers) + (sha256,)
+
+    with FileLock(target.with_name(target.name + '.lock')):
+        if target.is_file():
+            # Another process downloaded it while we waited for the lock
+            logger.info('Downloaded by another process: %s', target)
+            _feed_trackers(target, trackers)
+            for t in trackers:
+                t.on_finish()
+            return
+
+        offset = part.stat().st_size if part.is_file() else 0
+        if offset:
+            logger.info('Resuming download from byte %d', offset)
+            r = get_session().get(url, stream=True,
+                    headers=dict(headers, Range='bytes=%d-' % offset))
+            content_range = r.headers.get('Content-Range', '')
+            if not (r.status_code == 206 and
+                    content_range.startswith('bytes %d-' % offset)):
+                # The server didn't resume where we asked: start again
+                r.close()
+                offset = 0
+        if not offset:
+            r = get_session().get(url, headers=headers, stream=True)
+        r.raise_for_status()
+
+        for t in trackers:
+            t.on_start(r)
+        if offset:
+            _feed_trackers(part, trackers)
+
+        with part.open('ab' if offset else 'wb') as f:
+            for chunk in r.iter_content(chunk_size=65536):
+                if chunk:
+                    f.write(chunk)
+                    for t in trackers:
+                        t.on_chunk(chunk)
+
+        for t in trackers:
+            t.on_finish()
+        os.replace(str(part), str(target))
+        write_sidecar(target, sha256.hashobj.hexdigest())
 
 CACHE_ENV_VAR = 'PYNSIST_CACHE_DIR'
+# Extra read-only cache directories, separated by os.pathsep
+CACHE_LAYERS_ENV_VAR = 'PYNSIST_CACHE_LAYERS'
+# If set, files found in read-only layers are copied to the local cache
+CACHE_PROMOTE_ENV_VAR = 'PYNSIST_CACHE_PROMOTE'
 
 def get_cache_dir(ensure_existence=False):
     specified = os.environ.get(CACHE_ENV_VAR, None)
@@ -56,6 +185,145 @@ def get_cache_dir(ensure_existence=False):
     return p
 
 
+def get_cache_layers():
+    """Get the cache directories to look in, in priority order
+
+    The first is the writable cache from :func:`get_cache_dir`, where new
+    downloads go. Any others, from the ``PYNSIST_CACHE_LAYERS`` environment
+    variable, are shared caches which we only read from.
+    """
+    layers = [get_cache_dir()]
+    for d in os.environ.get(CACHE_LAYERS_ENV_VAR, '').split(os.pathsep):
+        if d and Path(d) not in layers:
+            layers.append(Path(d))
+    return layers
+
+
+def find_in_cache(relpath):
+    """Find a file in the cache layers, by its path relative to a cache root
+
+    Returns a Path in the first layer which has it, or None.
+    """
+    for layer in get_cache_layers():
+        p = layer / relpath
+        if p.is_file():
+            hit = cached_file_hit(p, layer)
+            if hit is not None:
+                return hit
+    return None
+
+
+def cached_file_hit(path, layer):
+    """Use a file found in a cache layer, promoting it if configured
+
+    The file is checked against its hash record (see :mod:`nsist.hashing`).
+    If it is corrupted, this returns None, and the file is deleted if it's in
+    the local cache.
+
+    If the file is from a read-only layer and ``PYNSIST_CACHE_PROMOTE`` is set,
+    it's copied to the same place in the local cache, and that path returned.
+    """
+    local = get_cache_dir()
+    path = Path(path)
+    if not verify_cached_file(path, writable=(layer == local)):
+        return None
+    if layer == local or not os.environ.get(CACHE_PROMOTE_ENV_VAR):
+        return path
+
+    dst = local / path.relative_to(layer)
+    src_stat = path.stat()
+    try:
+        dst_stat = dst.stat()
+        # copy2 keeps the modification time, so this means we promoted it
+        up_to_date = (dst_stat.st_size, dst_stat.st_mtime_ns) == \
+                     (src_stat.st_size, src_stat.st_mtime_ns)
+    except FileNotFoundError:
+        up_to_date = False
+    if not up_to_date:
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dst.with_name(dst.name + '.promote-%d' % os.getpid())
+        shutil.copy2(str(path), str(tmp))
+        os.replace(str(tmp), str(dst))
+        if sidecar_path(path).is_file():
+            # The record stays valid, as copy2 keeps the modification time
+            shutil.copy2(str(sidecar_path(path)), str(sidecar_path(dst)))
+        logger.info('Copied %s from shared cache %s', dst.name, layer)
+    return dst
+
+
+_migrated_caches = set()
+
+def wheel_cache_dir(name, version, cache_dir=None):
+    """Get the cache directory for one release's wheels: pypi/<name>/<version>
+
+    The name is normalized as in PEP 503, so every spelling of it shares one
+    directory. cache_dir defaults to the local cache; a cache layered below it
+    may be given instead.
+    """
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+        if cache_dir not in _migrated_caches:
+            migrate_wheel_cache(cache_dir)
+            _migrated_caches.add(cache_dir)
+    return Path(cache_dir, 'pypi', canonical_name(name), version)
+
+
+def migrate_wheel_cache(cache_dir):
+    """Move wheels cached under unnormalized names to the normalized layout
+
+    Older versions used the name as written in the requirement, so e.g.
+    'PyQt5' and 'pyqt5' were cached separately. This runs once per cache,
+    leaving a marker file when it's done.
+    """
+    pypi_dir = Path(cache_dir, 'pypi')
+    marker = pypi_dir / '.normalized-names'
+    if marker.exists() or not pypi_dir.is_dir():
+        return
+
+    with FileLock(Path(cache_dir, 'pypi-migrate.lock')):
+        if marker.exists():
+            return  # Another process did it while we waited
+        for name_dir in list(pypi_dir.iterdir()):
+            normed = canonical_name(name_dir.name)
+            if normed == name_dir.name or not name_dir.is_dir():
+                continue
+            logger.info('Moving cached wheels from %s to %s', name_dir.name, normed)
+            _merge_move(name_dir, pypi_dir / normed)
+        marker.touch()
+
+
+def _merge_move(src, dst):
+    """Move the contents of directory src into dst, then remove src
+
+    Files already present in dst are kept, and the copy in src discarded.
+    """
+    if dst.exists() and os.path.samefile(str(src), str(dst)):
+        # On a case-insensitive filesystem, only the case of the name differs.
+        # Merging would find every file already 'there' and delete it.
+        tmp = src.with_name(src.name + '.renaming')
+        os.rename(str(src), str(tmp))
+        os.rename(str(tmp), str(dst))
+        return
+    dst.mkdir(parents=True, exist_ok=True)
+    for p in src.iterdir():
+        target = dst / p.name
+        if p.is_dir():
+            _merge_move(p, target)
+        elif target.exists():
+            p.unlink()
+        else:
+            os.replace(str(p), str(target))
+    src.rmdir()
+
+
 def normalize_path(path):
     """Normalize paths to contain "/" only"""
     return os.path.normpath(path).replace('\\', '/')
+
+
+def canonical_name(name):
+    """Normalize a distribution name as described in PEP 503
+
+    e.g. 'PyQt_5' -> 'pyqt-5'
+    """
+    return re.sub(r'[-_.]+', '-', name).lower()
@@ -0,0 +1,177 @@
+"""Index the wheel files in local directories, so we don't list them repeatedly
+
+The index is an SQLite database in the cache directory. A directory is only
+listed again when its modification time changes, and then only the wheels
+added or removed since the last listing are updated in the index.
+"""
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from .util import canonical_name, get_cache_dir
+
+logger = logging.getLogger(__name__)
+
+_wheel_file_re = re.compile(
+    r'^(?P<name>[^-]+)-(?P<version>[^-]+)(?:-\d[^-]*)?'
+    r'-(?P<interpreter>[^-]+)-(?P<abi>[^-]+)-(?P<platform>[^-]+)\.whl$'
+)
+
+# If a directory was modified this recently, files could still be added
+# without changing its mtime (on filesystems with coarse timestamps), so we
+# don't record the mtime and scan it again next time.
+_RACY_INTERVAL = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS wheels (
+    directory TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    interpreter TEXT NOT NULL,
+    abi TEXT NOT NULL,
+    platform TEXT NOT NULL,
+    PRIMARY KEY (directory, filename)
+);
+CREATE INDEX IF NOT EXISTS wheels_by_name
+    ON wheels (directory, name, version);
+"""
+
+
+def parse_wheel_filename(filename):
+    """Split a wheel filename into (name, version, (interpreter, abi, platform))
+
+    The name is normalized as in PEP 503. Returns None if filename doesn't look
+    like a wheel.
+    """
+    m = _wheel_file_re.match(filename)
+    if not m:
+        return None
+    return (canonical_name(m.group('name')), m.group('version'),
+            m.group('interpreter', 'abi', 'platform'))
+
+
+def _scan_directory(directory):
+    """List (filename, name, version, tags) for the wheels in directory"""
+    wheels = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            parsed = parse_wheel_filename(entry.name)
+            if parsed is not None:
+                wheels.append((entry.name,) + parsed)
+    return wheels
+
+
+class WheelIndex(object):
+    """Find wheels in local directories by distribution name and version
+
+    If the database can't be used, e.g. because it's locked or corrupt,
+    directories are listed on each lookup instead, so this never stops a
+    build.
+    """
+    def __init__(self, db_path=None):
+        if db_path is None:
+            db_path = get_cache_dir(ensure_existence=True) / 'wheel-index.sqlite3'
+        self.db_path = db_path
+        # One connection shared between threads, protected by a lock
+        self._lock = threading.Lock()
+        try:
+            # Transactions are started explicitly, in _refresh
+            self._conn = sqlite3.connect(str(db_path), timeout=30,
+                                         check_same_thread=False,
+                                         isolation_level=None)
+            self._conn.executescript(_SCHEMA)
+        except sqlite3.Error as e:
+            logger.warning("Can't use wheel index %s: %s", db_path, e)
+            self._conn = None
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+
+    def _refresh(self, directory):
+        """Update the index for directory if it has changed since we last saw it
+
+        Must be called with the lock held. Returns False if it doesn't exist.
+        """
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            return False
+
+        row = self._conn.execute(
+            "SELECT mtime_ns FROM directories WHERE path = ?", (directory,)
+        ).fetchone()
+        if row is not None and row[0] == mtime_ns:
+            return True
+
+        logger.debug('Updating index of wheels in %s', directory)
+        with os.scandir(directory) as it:
+            filenames = {e.name for e in it if e.name.endswith('.whl')}
+        if time.time() - (mtime_ns / 1e9) < _RACY_INTERVAL:
+            mtime_ns = None
+
+        # Take the write lock before reading what's indexed, so another build
+        # sharing this cache can't change it between our read and write.
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            indexed = {r[0] for r in self._conn.execute(
+                "SELECT filename FROM wheels WHERE directory = ?", (directory,)
+            )}
+            self._conn.executemany(
+                "DELETE FROM wheels WHERE directory = ? AND filename = ?",
+                [(directory, fn) for fn in indexed - filenames]
+            )
+            added = []
+            for fn in filenames - indexed:
+                parsed = parse_wheel_filename(fn)
+                if parsed is not None:
+                    name, version, tags = parsed
+                    added.append((directory, fn, name, version) + tags)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO wheels VALUES (?, ?, ?, ?, ?, ?, ?)",
+                added
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO directories VALUES (?, ?)",
+                (directory, mtime_ns)
+            )
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+        return True
+
+    def find(self, directory, name, version):
+        """Find wheels for one version of a distribution in directory
+
+        Returns a list of (filename, (interpreter, abi, platform)) tuples.
+        """
+        directory = os.path.abspath(str(directory))
+        name = canonical_name(name)
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    if not self._refresh(directory):
+                        return []
+                    rows = self._conn.execute(
+                        "SELECT filename, interpreter, abi, platform "
+                        "FROM wheels WHERE directory = ? AND name = ? "
+                        "AND version = ?", (directory, name, version)
+                    ).fetchall()
+                    return [(r[0], tuple(r[1:])) for r in rows]
+                except sqlite3.Error as e:
+                    logger.warning("Can't use wheel index %s (%s); listing "
+                                   "%s instead", self.db_path, e, directory)
+
+        if not os.path.isdir(directory):
+            return []
+        return [(fn, tags) for fn, n, v, tags in _scan_directory(directory)
+                if n == name and v == version]
@@ -1,5 +1,4 @@
 """Find, download and unpack wheels."""
-import fnmatch
 import hashlib
 import itertools
 import logging
@@ -7,14 +6,23 @@ import glob
 import os
 import re
 import shutil
-import yarg
 import zipfile
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from requests_download import download, HashTracker
+from requests_download import HashTracker
 from tempfile import mkdtemp
 
-from .util import get_cache_dir, normalize_path
+from .cache import record_access
+from .excludes import ExcludeMatcher
+from .fileops import CopyEngine, fast_copy2, link_or_copy
+from .hashing import remove_sidecar
+from .pypi import MetadataError, PyPIMetadataCache, make_indexes
+from .util import (
+    cached_file_hit, canonical_name, download, get_cache_dir, get_cache_layers,
+    wheel_cache_dir,
+)
+from .wheelindex import WheelIndex, parse_wheel_filename
 
 logger = logging.getLogger(__name__)
 
@@ -46,7 +54,10 @@ class CompatibilityScorer:
         if not m:
             raise ValueError("Failed to find wheel tag in %r" % whl_filename)
 
-        interpreter, abi, platform = m.group(1, 2, 3)
+        return self.score_tags(*m.group(1, 2, 3))
+
+    def score_tags(self, interpreter, abi, platform) -> int:
+        """Like :meth:`score`, but for tags already split from the filename"""
         # Expand compressed tags ('cp38.cp39' indicates compatibility w/ both)
         expanded_tags = itertools.product(
             interpreter.split('.'), abi.split('.'), platform.split('.')
@@ -57,10 +68,17 @@ class CompatibilityScorer:
         return self.score(whl_filename) > 0
 
 class WheelLocator(object):
-    def __init__(self, requirement, scorer, extra_sources=None):
+    def __init__(self, requirement, scorer, extra_sources=None, indexes=None,
+                 index=None, sdist_builder=None):
         self.requirement = requirement
         self.scorer = scorer
         self.extra_sources = extra_sources or []
+        # Package indexes (see nsist.pypi) to search, in priority order
+        self.indexes = indexes if (indexes is not None) else [PyPIMetadataCache()]
+        # A WheelIndex to look up local wheels; if None, we list directories
+        self.index = index
+        # An nsist.sdists.SdistBuilder, to build wheels if none are published
+        self.sdist_builder = sdist_builder
 
         if requirement.count('==') != 1:
             raise ValueError("Requirement {!r} did not match name==version".format(requirement))
@@ -77,7 +95,10 @@ class WheelLocator(object):
             if release.package_type != 'wheel':
                 continue
 
-            score = self.scorer.score(release.filename)
+            if getattr(release, 'tags', None):
+                score = self.scorer.score_tags(*release.tags)
+            else:
+                score = self.scorer.score(release.filename)
             if score == 0:
                 # Incompatible
                 continue
@@ -88,20 +109,30 @@ class WheelLocator(object):
 
         return best
 
+    def _local_candidates(self, directory):
+        """List CachedRelease objects for wheels of this release in directory"""
+        escaped_version = re.sub(r'[^\w\d.]+', '_', self.version)
+        if self.index is not None:
+            return [CachedRelease(filename, tags)
+                    for filename, tags in self.index.find(
+                        directory, self.name, escaped_version)]
+
+        if not directory.is_dir():
+            return []
+        candidates = []
+        for p in directory.iterdir():
+            parsed = parse_wheel_filename(p.name)
+            if parsed and parsed[:2] == (canonical_name(self.name), escaped_version):
+                candidates.append(CachedRelease(p.name, parsed[2]))
+        return candidates
+
     def check_extra_sources(self):
         """Find a compatible wheel in the specified extra_sources directories.
 
         Returns a Path or None.
         """
-        whl_filename_prefix = '{name}-{version}-'.format(
-            name=re.sub(r'[^\w\d.]+', '_', self.name),
-            version=re.sub(r'[^\w\d.]+', '_', self.version),
-        )
         for source in self.extra_sources:
-            candidates = [CachedRelease(p.name)
-                          for p in source.iterdir()
-                          if p.name.startswith(whl_filename_prefix)]
-            rel = self.pick_best_wheel(candidates)
+            rel = self.pick_best_wheel(self._local_candidates(source))
             if rel:
                 path = source / rel.filename
                 return path
@@ -110,40 +141,113 @@ class WheelLocator(object):
         """Find a wheel previously downloaded from PyPI in the cache.
 
         Returns a Path or None.
+
+        Read-only shared cache layers are checked after the local cache
+        (see :func:`nsist.util.get_cache_layers`).
         """
-        release_dir = get_cache_dir() / 'pypi' / self.name / self.version
-        if not release_dir.is_dir():
-            return None
+        for i, layer in enumerate(get_cache_layers()):
+            release_dirs = [wheel_cache_dir(self.name, self.version,
+                                            None if i == 0 else layer)]
+            if i > 0:
+                # Shared caches may not have been migrated to normalized names
+                release_dirs.append(layer / 'pypi' / self.name / self.version)
+            for release_dir in release_dirs:
+                rel = self.pick_best_wheel(self._local_candidates(release_dir))
+                if rel is not None:
+                    hit = cached_file_hit(release_dir / rel.filename, layer)
+                    if hit is not None:
+                        return hit
+
+        return None
+
+    def find_remote_wheel(self):
+        """Find the best compatible wheel on the package indexes
+
+        Indexes are searched in order, and the first one with a compatible
+        wheel for this release is used. Returns a RemoteRelease object.
+        Raises NoWheelError if no compatible wheel is found.
+        """
+        errors = []
+        found_release = False
+        for index in self.indexes:
+            try:
+                release_list = index.release_files(self.name, self.version)
+            except MetadataError as e:
+                errors.append(str(e))
+                continue
+            if release_list is None:
+                continue
+            found_release = True
+            best = self.pick_best_wheel(release_list)
+            if best is not None:
+                return best
 
-        rel = self.pick_best_wheel(CachedRelease(p.name)
-                                   for p in release_dir.iterdir())
-        if rel is None:
+        if found_release:
+            raise NoWheelError('No compatible wheels found for {0.name} {0.version}'.format(self))
+        if len(errors) == len(self.indexes):
+            raise NoWheelError(errors[0])
+        raise NoWheelError("No release {0.version} for package {0.name}".format(self))
+
+    def find_remote_sdist(self):
+        """Find an sdist for this release on the package indexes
+
+        Returns a RemoteRelease object, or None if there is no sdist.
+        """
+        for index in self.indexes:
+            try:
+                release_list = index.release_files(self.name, self.version)
+            except MetadataError:
+                continue
+            for release in release_list or []:
+                if release.package_type == 'sdist':
+                    return release
+        return None
+
+    def build_from_sdist(self):
+        """Build a wheel from the sdist, if there is one and it's allowed
+
+        Returns a Path, or None.
+        """
+        if self.sdist_builder is None:
+            return None
+        sdist = self.find_remote_sdist()
+        if sdist is None:
+            return None
+        if any(ix.offline for ix in self.indexes) and not \
+                (wheel_cache_dir(self.name, self.version) / sdist.filename).is_file():
             return None
+        return self.sdist_builder.get_wheel(self, sdist)
 
-        return release_dir / rel.filename
+    def open_remote_wheel(self):
+        """Open the best compatible wheel on the indexes without downloading it
 
-    def get_from_pypi(self):
-        """Download a compatible wheel from PyPI.
+        Returns a :class:`nsist.remotezip.RemoteZipFile`, which fetches only
+        the parts of the wheel that are read. Raises
+        :exc:`nsist.remotezip.RangeRequestsNotSupported` if the server can't
+        send part of a file.
+        """
+        from . import __version__
+        from .remotezip import RemoteZipFile
+        release = self.find_remote_wheel()
+        if any(ix.offline for ix in self.indexes):
+            raise NoWheelError('{} is not in the cache (offline mode)'
+                               .format(release.filename))
+        headers = {'user-agent': 'pynsist/'+__version__}
+        return RemoteZipFile(release.url, headers=headers)
+
+    def get_from_pypi(self, trackers=()):
+        """Download a compatible wheel from PyPI (or the configured indexes).
 
         Downloads to the cache directory and returns the destination as a Path.
-        Raises NoWheelError if no compatible wheel is found.
+        Raises NoWheelError if no compatible wheel is found. trackers are
+        passed to :func:`nsist.util.download`, to see the data as it arrives.
         """
-        try:
-            pypi_pkg = yarg.get(self.name)
-        except yarg.HTTPError as e:
-            if e.status_code == 404:
-                raise NoWheelError("No package named {} found on PyPI".format(self.name))
-            raise
-
-        release_list = pypi_pkg.release(self.version)
-        if release_list is None:
-            raise NoWheelError("No release {0.version} for package {0.name}".format(self))
-
-        preferred_release = self.pick_best_wheel(release_list)
-        if preferred_release is None:
-            raise NoWheelError('No compatible wheels found for {0.name} {0.version}'.format(self))
+        preferred_release = self.find_remote_wheel()
+        if any(ix.offline for ix in self.indexes):
+            raise NoWheelError('{} is not in the cache (offline mode)'
+                               .format(preferred_release.filename))
 
-        download_to = get_cache_dir() / 'pypi' / self.name / self.version
+        download_to = wheel_cache_dir(self.name, self.version)
         try:
             download_to.mkdir(parents=True)
         except OSError:
@@ -153,19 +257,28 @@ class WheelLocator(object):
         target = download_to / preferred_release.filename
 
         from . import __version__
-        hasher = HashTracker(hashlib.md5())
+        if preferred_release.sha256_digest:
+            hasher = HashTracker(hashlib.sha256())
+            expected_hash = preferred_release.sha256_digest
+        else:
+            hasher = HashTracker(hashlib.md5())
+            expected_hash = preferred_release.md5_digest
         headers = {'user-agent': 'pynsist/'+__version__}
         logger.info('Downloading wheel: %s', preferred_release.url)
         download(preferred_release.url, str(target), headers=headers,
-                 trackers=(hasher,))
-        if hasher.hashobj.hexdigest() != preferred_release.md5_digest:
+                 trackers=(hasher,) + tuple(trackers))
+        if expected_hash and hasher.hashobj.hexdigest() != expected_hash:
             target.unlink()
+            remove_sidecar(target)
             raise ValueError('Downloaded wheel corrupted: {}'.format(preferred_release.url))
 
         return target
 
-    def fetch(self):
-        """Find and return a compatible wheel (main interface)"""
+    def fetch(self, trackers=()):
+        """Find and return a compatible wheel (main interface)
+
+        trackers see the wheel's data if it is downloaded.
+        """
         p = self.check_extra_sources()
         if p is not None:
             logger.info('Using wheel from extra directory: %s', p)
@@ -174,117 +287,393 @@ class WheelLocator(object):
         p = self.check_cache()
         if p is not None:
             logger.info('Using cached wheel: %s', p)
+            record_access(p, hit=True)
             return p
 
-        return self.get_from_pypi()
+        try:
+            p = self.get_from_pypi(trackers)
+        except NoWheelError:
+            p = self.build_from_sdist()
+            if p is None:
+                raise
+            return p
+        record_access(p, hit=False)
+        return p
 
 
 class CachedRelease(object):
-    # Mock enough of the yarg Release object to be compatible with
+    # Mock enough of the RemoteRelease object to be compatible with
     # pick_best_release above
-    def __init__(self, filename):
+    def __init__(self, filename, tags=None):
         self.filename = filename
         self.package_type = 'wheel' if filename.endswith('.whl') else ''
+        # (interpreter, abi, platform), if already parsed from the filename
+        self.tags = tags
 
-def merge_dir_to(src, dst):
+def merge_dir_to(src, dst, copy_function=fast_copy2, engine=None):
     """Merge all files from one directory into another.
 
     Subdirectories will be merged recursively. If filenames are the same, those
     from src will overwrite those in dst. If a regular file clashes with a
-    directory, an error will occur.
+    directory, an error will occur. Files are copied on engine (a
+    :class:`nsist.fileops.CopyEngine`), or on a new one which is waited for.
     """
+    if engine is None:
+        with CopyEngine() as engine:
+            return merge_dir_to(src, dst, copy_function, engine)
+
     for p in src.iterdir():
         if p.is_dir():
             dst_p = dst / p.name
             if dst_p.is_dir():
-                merge_dir_to(p, dst_p)
+                merge_dir_to(p, dst_p, copy_function, engine)
             elif dst_p.is_file():
                 raise RuntimeError('Directory {} clashes with file {}'
                                    .format(p, dst_p))
             else:
-                shutil.copytree(str(p), str(dst_p))
+                engine.copytree(str(p), str(dst_p), copy_function=copy_function)
         else:
             # Copy regular file
             dst_p = dst / p.name
             if dst_p.is_dir():
                 raise RuntimeError('File {} clashes with directory {}'
                                    .format(p, dst_p))
-            shutil.copy2(str(p), str(dst_p))
+            if dst_p.exists():
+                # Replace rather than overwrite the file, in case it is a
+                # hard link into the extracted wheel cache.
+                dst_p.unlink()
+            engine.copy(str(p), str(dst_p), copy_function)
 
 
-def extract_wheel(whl_file, target_dir, exclude=None):
+def extract_wheel(whl_file, target_dir, exclude=None, cache=None):
     """Extract importable modules from a wheel to the target directory
+
+    If cache is an :class:`ExtractedWheelCache`, the files are linked or copied
+    from a previously extracted copy of the wheel when possible.
     """
-    # Extract to temporary directory
-    td = Path(mkdtemp())
-    with zipfile.ZipFile(str(whl_file), mode='r') as zf:
-        if exclude:
-            exclude_regexen = make_exclude_regexen(exclude)
-            for zpath in zf.namelist():
-                if is_excluded('pkgs/' + zpath, exclude_regexen):
-                    continue  # Skip excluded paths
-                zf.extract(zpath, path=str(td))
-        else:
-            zf.extractall(str(td))
+    if cache is not None:
+        cache.extract(whl_file, target_dir, exclude=exclude)
+        return
 
-    # Move extra lib files out of the .data subdirectory
-    for p in td.iterdir():
-        if p.suffix == '.data':
-            if (p / 'purelib').is_dir():
-                merge_dir_to(p / 'purelib', td)
-            if (p / 'platlib').is_dir():
-                merge_dir_to(p / 'platlib', td)
-
-            # HACK: Some wheels from Christoph Gohlke's page have extra package
-            # files added in data/Lib/site-packages. This is a trick that relies
-            # on the default installation layout. It doesn't look like it will
-            # change, so in the best tradition of packaging, we'll work around
-            # the workaround.
-            # https://github.com/takluyver/pynsist/issues/171
-            # This is especially ugly because we do a case-insensitive match,
-            # regardless of the filesystem.
-            if (p / 'data').is_dir():
-                for sd in (p / 'data').iterdir():
-                    if sd.name.lower() == 'lib' and sd.is_dir():
-                        for sd2 in sd.iterdir():
-                            if sd2.name.lower() == 'site-packages' and sd2.is_dir():
-                                merge_dir_to(sd2, td)
-
-    # Copy to target directory
     target = Path(target_dir)
-    copied_something = False
-    for p in td.iterdir():
-        if p.suffix not in {'.data'}:
-            if p.is_dir():
-                # If the dst directory already exists, this will combine them.
-                # shutil.copytree will not combine them.
-                try:
-                    target.joinpath(p.name).mkdir()
-                except OSError:
-                    if not target.joinpath(p.name).is_dir():
-                        raise
-                merge_dir_to(p, target / p.name)
-            else:
-                shutil.copy2(str(p), str(target))
-            copied_something = True
+    excluded = ExcludeMatcher(exclude or [])
+    with zipfile.ZipFile(str(whl_file), mode='r') as zf:
+        members = _wheel_members(zf, excluded)
+        made_dirs = set()
+        for parts, zinfo in members:
+            _extract_member(zf, zinfo, target, parts, made_dirs)
 
-    if not copied_something:
+    if not members:
         raise RuntimeError("Did not find any files to extract from wheel {}"
                            .format(whl_file))
 
-    # Clean up temporary directory
-    shutil.rmtree(str(td))
+
+def _wheel_members(zf, excluded=None):
+    """List (path_parts, zinfo) for the members of a wheel to extract
+
+    They are in the order to extract them: files from .data/purelib etc.
+    replace those at the top level of the wheel. Python's sort is stable, so
+    otherwise the zip order is kept.
+    """
+    members = []
+    for zinfo in zf.infolist():
+        dest = _member_destination(zinfo.filename, excluded)
+        if dest is not None:
+            members.append((dest, zinfo))
+    members.sort(key=lambda m: m[0][0])
+    return [(parts, zinfo) for (_, parts), zinfo in members]
+
+
+def _member_destination(name, excluded=None):
+    """Like _wheel_member_destination, but None for excluded paths too
+
+    excluded is an :class:`nsist.excludes.ExcludeMatcher`.
+    """
+    if excluded and excluded('pkgs/' + name):
+        return None
+    return _wheel_member_destination(name)
+
+
+def _wheel_member_destination(name):
+    """Find where a file from a wheel should go, relative to the target
+
+    Returns (priority, path_parts), or None if the file shouldn't be extracted.
+    Higher priorities overwrite lower ones where they contain the same file.
+    """
+    # Drop path components which could point outside the target, as
+    # ZipFile.extract() does.
+    parts = [p for p in name.split('/') if p not in {'', '.', '..'}]
+    if not parts:
+        return None
+    if os.path.splitext(parts[0])[1] != '.data':
+        return 0, parts
+
+    # Move extra lib files out of the .data subdirectory
+    if len(parts) > 2 and parts[1] == 'purelib':
+        return 1, parts[2:]
+    if len(parts) > 2 and parts[1] == 'platlib':
+        return 2, parts[2:]
+
+    # HACK: Some wheels from Christoph Gohlke's page have extra package
+    # files added in data/Lib/site-packages. This is a trick that relies
+    # on the default installation layout. It doesn't look like it will
+    # change, so in the best tradition of packaging, we'll work around
+    # the workaround.
+    # https://github.com/takluyver/pynsist/issues/171
+    # This is especially ugly because we do a case-insensitive match,
+    # regardless of the filesystem.
+    if len(parts) > 4 and parts[1] == 'data' and parts[2].lower() == 'lib' \
+            and parts[3].lower() == 'site-packages':
+        return 3, parts[4:]
+
+    return None
+
+
+def _extract_member(zf, zinfo, target, parts, made_dirs, streamed=None):
+    """Write one member of a zip file directly to target/parts
+
+    made_dirs is a set of directories already created, to skip checking them.
+    If streamed is the path of a file already holding the member's contents,
+    it is moved into place instead of reading the member from zf.
+    """
+    dest = target.joinpath(*parts)
+    for i in range(1, len(parts)):
+        parent = target.joinpath(*parts[:i])
+        if parent in made_dirs:
+            continue
+        if parent.is_file():
+            raise RuntimeError('Directory {} clashes with file {}'
+                               .format(zinfo.filename, parent))
+        parent.mkdir(exist_ok=True)
+        made_dirs.add(parent)
+
+    if zinfo.is_dir():
+        if dest.is_file():
+            raise RuntimeError('Directory {} clashes with file {}'
+                               .format(zinfo.filename, dest))
+        dest.mkdir(exist_ok=True)
+        return
+
+    if dest.is_dir():
+        raise RuntimeError('File {} clashes with directory {}'
+                           .format(zinfo.filename, dest))
+    if dest.exists():
+        # Replace rather than overwrite, in case it's a hard link
+        dest.unlink()
+    if streamed is not None:
+        os.rename(str(streamed), str(dest))
+        return
+    with zf.open(zinfo) as fsrc, dest.open('wb') as fdst:
+        shutil.copyfileobj(fsrc, fdst, 1 << 20)
+
+
+class StreamingExtractor(object):
+    """Extract a wheel into the cache while it is being downloaded
+
+    This is a download tracker (see :func:`nsist.util.download`), so it sees
+    the wheel's data as it arrives. Members are decompressed to a temporary
+    directory straight away, using their local headers (see
+    :mod:`nsist.streamzip`). :meth:`finish` then checks them against the
+    central directory of the complete wheel, and moves them into place in
+    the :class:`ExtractedWheelCache`. Anything that wasn't streamed
+    correctly is extracted from the wheel file as usual.
+
+    If no download happens, e.g. because the wheel was already cached, this
+    does nothing.
+    """
+    def __init__(self, cache, exclude=None):
+        self.cache = cache
+        self.exclude = exclude
+        self.excluded = ExcludeMatcher(exclude or [])
+        self.streamed_count = 0
+        self._reset()
+
+    def _reset(self):
+        self._hasher = hashlib.sha256()
+        self._reader = None
+        self._raw_dir = None
+        self._files = {}  # Member name -> Path of streamed contents
+
+    def _open_member(self, name):
+        if _member_destination(name, self.excluded) is None:
+            return None
+        path = self._raw_dir / str(len(self._files))
+        old = self._files.pop(name, None)
+        if old is not None:
+            # The same name appears twice in the zip file
+            old.unlink()
+        self._files[name] = path
+        return path.open('wb')
+
+    def on_start(self, response):
+        # A resumed download starts again from the beginning of the file
+        self.discard()
+
+    def on_chunk(self, chunk):
+        if self._reader is None:
+            self.cache.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._raw_dir = Path(mkdtemp(dir=str(self.cache.cache_dir),
+                                         prefix='tmp-'))
+            from .streamzip import StreamingZipReader
+            self._reader = StreamingZipReader(self._open_member)
+        self._hasher.update(chunk)
+        self._reader.feed(chunk)
+
+    def on_finish(self):
+        pass
+
+    def discard(self):
+        """Throw away anything streamed so far"""
+        if self._reader is not None:
+            self._reader.close()
+        if self._raw_dir is not None and self._raw_dir.is_dir():
+            shutil.rmtree(str(self._raw_dir))
+        self._reset()
+
+    def finish(self, whl_file):
+        """Put the extracted wheel in the cache, once it's fully downloaded"""
+        if self._reader is None:
+            return  # Nothing was downloaded
+        try:
+            key = self.cache.key_from_hash(self._hasher, self.exclude)
+            tree = self.cache.cache_dir / key
+            if not tree.is_dir():
+                self.cache.add_tree(tree, self._reconcile, whl_file)
+        finally:
+            self.discard()
+
+    def _reconcile(self, whl_file, target):
+        streamed = {m.name: m for m in self._reader.members}
+        with zipfile.ZipFile(str(whl_file), mode='r') as zf:
+            members = _wheel_members(zf, self.excluded)
+            made_dirs = set()
+            for parts, zinfo in members:
+                m = streamed.get(zinfo.filename)
+                src = None
+                if m is not None and (m.crc, m.size) == \
+                        (zinfo.CRC, zinfo.file_size) and not zinfo.is_dir() \
+                        and self._files[m.name].is_file():
+                    src = self._files[m.name]
+                    self.streamed_count += 1
+                _extract_member(zf, zinfo, target, parts, made_dirs, src)
+        if not members:
+            raise RuntimeError("Did not find any files to extract from wheel {}"
+                               .format(whl_file))
+        logger.debug('Extracted %d of %d files from %s while downloading',
+                     self.streamed_count, len(members), whl_file)
+
+
+class ExtractedWheelCache(object):
+    """Wheels already extracted by :func:`extract_wheel`, ready to reuse
+
+    Each extracted tree is stored under ``extracted/`` in the cache directory,
+    keyed by the sha256 hash of the wheel and the exclude patterns used.
+    Files are materialised in the target directory with reflinks or hard links
+    where the filesystem allows, or else copied.
+    """
+    # Change this if extract_wheel produces different output, to invalidate
+    # previously extracted trees.
+    layout_version = 2
+
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = get_cache_dir() / 'extracted'
+        self.cache_dir = Path(cache_dir)
+
+    def key(self, whl_file, exclude=None):
+        h = hashlib.sha256()
+        with open(str(whl_file), 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return self.key_from_hash(h, exclude)
+
+    def key_from_hash(self, h, exclude=None):
+        """Finish the key, given a sha256 object fed with the wheel's data"""
+        h = h.copy()
+        h.update('\0{}\0'.format(self.layout_version).encode())
+        for pattern in sorted(exclude or []):
+            h.update(pattern.encode('utf-8') + b'\0')
+        return h.hexdigest()
+
+    def add_tree(self, tree, extract, whl_file):
+        """Extract a wheel into the cache at tree, using extract(whl_file, dir)
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Extract to a temporary name and rename it into place, so other
+        # builds never see a partly extracted tree.
+        td = Path(mkdtemp(dir=str(self.cache_dir), prefix='tmp-'))
+        try:
+            extract(whl_file, td)
+            try:
+                os.rename(str(td), str(tree))
+            except OSError:
+                if not tree.is_dir():
+                    raise
+                # Another build extracted the same wheel at the same time
+        finally:
+            if td.is_dir():
+                shutil.rmtree(str(td))
+        record_access(tree, hit=False)
+
+    def get_tree(self, whl_file, exclude=None):
+        """Return the directory where the wheel is extracted
+
+        The wheel is extracted into the cache first if necessary.
+        """
+        tree = self.cache_dir / self.key(whl_file, exclude)
+        if tree.is_dir():
+            record_access(tree, hit=True)
+            return tree
+
+        self.add_tree(tree, lambda whl, td: extract_wheel(whl, td, exclude),
+                      whl_file)
+        return tree
+
+    def streaming_extractor(self, exclude=None):
+        """Make a download tracker to extract a wheel as it downloads"""
+        return StreamingExtractor(self, exclude)
+
+    def extract(self, whl_file, target_dir, exclude=None):
+        tree = self.get_tree(whl_file, exclude)
+        merge_dir_to(tree, Path(target_dir), copy_function=link_or_copy)
+
 
 class WheelGetter:
     def __init__(self, requirements, wheel_globs, target_dir,
-                 py_version, bitness, extra_sources=None, exclude=None):
+                 py_version, bitness, extra_sources=None, exclude=None,
+                 jobs=1, offline=None, lock=None, index_urls=None,
+                 find_links=None, resolve=False, build_sdists=False,
+                 index=None, extract_cache=None):
         self.requirements = requirements
         self.wheel_globs = wheel_globs
         self.target_dir = target_dir
+        self.py_version = py_version
+        self.bitness = bitness
         target_platform = 'win_amd64' if bitness == 64 else 'win32'
         self.scorer = CompatibilityScorer(py_version, target_platform)
         self.extra_sources = extra_sources
         self.exclude = exclude
+        self.jobs = jobs
+        # Shared by all the requirements, so they use the same settings
+        self.indexes = make_indexes(index_urls, find_links, offline=offline)
+        # A WheelIndex to look up wheels in local directories
+        self.index = index if (index is not None) else WheelIndex()
+        # An ExtractedWheelCache to reuse extracted wheels, or False to always
+        # extract them from the wheel files
+        if extract_cache is None:
+            extract_cache = ExtractedWheelCache()
+        self.extract_cache = extract_cache or None
+        # Also fetch the dependencies of the requirements
+        self.resolve = resolve
+        self.sdist_builder = None
+        if build_sdists:
+            from .sdists import SdistBuilder
+            self.sdist_builder = SdistBuilder(jobs=jobs)
+        # Lockfile data from nsist.lockfile.read_lockfile(), or None
+        self.lock = lock
+        if lock is not None:
+            from .lockfile import check_lock_matches
+            check_lock_matches(lock, py_version, bitness)
 
         self.got_distributions = {}
 
@@ -292,16 +681,87 @@ class WheelGetter:
         self.get_requirements()
         self.get_globs()
 
+    def requirement_locators(self):
+        """Get an object with a fetch() method for each wheel to fetch
+
+        These are WheelLocator objects, or LockedWheel objects if there is a
+        lockfile.
+        """
+        if self.lock is not None:
+            from .lockfile import locked_wheels_for
+            return locked_wheels_for(self.lock, self.requirements,
+                                     resolved=self.resolve)
+
+        requirements = self.requirements
+        if self.resolve:
+            requirements = self.resolve_requirements()
+        return [WheelLocator(req, self.scorer, self.extra_sources,
+                             indexes=self.indexes, index=self.index,
+                             sdist_builder=self.sdist_builder)
+                for req in requirements]
+
     def get_requirements(self):
-        for req in self.requirements:
-            wl = WheelLocator(req, self.scorer, self.extra_sources)
-            whl_file = wl.fetch()
-            extract_wheel(whl_file, self.target_dir, exclude=self.exclude)
-            self.got_distributions[wl.name] = whl_file
+        locators = self.requirement_locators()
+        if self.jobs > 1 and len(locators) > 1:
+            self._get_requirements_pipelined(locators)
+            return
+
+        for wl in locators:
+            whl_file = self._fetch(wl)
+            self._extract_requirement(wl, whl_file)
+
+    def resolve_requirements(self):
+        """Find the requirements plus their dependencies, as name==version"""
+        from .resolver import Resolver
+        # Metadata is small, so look up several packages at once even if
+        # wheels are downloaded one at a time.
+        resolver = Resolver(self.scorer, self.indexes, self.py_version,
+                            self.bitness, self.extra_sources, index=self.index,
+                            jobs=max(self.jobs, 4))
+        return resolver.resolve(self.requirements)
+
+    def _get_requirements_pipelined(self, locators):
+        """Fetch wheels on a thread pool while extracting finished ones
+
+        Lookups and downloads run concurrently, but wheels are extracted in
+        the calling thread in the order the requirements were given. So files
+        overwrite each other, and errors are raised, exactly as they would be
+        when fetching one requirement at a time.
+        """
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            futures = [pool.submit(self._fetch, wl) for wl in locators]
+            try:
+                for wl, future in zip(locators, futures):
+                    self._extract_requirement(wl, future.result())
+            finally:
+                # If something failed, don't start any more downloads
+                for future in futures:
+                    future.cancel()
+
+    def _fetch(self, wl):
+        """Fetch a wheel, extracting it into the cache as it downloads"""
+        if self.extract_cache is None:
+            return wl.fetch()
+        stream = self.extract_cache.streaming_extractor(self.exclude)
+        try:
+            whl_file = wl.fetch(trackers=(stream,))
+            stream.finish(whl_file)
+        finally:
+            stream.discard()
+        return whl_file
+
+    def _extract_requirement(self, wl, whl_file):
+        extract_wheel(whl_file, self.target_dir, exclude=self.exclude,
+                      cache=self.extract_cache)
+        self.got_distributions[canonical_name(wl.name)] = whl_file
 
     def get_globs(self):
         for glob_path in self.wheel_globs:
-            paths = glob.glob(glob_path)
+            if self.lock is not None:
+                from .lockfile import locked_local_wheels
+                paths = locked_local_wheels(self.lock, glob_path)
+            else:
+                paths = glob.glob(glob_path)
             if not paths:
                 raise ValueError('Glob path {} does not match any files'
                                  .format(glob_path))
@@ -309,7 +769,8 @@ class WheelGetter:
                 logger.info('Collecting wheel file: %s (from: %s)',
                             os.path.basename(path), glob_path)
                 self.validate_wheel(path)
-                extract_wheel(path, self.target_dir, exclude=self.exclude)
+                extract_wheel(path, self.target_dir, exclude=self.exclude,
+                              cache=self.extract_cache)
 
     def validate_wheel(self, whl_path):
         """
@@ -318,7 +779,10 @@ class WheelGetter:
         If not, an exception will be raised.
         """
         wheel_name = os.path.basename(whl_path)
-        distribution = wheel_name.split('-', 1)[0]
+        parsed = parse_wheel_filename(wheel_name)
+        if parsed is None:
+            raise ValueError('{} is not a valid wheel filename'.format(wheel_name))
+        distribution = parsed[0]  # Normalized, e.g. 'PyQt_5' -> 'pyqt-5'
 
         # Check that a distribution of same name has not been included before
         if distribution in self.got_distributions:
@@ -334,31 +798,6 @@ class WheelGetter:
         self.got_distributions[distribution] = whl_path
 
 
-def make_exclude_regexen(exclude_patterns):
-    """Translate exclude glob patterns to regex pattern objects.
-
-    Handles matching files under a named directory.
-    """
-    re_pats = set()
-    for pattern in exclude_patterns:
-        re_pats.add(fnmatch.translate(pattern))
-        if not pattern.endswith('*'):
-            # Also use the pattern as a directory name and match anything
-            # under that directory.
-            suffix = '*' if pattern.endswith('/') else '/*'
-            re_pats.add(fnmatch.translate(pattern + suffix))
-
-    return [re.compile(p) for p in sorted(re_pats)]
-
-
-def is_excluded(path, exclude_regexen):
-    """Return True if path matches an exclude pattern"""
-    path = normalize_path(path)
-    for re_pattern in exclude_regexen:
-        if re_pattern.match(path):
-            return True
-    return False
-
 # The function below is based on the packaging.tags module, used with
 # modification following the BSD 2 clause license:
 